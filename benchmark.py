@@ -0,0 +1,1167 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import tarfile
+import threading
+import platform
+import shutil
+import socket
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from PIL import Image
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils import data
+import network
+from network._deeplab import ASPP, FusedASPP, StreamASPP
+from network.utils import chunked_upsample_argmax
+from datasets import VOCSegmentation, Cityscapes, LabelStats, ClassAwareSampler
+from datasets.utils import download_url, check_integrity, download_url_parallel
+from utils import ext_transforms as et
+from utils.label_io import LabelWriter, make_palette
+import utils
+from metrics import StreamSegMetrics, ImageSegMetrics
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bench", type=str, default='aspp',
+                        choices=sorted(BENCHMARKS), help='benchmark to run')
+    parser.add_argument("--gpu_id", type=str, default=None,
+                        help="GPU ID (default: run on CPU)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="number of intra-op CPU threads (default: torch default)")
+    parser.add_argument("--n_warmup", type=int, default=3,
+                        help="untimed iterations before measuring (default: 3)")
+    parser.add_argument("--n_iters", type=int, default=10,
+                        help="timed iterations (default: 10)")
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--train_iters", type=int, default=100,
+                        help="training iterations of the training benchmarks (default: 100)")
+    parser.add_argument("--crop_size", type=int, default=513)
+    parser.add_argument("--models", type=str, nargs='+', default=None,
+                        help="network.modeling models of the model benchmarks (default: all)")
+    parser.add_argument("--compile_backend", type=str, default='inductor',
+                        help="torch.compile backend of the compile benchmark (default: inductor)")
+
+    # Accuracy (optional, needs a dataset and a trained checkpoint)
+    parser.add_argument("--data_root", type=str, default=None,
+                        help="path to Dataset (default: no accuracy measurement)")
+    parser.add_argument("--dataset", type=str, default='voc',
+                        choices=['voc', 'cityscapes'], help='Name of dataset')
+    parser.add_argument("--ckpt", default=None, type=str,
+                        help="checkpoint evaluated by accuracy benchmarks")
+    parser.add_argument("--val_samples", type=int, default=100,
+                        help="number of val images used for mIoU (default: 100)")
+    return parser
+
+
+def timeit(fn, n_warmup=3, n_iters=10):
+    """Returns the median wall time of ``fn()`` in milliseconds"""
+    for _ in range(n_warmup):
+        fn()
+    times = []
+    for _ in range(n_iters):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times))
+
+
+def print_table(header, rows):
+    widths = [max(len(str(r[i])) for r in [header] + rows) for i in range(len(header))]
+    fmt = ' | '.join('%%-%ds' % w for w in widths)
+    print(fmt % tuple(header))
+    print('-+-'.join('-' * w for w in widths))
+    for r in rows:
+        print(fmt % tuple(r))
+
+
+def get_val_loader(opts):
+    """Loader over the first ``val_samples`` val images, or None without ``data_root``"""
+    if opts.data_root is None:
+        return None
+    transform = et.ExtCompose([
+        et.ExtResize(opts.crop_size),
+        et.ExtCenterCrop(opts.crop_size),
+        et.ExtToTensor(),
+        et.ExtNormalize(mean=[0.485, 0.456, 0.406],
+                        std=[0.229, 0.224, 0.225]),
+    ])
+    if opts.dataset == 'voc':
+        val_dst = VOCSegmentation(root=opts.data_root, image_set='val', transform=transform)
+    else:
+        val_dst = Cityscapes(root=opts.data_root, split='val', transform=transform)
+    val_dst = data.Subset(val_dst, range(min(opts.val_samples, len(val_dst))))
+    return data.DataLoader(val_dst, batch_size=opts.batch_size, shuffle=False, num_workers=2)
+
+
+def num_classes(opts):
+    return 21 if opts.dataset == 'voc' else 19
+
+
+def load_ckpt(model, opts):
+    if opts.ckpt is not None:
+        checkpoint = torch.load(opts.ckpt, map_location=torch.device('cpu'))
+        model.load_state_dict(checkpoint["model_state"])
+    return model
+
+
+def evaluate(model, loader, device, n_classes):
+    """mIoU of ``model`` over ``loader``"""
+    metrics = StreamSegMetrics(n_classes)
+    with torch.no_grad():
+        for images, labels in loader:
+            preds = model(images.to(device, dtype=torch.float32)).max(1)[1]
+            metrics.update(labels.numpy(), preds.cpu().numpy())
+    return metrics.get_results()['Mean IoU']
+
+
+def bench_aspp(opts, device):
+    """ASPP vs FusedASPP (sequential and threaded) at each output stride"""
+    rows = []
+    for in_channels in [320, 2048]:
+        for output_stride, rates in [(16, [6, 12, 18]), (8, [12, 24, 36])]:
+            size = (opts.crop_size - 1) // output_stride + 1
+            x = torch.randn(opts.batch_size, in_channels, size, size, device=device)
+            aspp = ASPP(in_channels, rates).to(device).eval()
+            variants = [('ASPP', aspp),
+                        ('FusedASPP', FusedASPP.from_aspp(aspp)),
+                        ('FusedASPP x5', FusedASPP.from_aspp(aspp, num_workers=5))]
+            with torch.no_grad():
+                ref = aspp(x)
+                base = None
+                for name, m in variants:
+                    err = (m(x) - ref).abs().max().item()
+                    ms = timeit(lambda: m(x), opts.n_warmup, opts.n_iters)
+                    base = base or ms
+                    rows.append([in_channels, 'OS%d' % output_stride, '%dx%d' % (size, size), name,
+                                 '%.2f' % ms, '%.2fx' % (base / ms), '%.1e' % err])
+    print_table(['in_ch', 'OS', 'feat', 'module', 'ms', 'speedup', 'max|err|'], rows)
+
+
+def bench_labels(opts, device):
+    """Full-size upsample + argmax vs chunked upsample-argmax on decoder-resolution logits"""
+    rows = []
+    for dataset, num_classes, (H, W) in [('voc', 21, (opts.crop_size, opts.crop_size)),
+                                         ('cityscapes', 19, (1024, 2048))]:
+        logits = torch.randn(opts.batch_size, num_classes, (H - 1) // 4 + 1, (W - 1) // 4 + 1, device=device)
+        full = lambda: F.interpolate(logits, size=(H, W), mode='bilinear', align_corners=False).max(1)[1]
+        ref = full()
+        full_bytes = logits.element_size() * num_classes * H * W * opts.batch_size
+        rows.append([dataset, 'upsample+max', '%.2f' % timeit(full, opts.n_warmup, opts.n_iters),
+                     '%.1f' % (full_bytes / 2 ** 20), '-', '-'])
+        for chunk_rows in [32, 128]:
+            pred = chunked_upsample_argmax(logits, (H, W), chunk_rows=chunk_rows)
+            metrics = StreamSegMetrics(num_classes)
+            metrics.update(ref.cpu().numpy(), pred.cpu().numpy())
+            ms = timeit(lambda: chunked_upsample_argmax(logits, (H, W), chunk_rows=chunk_rows),
+                        opts.n_warmup, opts.n_iters)
+            chunk_bytes = logits.element_size() * num_classes * chunk_rows * W * opts.batch_size
+            rows.append([dataset, 'chunked(%d rows)' % chunk_rows, '%.2f' % ms, '%.1f' % (chunk_bytes / 2 ** 20),
+                         '%.6f' % (pred.long() == ref).float().mean().item(),
+                         '%.6f' % metrics.get_results()['Mean IoU']])
+    print_table(['dataset', 'mode', 'ms', 'logits MiB', 'agreement', 'mIoU vs full'], rows)
+
+
+def bench_output_stride(opts, device):
+    """Latency (and mIoU with --data_root) of one model served at OS16 and OS8 via set_output_stride"""
+    loader = get_val_loader(opts)
+    x = torch.randn(opts.batch_size, 3, opts.crop_size, opts.crop_size, device=device)
+    rows = []
+    for name, kwargs in [('deeplabv3plus_mobilenet', {}),
+                         ('deeplabv3plus_resnet34', {'fl_maxpool': True, 'fl_stemstride': True}),
+                         ('deeplabv3plus_resnet50', {'fl_maxpool': True, 'fl_stemstride': True}),
+                         ('deeplabv3plus_resnet101', {'fl_maxpool': True, 'fl_stemstride': True})]:
+        model = network.modeling.__dict__[name](num_classes=num_classes(opts), output_stride=16,
+                                                pretrained_backbone=False, **kwargs)
+        model = load_ckpt(model, opts).to(device).eval()
+        preds = {}
+        for output_stride in [16, 8]:
+            network.set_output_stride(model, output_stride)
+            with torch.no_grad():
+                ms = timeit(lambda: model(x), opts.n_warmup, opts.n_iters)
+                preds[output_stride] = model(x).max(1)[1]
+            miou = '%.4f' % evaluate(model, loader, device, num_classes(opts)) if loader is not None else '-'
+            agreement = (preds[output_stride] == preds[16]).float().mean().item()
+            rows.append([name, 'OS%d' % output_stride, '%.1f' % ms, '%.4f' % agreement, miou])
+    print_table(['model', 'OS', 'ms', 'agreement w/ OS16', 'mIoU'], rows)
+
+
+def synthetic_sequence(n_frames, size, shift=2, device='cpu'):
+    """Smooth random scene translated by ``shift`` pixels per frame"""
+    scene = torch.randn(1, 3, size // 16 + 1, size // 16 + 1 + n_frames * shift // 16 + 1, device=device)
+    scene = F.interpolate(scene, scale_factor=16, mode='bilinear', align_corners=False)
+    return [scene[:, :, :size, i * shift:i * shift + size].contiguous() for i in range(n_frames)]
+
+
+def bench_video(opts, device):
+    """Per-frame inference vs VideoSegmenter keyframe policies on a moving sequence"""
+    n_frames = 20
+    frames = synthetic_sequence(n_frames, opts.crop_size, device=device)
+    rows = []
+    for name, kwargs in [('deeplabv3plus_mobilenet', {}),
+                         ('deeplabv3plus_resnet50', {'fl_maxpool': True, 'fl_stemstride': True})]:
+        model = network.modeling.__dict__[name](num_classes=num_classes(opts), output_stride=16,
+                                                pretrained_backbone=False, **kwargs)
+        model = load_ckpt(model, opts).to(device).eval()
+        with torch.no_grad():
+            start = time.perf_counter()
+            ref = [model(f).max(1)[1] for f in frames]
+            base = time.perf_counter() - start
+        rows.append([name, 'per-frame', n_frames, '%.2f' % (n_frames / base), '1.00x', '-'])
+        for key_interval, threshold in [(3, None), (5, None), (10, None), (None, 0.3), (10, 0.3)]:
+            segmenter = network.VideoSegmenter(model, key_interval=key_interval, change_threshold=threshold)
+            metrics = StreamSegMetrics(num_classes(opts))
+            start = time.perf_counter()
+            preds = [segmenter(f).max(1)[1] for f in frames]
+            elapsed = time.perf_counter() - start
+            for r, p in zip(ref, preds):
+                metrics.update(r.cpu().numpy(), p.cpu().numpy())
+            rows.append([name, 'interval=%s threshold=%s' % (key_interval, threshold), segmenter.n_keyframes,
+                         '%.2f' % (n_frames / elapsed), '%.2fx' % (base / elapsed),
+                         '%.4f' % metrics.get_results()['Mean IoU']])
+    print_table(['model', 'policy', 'keyframes', 'fps', 'speedup', 'mIoU vs per-frame'], rows)
+
+
+def synthetic_labels(n, size, n_classes, seed=0):
+    """Blobby label maps: nearest-upsampled random low-resolution labels"""
+    g = torch.Generator().manual_seed(seed)
+    low = torch.randint(0, n_classes, (n, 1, size[0] // 32 + 1, size[1] // 32 + 1), generator=g).float()
+    return F.interpolate(low, size=size, mode='nearest')[:, 0].numpy().astype(np.uint8)
+
+
+def bench_formats(opts, device):
+    """Output bytes and encode time per image for every LabelWriter format"""
+    rows = []
+    n_images = 16
+    for dataset, (H, W) in [('voc', (opts.crop_size, opts.crop_size)), ('cityscapes', (1024, 2048))]:
+        dst = VOCSegmentation if dataset == 'voc' else Cityscapes
+        colors = dst.cmap if dataset == 'voc' else dst.train_id_to_color
+        labels = synthetic_labels(n_images, (H, W), 21 if dataset == 'voc' else 19)
+        for fmt in ['rgb', 'palette', 'raw', 'rle', 'npz']:
+            out_dir = tempfile.mkdtemp()
+            writer = LabelWriter(out_dir, fmt, palette=make_palette(colors),
+                                 decode_fn=dst.decode_target, shard_size=n_images)
+            start = time.perf_counter()
+            for i, label in enumerate(labels):
+                writer.write('%d' % i, label.copy())
+            writer.close()
+            elapsed = time.perf_counter() - start
+            n_bytes = sum(os.path.getsize(os.path.join(out_dir, f)) for f in os.listdir(out_dir))
+            shutil.rmtree(out_dir)
+            rows.append([dataset, fmt, '%.1f' % (n_bytes / n_images / 1024), '%.2f' % (elapsed / n_images * 1000)])
+    print_table(['dataset', 'format', 'KiB/image', 'ms/image'], rows)
+
+
+def _save_matplotlib(image, target, pred, out_dir, img_id):
+    """The per-image path validate() used before render_batch"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    Image.fromarray(image).save(os.path.join(out_dir, '%d_image.png' % img_id))
+    Image.fromarray(target).save(os.path.join(out_dir, '%d_target.png' % img_id))
+    Image.fromarray(pred).save(os.path.join(out_dir, '%d_pred.png' % img_id))
+    plt.figure()
+    plt.imshow(image)
+    plt.axis('off')
+    plt.imshow(pred, alpha=0.7)
+    ax = plt.gca()
+    ax.xaxis.set_major_locator(matplotlib.ticker.NullLocator())
+    ax.yaxis.set_major_locator(matplotlib.ticker.NullLocator())
+    plt.savefig(os.path.join(out_dir, '%d_overlay.png' % img_id), bbox_inches='tight', pad_inches=0)
+    plt.close()
+
+
+def bench_render(opts, device):
+    """Saving validation results: per-image matplotlib vs render_batch + AsyncImageSaver"""
+    mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+    n_batches, batch_size = 4, 4
+    size = (opts.crop_size, opts.crop_size)
+    images = torch.randn(n_batches, batch_size, 3, *size)
+    labels = [synthetic_labels(batch_size, size, 21, seed=i) for i in range(n_batches)]
+    denorm = utils.Denormalize(mean=mean, std=std)
+    rows = []
+
+    out_dir = tempfile.mkdtemp()
+    start = time.perf_counter()
+    img_id = 0
+    for batch, targets in zip(images, labels):
+        for image, target in zip(batch.numpy(), targets):
+            image = (denorm(image) * 255).transpose(1, 2, 0).astype(np.uint8)
+            target = VOCSegmentation.decode_target(target).astype(np.uint8)
+            _save_matplotlib(image, target, target, out_dir, img_id)
+            img_id += 1
+    rows.append(['matplotlib', '%.1f' % ((time.perf_counter() - start) / img_id * 1000)])
+    shutil.rmtree(out_dir)
+
+    for num_workers in [1, 4]:
+        out_dir = tempfile.mkdtemp()
+        lut = utils.label_lut(VOCSegmentation)
+        start = time.perf_counter()
+        saver = utils.AsyncImageSaver(num_workers=num_workers)
+        img_id = 0
+        for batch, targets in zip(images, labels):
+            panels = utils.render_batch(batch, targets, targets, lut, mean=mean, std=std)
+            for j in range(len(batch)):
+                for name in ['image', 'target', 'pred', 'overlay']:
+                    saver.save(panels[name][j], os.path.join(out_dir, '%d_%s.png' % (img_id, name)))
+                img_id += 1
+        saver.close()
+        rows.append(['render_batch (%d threads)' % num_workers,
+                     '%.1f' % ((time.perf_counter() - start) / img_id * 1000)])
+        shutil.rmtree(out_dir)
+    print_table(['renderer', 'ms/sample (4 PNGs)'], rows)
+
+
+def synthetic_cityscapes(root, split='train', n_cities=8, n_images=50, size=(64, 128)):
+    """Cityscapes-like directory tree of small images: road (id 7) everywhere, a car (26) in
+    every label and a train (31), the rare class, in one label out of ten"""
+    img = Image.fromarray(np.zeros(size + (3,), dtype=np.uint8))
+    for c in range(n_cities):
+        city = 'city%02d' % c
+        os.makedirs(os.path.join(root, 'leftImg8bit', split, city))
+        os.makedirs(os.path.join(root, 'gtFine', split, city))
+        for i in range(n_images):
+            target = np.full(size, 7, dtype=np.uint8)
+            target[size[0] // 2:, :size[1] // 2] = 26
+            if i % 10 == 0:
+                target[:size[0] // 8, -size[1] // 8:] = 31
+            name = '%s_%06d_000019' % (city, i)
+            img.save(os.path.join(root, 'leftImg8bit', split, city, name + '_leftImg8bit.png'))
+            Image.fromarray(target).save(os.path.join(root, 'gtFine', split, city, name + '_gtFine_labelTrainIds.png'))
+
+
+def bench_manifest(opts, device):
+    """Dataset construction time: directory listing vs cold and warm manifest"""
+    if opts.data_root is not None and opts.dataset == 'cityscapes':
+        root, tmp_root = opts.data_root, None
+    else:
+        root = tmp_root = tempfile.mkdtemp()
+        synthetic_cityscapes(root)
+    manifest_dir = tempfile.mkdtemp()
+
+    rows = []
+    for name, kwargs in [('listdir', dict(use_manifest=False)),
+                         ('manifest (build)', dict(manifest_dir=manifest_dir)),
+                         ('manifest (cached)', dict(manifest_dir=manifest_dir))]:
+        start = time.perf_counter()
+        dst = Cityscapes(root, split='train', **kwargs)
+        rows.append([name, len(dst), '%.1f' % ((time.perf_counter() - start) * 1000)])
+    print_table(['index', 'images', 'ms'], rows)
+
+    shutil.rmtree(manifest_dir)
+    if tmp_root is not None:
+        shutil.rmtree(tmp_root)
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """Local stand-in for a dataset mirror: serves ``server.blob`` with byte ranges and
+    keep-alive, throttled to ``server.bandwidth`` bytes/s per connection"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, head_only):
+        blob = self.server.blob
+        start, end = 0, len(blob) - 1
+        status = 200
+        if 'Range' in self.headers:
+            start, end = [int(v) for v in self.headers['Range'].split('=')[1].split('-')]
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(blob)))
+        self.end_headers()
+        if head_only:
+            return
+        block = 64 * 1024
+        for offset in range(start, end + 1, block):
+            self.wfile.write(blob[offset:min(offset + block, end + 1)])
+            time.sleep(block / self.server.bandwidth)
+
+    def do_HEAD(self):
+        self._send(head_only=True)
+
+    def do_GET(self):
+        self._send(head_only=False)
+
+
+def serve_blob(blob, bandwidth=32 * 1024 * 1024):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    server.daemon_threads = True
+    server.blob = blob
+    server.bandwidth = bandwidth
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d/data.tar' % server.server_address[1]
+
+
+def synthetic_tar(n_files=32, file_size=1024 * 1024):
+    buf = io.BytesIO()
+    rng = np.random.RandomState(0)
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for i in range(n_files):
+            data = rng.bytes(file_size)
+            info = tarfile.TarInfo('data/%03d.bin' % i)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def bench_download(opts, device):
+    """Download + verify + extract of a tar from a local throttled server"""
+    blob = synthetic_tar()
+    md5 = hashlib.md5(blob).hexdigest()
+    server, url = serve_blob(blob)
+
+    def serial(root):
+        download_url(url, root, 'data.tar', md5)
+        assert check_integrity(os.path.join(root, 'data.tar'), md5)
+        with tarfile.open(os.path.join(root, 'data.tar'), "r") as tar:
+            tar.extractall(path=root)
+
+    rows = []
+    runs = [('urlretrieve + md5 + extract', serial)]
+    for n in [1, 4, 8]:
+        runs.append(('parallel, %d connections' % n,
+                     lambda root, n=n: download_url_parallel(url, root, 'data.tar', md5, extract=True,
+                                                             num_connections=n, chunk_size=1024 * 1024)))
+    for name, fn in runs:
+        root = tempfile.mkdtemp()
+        start = time.perf_counter()
+        fn(root)
+        elapsed = time.perf_counter() - start
+        assert len(os.listdir(os.path.join(root, 'data'))) == 32
+        shutil.rmtree(root)
+        rows.append([name, '%.2f' % elapsed, '%.1f' % (len(blob) / elapsed / 2 ** 20)])
+    server.shutdown()
+    print_table(['method', 's', 'MB/s'], rows)
+
+
+def bench_label_stats(opts, device):
+    """Label statistics indexing time and how often the rare class is seen by training"""
+    root = tempfile.mkdtemp()
+    synthetic_cityscapes(root)
+    dst = Cityscapes(root, split='train', use_manifest=False)
+    rows = []
+    for num_workers in [0, 4]:
+        start = time.perf_counter()
+        stats = LabelStats.compute(dst, 19, num_workers=num_workers)
+        rows.append(['index, %d workers' % num_workers, '%.2f s' % (time.perf_counter() - start)])
+
+    rare = Cityscapes.id_to_train_id[31]
+    img = Image.new('RGB', (128, 64))
+    for name, power, rare_prob in [('uniform', 0., 0.), ('class-aware sampler', 1., 0.),
+                                   ('sampler + rare crop', 1., 0.5)]:
+        crop = et.ExtRandomCrop((32, 32), class_weights=stats.crop_weights(Cityscapes.id_to_train_id),
+                                rare_prob=rare_prob)
+        hits = 0
+        indices = list(ClassAwareSampler(stats, num_samples=1000, power=power))
+        for i in indices:
+            _, lbl = crop(img, Image.open(dst.targets[i]))
+            hits += (Cityscapes.encode_target(lbl) == rare).any()
+        rows.append([name, 'rare class in %.1f%% of crops' % (100. * hits / len(indices))])
+    print_table(['setting', 'result'], rows)
+    shutil.rmtree(root)
+
+
+def saved_tensor_bytes(fn, inputs=()):
+    """Runs ``fn`` and returns its result and the bytes of the tensors autograd kept for
+    backward, besides ``inputs`` which are alive anyway"""
+    saved = {}
+    input_ptrs = set(t.untyped_storage().data_ptr() for t in inputs)
+
+    def pack(t):
+        ptr = t.untyped_storage().data_ptr()
+        if ptr not in input_ptrs:
+            saved[ptr] = t.untyped_storage().nbytes()
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    return out, sum(saved.values())
+
+
+def bench_loss(opts, device):
+    """Forward + backward time and memory kept for backward of the training losses"""
+    n_classes = 19
+    size = (opts.crop_size, opts.crop_size)
+    logits = torch.randn(opts.batch_size, n_classes, *size, device=device)
+    targets = torch.randint(0, n_classes, (opts.batch_size,) + size, device=device)
+    targets[:, :size[0] // 8] = 255
+    losses = [
+        ('CrossEntropyLoss', nn.CrossEntropyLoss(ignore_index=255)),
+        ('ChunkedCrossEntropyLoss', utils.ChunkedCrossEntropyLoss()),
+        ('FocalLoss(gamma=2)', utils.FocalLoss(gamma=2)),
+        ('ChunkedFocalLoss(gamma=2)', utils.ChunkedFocalLoss(gamma=2)),
+        ('OHEMCrossEntropyLoss', utils.OHEMCrossEntropyLoss()),
+    ]
+    rows = []
+    for name, criterion in losses:
+        criterion.to(device)
+        x = logits.clone().requires_grad_()
+
+        def step():
+            loss = criterion(x, targets)
+            loss.backward()
+            x.grad = None
+        _, n_bytes = saved_tensor_bytes(lambda: criterion(x, targets), inputs=(x, targets))
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        ms = timeit(step, opts.n_warmup, opts.n_iters)
+        peak = '%.1f' % (torch.cuda.max_memory_allocated(device) / 2 ** 20) if device.type == 'cuda' else '-'
+        rows.append([name, '%.1f' % ms, '%.1f' % (n_bytes / 2 ** 20), peak])
+    print_table(['loss', 'fwd+bwd ms', 'MiB saved for bwd', 'CUDA peak MiB'], rows)
+
+
+def synthetic_segmentation(n, size, n_classes, seed=0):
+    """Images of a few colored rectangles on a colored background, the class is the color"""
+    colors = np.random.RandomState(n_classes).uniform(-1.5, 1.5, (n_classes, 3)).astype(np.float32)
+    rng = np.random.RandomState(seed)
+    labels = np.zeros((n,) + size, dtype=np.int64)
+    for k in range(n):
+        labels[k] = rng.randint(n_classes)
+        for _ in range(4):
+            y, x = rng.randint(0, size[0] - 8), rng.randint(0, size[1] - 8)
+            h, w = rng.randint(4, size[0] // 2), rng.randint(4, size[1] // 2)
+            labels[k, y:y + h, x:x + w] = rng.randint(n_classes)
+    images = colors[labels].transpose(0, 3, 1, 2) + 0.3 * rng.randn(n, 3, *size).astype(np.float32)
+    return torch.from_numpy(images), torch.from_numpy(labels)
+
+
+def peak_memory_bytes(fn):
+    """Peak of the tensor memory allocated while running ``fn()``, besides the tensors alive
+    before it (CUDA allocator statistics, or the profiler memory timeline on CPU)"""
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() - base
+    from torch.profiler import profile, ProfilerActivity
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True, record_shapes=True, with_stack=True) as prof:
+        fn()
+    live = peak = 0
+    for _, action, _, size in prof._memory_profile().timeline:
+        if action.name == 'CREATE':
+            live += size
+        elif action.name == 'DESTROY':
+            live -= size
+        peak = max(peak, live)
+    return peak
+
+
+def train_synthetic(model, train_data, val_data, n_classes, opts, device, lr=0.05):
+    """Trains ``model`` for ``opts.train_iters`` on synthetic_segmentation data, returns the
+    median step time (s) and the val mIoU"""
+    (train_images, train_labels), (val_images, val_labels) = train_data, val_data
+    optimizer = torch.optim.SGD(model.parameters(), lr=lr, momentum=0.9)
+    criterion = nn.CrossEntropyLoss(ignore_index=255)
+    model.train()
+    step_times = []
+    for _ in range(opts.train_iters):
+        idx = torch.randint(0, len(train_images), (max(opts.batch_size, 2),))
+        images, labels = train_images[idx].to(device), train_labels[idx].to(device)
+        start = time.perf_counter()
+        optimizer.zero_grad()
+        criterion(model(images), labels).backward()
+        optimizer.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        step_times.append(time.perf_counter() - start)
+    model.eval()
+    metrics = StreamSegMetrics(n_classes)
+    with torch.no_grad():
+        for k in range(0, len(val_images), 4):
+            preds = model(val_images[k:k + 4].to(device)).max(1)[1]
+            metrics.update(val_labels[k:k + 4].numpy(), preds.cpu().numpy())
+    return np.median(step_times), metrics.get_results()['Mean IoU']
+
+
+def bench_decoder_res(opts, device):
+    """Training at full vs decoder resolution: step time, memory kept for backward, mIoU"""
+    n_classes = 6
+    size = (opts.crop_size, opts.crop_size)
+    train_images, train_labels = synthetic_segmentation(64, size, n_classes, seed=0)
+    val_images, val_labels = synthetic_segmentation(16, size, n_classes, seed=1)
+    rows = []
+    for name, decoder_res, label_mode in [('full resolution', False, None),
+                                          ('decoder res, mode labels', True, 'mode'),
+                                          ('decoder res, nearest labels', True, 'nearest')]:
+        torch.manual_seed(0)
+        model = network.modeling.deeplabv3plus_mobilenet(num_classes=n_classes, output_stride=16,
+                                                         pretrained_backbone=False).to(device)
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.05, momentum=0.9)
+        criterion = nn.CrossEntropyLoss(ignore_index=255)
+
+        def loss_fn(images, labels):
+            if decoder_res:
+                outputs = model(images, upsample=False)
+                labels = utils.downsample_labels(labels, outputs.shape[-2:], n_classes, mode=label_mode)
+            else:
+                outputs = model(images)
+            return criterion(outputs, labels)
+
+        model.train()
+        step_times = []
+        for it in range(opts.train_iters):
+            idx = torch.randint(0, len(train_images), (max(opts.batch_size, 2),))
+            images, labels = train_images[idx].to(device), train_labels[idx].to(device)
+            start = time.perf_counter()
+            optimizer.zero_grad()
+            if it == 0:
+                loss, n_bytes = saved_tensor_bytes(lambda: loss_fn(images, labels), inputs=(images,))
+            else:
+                loss = loss_fn(images, labels)
+            loss.backward()
+            optimizer.step()
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            step_times.append(time.perf_counter() - start)
+
+        model.eval()
+        metrics = StreamSegMetrics(n_classes)
+        with torch.no_grad():
+            for k in range(0, len(val_images), 4):
+                preds = model(val_images[k:k + 4].to(device)).max(1)[1]
+                metrics.update(val_labels[k:k + 4].numpy(), preds.cpu().numpy())
+        rows.append([name, '%.1f' % (np.median(step_times) * 1000), '%.1f' % (n_bytes / 2 ** 20),
+                     '%.3f' % metrics.get_results()['Mean IoU']])
+    print_table(['training', 'step ms', 'MiB saved for bwd', 'val mIoU (full res)'], rows)
+
+
+def bench_fast_val(opts, device):
+    """Fast validation on stratified subsets: bootstrap CI width and coverage of the full-set mIoU"""
+    n_images, n_classes, size = 500, 19, (32, 64)
+    rng = np.random.RandomState(0)
+    # images contain classes with decreasing frequency, predictions have a per-image error rate
+    presence = rng.rand(n_images, n_classes) < np.linspace(0.95, 0.05, n_classes)
+    labels = np.empty((n_images,) + size, dtype=np.int64)
+    preds = np.empty_like(labels)
+    for k in range(n_images):
+        classes = np.flatnonzero(presence[k]) if presence[k].any() else np.array([0])
+        labels[k] = rng.choice(classes, size)
+        noise = rng.rand(*size) < rng.beta(2, 8)
+        preds[k] = np.where(noise, rng.randint(n_classes, size=size), labels[k])
+    full = StreamSegMetrics(n_classes)
+    full.update(labels, preds)
+    full_miou = full.get_results()['Mean IoU']
+    stats = LabelStats([str(k) for k in range(n_images)],
+                       np.stack([np.bincount(l.ravel(), minlength=n_classes) for l in labels]).astype(np.uint32),
+                       np.zeros((n_images, n_classes, 4), dtype=np.uint16))
+
+    rows = []
+    for n in [25, 50, 100, 200]:
+        covered, widths, errors = 0, [], []
+        for seed in range(20):
+            ids = stats.stratified_subset(n, seed=seed)
+            metrics = ImageSegMetrics(n_classes)
+            metrics.update(labels[ids], preds[ids])
+            low, high = metrics.bootstrap(n_boot=200, seed=seed)
+            covered += low <= full_miou <= high
+            widths.append(high - low)
+            errors.append(abs(metrics.get_results()['Mean IoU'] - full_miou))
+        rows.append([n, '%.0f%%' % (100. * n / n_images), '%.4f' % np.mean(errors),
+                     '%.4f' % np.mean(widths), '%d/20' % covered])
+    print("full val mIoU: %.4f" % full_miou)
+    print_table(['subset', 'val cost', 'mean |error|', 'mean 95% CI width', 'CI covers full mIoU'], rows)
+
+
+class VisdomStandIn(BaseHTTPRequestHandler):
+    """Minimal Visdom server: accepts every request after ``delay`` seconds, counts the points"""
+    protocol_version = 'HTTP/1.1'
+    delay = 0.
+    points = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.delay)
+        if self.path == '/update':
+            type(self).points += len(json.loads(body).get('data', [{}])[0].get('x', []))
+        reply = b'"win"'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+def bench_logging(opts, device):
+    """Training-loop overhead of per-iteration metrics logging, synchronous Visualizer vs MetricsLogger"""
+    from utils.visualizer import Visualizer
+    handler = type('Handler', (VisdomStandIn,), {'delay': 0.02, 'points': 0})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    with socket.socket() as s:  # a port nobody listens on
+        s.bind(('127.0.0.1', 0))
+        down_port = s.getsockname()[1]
+    a = torch.randn(384, 384)
+    n_iters = opts.train_iters
+    tmp = tempfile.mkdtemp()
+
+    def train(log_fn):
+        start = time.perf_counter()
+        for it in range(n_iters):
+            loss = (a @ a).mean().item()  # ~1 ms of work per iteration
+            log_fn(it, loss)
+        return time.perf_counter() - start
+
+    rows = []
+    base = train(lambda it, loss: None)
+    rows.append(['no logging', '%.1f' % (base * 1000 / n_iters), '-', '-'])
+
+    vis = Visualizer(port=port, raise_exceptions=True, use_incoming_socket=False)
+    handler.points = 0
+    total = train(lambda it, loss: vis.vis_scalar('Loss', it, loss))
+    rows.append(['Visualizer, synchronous', '%.1f' % (total * 1000 / n_iters),
+                 '%.1f' % (total - base), handler.points])
+
+    for name, port_, sinks in [('MetricsLogger, visdom', port, []),
+                               ('MetricsLogger, visdom down', down_port, []),
+                               ('MetricsLogger, visdom + jsonl + tensorboard', port,
+                                [utils.JSONLSink(os.path.join(tmp, 'metrics.jsonl'))])]:
+        if 'tensorboard' in name:
+            try:
+                sinks.append(utils.TensorBoardSink(tmp))
+            except ImportError:
+                continue
+        handler.points = 0
+        logger = utils.MetricsLogger([utils.VisdomSink(port=port_)] + sinks, flush_interval=0.5)
+        total = train(lambda it, loss: logger.scalar('Loss', it, loss))
+        logger.close()
+        rows.append([name, '%.1f' % (total * 1000 / n_iters), '%.1f' % (total - base), handler.points])
+    server.shutdown()
+    shutil.rmtree(tmp)
+    print("visdom stand-in answers each request after %.0f ms, %d iterations" % (handler.delay * 1000, n_iters))
+    print_table(['logging', 'ms / iteration', 'overhead s', 'points received'], rows)
+
+
+def bench_compile(opts, device):
+    """torch.compile with shape buckets vs eager on variable image sizes, for each network.modeling model"""
+    models = opts.models or sorted(name for name in network.modeling.__dict__ if name.startswith('deeplabv3'))
+    rng = np.random.RandomState(0)
+    sizes = [tuple(int(v) for v in rng.randint(opts.crop_size // 2, opts.crop_size + 1, 2)) for _ in range(12)]
+    cache_dir = tempfile.mkdtemp()
+    rows = []
+    for name in models:
+        torch.manual_seed(0)
+        model = network.modeling.__dict__[name](num_classes=21, pretrained_backbone=False).to(device).eval()
+        images = [torch.randn(opts.batch_size, 3, h, w, device=device) for h, w in sizes]
+
+        def run_all():
+            with torch.no_grad():
+                return [model.predict_labels(x) for x in images]
+
+        run_all()
+        eager_ms = timeit(run_all, n_warmup=0, n_iters=max(opts.n_iters // 5, 1)) / len(images)
+        eager_labels = run_all()
+
+        buckets = network.ShapeBuckets.from_sizes(sizes, max_buckets=4, batch_size=opts.batch_size)
+        compile_times = []
+        for _ in range(2):  # cold cache, then recompiling from the persistent cache
+            torch._dynamo.reset()
+            network.uncompile_model(model)
+            network.compile_model(model, buckets, backend=opts.compile_backend, cache_dir=cache_dir)
+            timings = network.warmup_compiled(model, device)
+            compile_times.append(sum(t for _, _, t in timings))
+        compiled_ms = timeit(run_all, n_warmup=1, n_iters=max(opts.n_iters // 5, 1)) / len(images)
+        agreement = np.mean([(a == b).float().mean().item() for a, b in zip(eager_labels, run_all())])
+        rows.append([name, '%.1f' % eager_ms, '%.1f' % compile_times[0], '%.1f' % compile_times[1],
+                     '%.1f' % compiled_ms, '%.2fx' % (eager_ms / compiled_ms), '%.2f%%' % (100 * agreement)])
+        network.uncompile_model(model)
+    shutil.rmtree(cache_dir)
+    print("%d image sizes between %d and %d, %s, padding %.1f%%" % (
+        len(sizes), opts.crop_size // 2, opts.crop_size, buckets, 100 * buckets.padding_ratio(sizes)))
+    print_table(['model', 'eager ms/img', 'compile s (cold)', 'compile s (cached)', 'compiled ms/img',
+                 'speedup', 'same labels'], rows)
+
+
+def bench_branches(opts, device):
+    """Concurrent branches of HRNet stages, ASPP and multi-branch stems, per module and per model"""
+    from network.backbone.hrnetv2 import StageModule
+    from network.backbone.resnet import StemBlock2, ParallelStem
+    n, s = opts.batch_size, opts.crop_size
+    threads = torch.get_num_threads()
+    cases = [
+        ('StageModule 48, 4 branches', StageModule(4, 4, 48),
+         [[torch.randn(n, 48 * 2 ** i, s // 2 ** (i + 2), s // 2 ** (i + 2)) for i in range(4)]]),
+        ('StageModule 32, 3 branches', StageModule(3, 3, 32),
+         [[torch.randn(n, 32 * 2 ** i, s // 2 ** (i + 2), s // 2 ** (i + 2)) for i in range(3)]]),
+        ('ASPP 2048, OS16', ASPP(2048, [6, 12, 18]), [torch.randn(n, 2048, s // 16, s // 16)]),
+        ('StemBlock2', StemBlock2(64, [32, 64, 64, 32]), [torch.randn(n, 64, s, s)]),
+        ('ParallelStem', ParallelStem(), [torch.randn(n, 3, s, s)]),
+    ]
+    hrnet_size = s // 32 * 32
+    for name in opts.models or ['deeplabv3plus_hrnetv2_32', 'deeplabv3plus_hrnetv2_48']:
+        cases.append((name, network.modeling.__dict__[name](num_classes=21, pretrained_backbone=False),
+                      [torch.randn(n, 3, hrnet_size, hrnet_size)]))
+
+    rows = []
+    for name, module, inputs in cases:
+        module = module.to(device).eval()
+        inputs = [[t.to(device) for t in x] if isinstance(x, list) else x.to(device) for x in inputs]
+        base, ref = None, None
+        has_fusion = 'StageModule' in name or 'hrnet' in name
+        for workers, group_fusion in [(1, False), (1, True), (2, True), (4, True)]:
+            if group_fusion and workers == 1 and not has_fusion:
+                continue
+            network.convert_to_parallel_branches(module, num_workers=workers, group_fusion=group_fusion)
+            torch.set_num_threads(max(threads // workers, 1))
+            with torch.no_grad():
+                out = module(*inputs)
+                out = torch.cat([o.flatten() for o in out]) if isinstance(out, list) else out
+                ref = out if ref is None else ref
+                ms = timeit(lambda: module(*inputs), opts.n_warmup, opts.n_iters)
+            base = base or ms
+            rows.append([name, workers, ('yes' if group_fusion else 'no') if has_fusion else '-',
+                         max(threads // workers, 1),
+                         '%.2f' % ms, '%.2fx' % (base / ms), '%.1e' % (out - ref).abs().max().item()])
+        torch.set_num_threads(threads)
+    print_table(['module', 'workers', 'grouped fusion', 'threads/worker', 'ms', 'speedup', 'max|err|'], rows)
+
+
+def bench_hrnet_head(opts, device):
+    """HRNetV2 ASPP on the upsampled concat vs StreamASPP (exact and reduced fusion): memory, time, mIoU"""
+    models = opts.models or ['deeplabv3plus_hrnetv2_48', 'deeplabv3plus_hrnetv2_32']
+    size = opts.crop_size // 32 * 32
+    variants = [('concat', {}), ('stream (exact)', {'stream_aspp': True}),
+                ('reduced 256', {'fusion_channels': 256}), ('reduced 128', {'fusion_channels': 128})]
+    rows = []
+    for name in models:
+        x = torch.randn(max(opts.batch_size, 2), 3, size, size, device=device)  # BatchNorm of the pooling branch
+        ref = None
+        for variant, kwargs in variants:
+            torch.manual_seed(0)
+            model = network.modeling.__dict__[name](num_classes=21, pretrained_backbone=False, **kwargs).to(device)
+            concat = model.backbone.hrnet_concat
+            model.backbone.hrnet_concat = False
+            with torch.no_grad():
+                features = model.backbone.eval()(x)
+            streams = [f.requires_grad_() for f in features['out']]
+            low_level = features['low_level'].requires_grad_()
+
+            def aspp():  # from the stage4 streams on, including the concat
+                if concat:
+                    return model.classifier.aspp(
+                        torch.cat([StreamASPP._upsample(f, streams[0].shape[-2:]) for f in streams], 1))
+                return model.classifier.aspp(streams)
+
+            def head():
+                return model.classifier.forward_low(low_level, aspp())
+
+            model.classifier.eval()
+            with torch.no_grad():
+                out = head()
+                ref = out if ref is None else ref
+                aspp_peak = peak_memory_bytes(aspp)
+                head_peak = peak_memory_bytes(head)
+                ms = timeit(head, opts.n_warmup, opts.n_iters)
+            model.classifier.train()
+            _, train_bytes = saved_tensor_bytes(aspp, inputs=streams)
+            err = '%.1e' % (out - ref).abs().max().item() if 'reduced' not in variant else '-'
+            rows.append([name, variant, '%.1f' % (aspp_peak / 2 ** 20), '%.1f' % (head_peak / 2 ** 20),
+                         '%.1f' % (train_bytes / 2 ** 20), '%.1f' % ms, err])
+            del model, features, streams, low_level
+    print("input %dx%d, batch %d, from the stage4 streams on (ASPP includes the concat)" % (size, size, len(x)))
+    print_table(['model', 'ASPP input', 'ASPP peak MiB', 'head peak MiB', 'ASPP MiB saved for bwd', 'head ms',
+                 'max|err|'], rows)
+
+    # accuracy of the reduced fusion, trained from scratch on synthetic data
+    n_classes, train_size = 6, (64, 64)
+    train_data = synthetic_segmentation(64, train_size, n_classes, seed=0)
+    val_data = synthetic_segmentation(16, train_size, n_classes, seed=1)
+    rows = []
+    for variant, kwargs in variants[:1] + variants[2:]:
+        torch.manual_seed(0)
+        model = network.modeling.deeplabv3plus_hrnetv2_32(num_classes=n_classes, pretrained_backbone=False,
+                                                          **kwargs).to(device)
+        step, miou = train_synthetic(model, train_data, val_data, n_classes, opts, device)
+        rows.append([variant, '%.1f' % (step * 1000), '%.3f' % miou])
+    print("deeplabv3plus_hrnetv2_32 trained %d iterations on synthetic %dx%d images" % (opts.train_iters, *train_size))
+    print_table(['ASPP input', 'step ms', 'val mIoU'], rows)
+
+
+def bench_mobilenet(opts, device):
+    """Latency of the MobileNetV2 width family at a few resolutions, with the inverted residual
+    blocks padding a copy of their input or padding in the depthwise conv, and the mIoU of
+    each width trained from scratch on synthetic data"""
+    from network.backbone.mobilenetv2 import set_blocks_padding
+    names = opts.models or ['deeplabv3plus_mobilenet_x0_35', 'deeplabv3plus_mobilenet_x0_5',
+                            'deeplabv3plus_mobilenet_x0_75', 'deeplabv3plus_mobilenet',
+                            'deeplabv3plus_mobilenet_x1_4']
+    sizes = sorted({opts.crop_size // 2, opts.crop_size * 3 // 4, opts.crop_size})
+    rows = []
+    for name in names:
+        model = network.modeling.__dict__[name](num_classes=21, output_stride=16,
+                                                pretrained_backbone=False).to(device).eval()
+        blocks = list(model.backbone.low_level_features[1:]) + list(model.backbone.high_level_features)
+        params = sum(p.numel() for p in model.parameters()) / 1e6
+        for size in sizes:
+            x = torch.randn(opts.batch_size, 3, size, size, device=device)
+            times = [[], []]
+            with torch.no_grad():
+                for i in range(opts.n_warmup + opts.n_iters):  # alternate the two, against drifting clocks
+                    for pad_in_conv in (False, True):
+                        set_blocks_padding(blocks, pad_in_conv)
+                        ms = timeit(lambda: model(x), 0, 1)
+                        if i >= opts.n_warmup:
+                            times[pad_in_conv].append(ms)
+            ms = [float(np.median(t)) for t in times]
+            rows.append([name, '%.2f' % params, size, '%.1f' % ms[0], '%.1f' % ms[1], '%.2fx' % (ms[0] / ms[1])])
+        del model
+    print("output stride 16, batch %d" % opts.batch_size)
+    print_table(['model', 'params (M)', 'input', 'padded copy ms', 'pad in conv ms', 'speedup'], rows)
+
+    n_classes, train_size = 6, (96, 96)
+    train_data = synthetic_segmentation(64, train_size, n_classes, seed=0)
+    val_data = synthetic_segmentation(16, train_size, n_classes, seed=1)
+    rows = []
+    for name in names:
+        torch.manual_seed(0)
+        model = network.modeling.__dict__[name](num_classes=n_classes, output_stride=16, pretrained_backbone=False,
+                                                pad_in_conv=True).to(device)
+        step, miou = train_synthetic(model, train_data, val_data, n_classes, opts, device)
+        rows.append([name, '%.1f' % (step * 1000), '%.3f' % miou])
+    print("trained %d iterations from scratch on synthetic %dx%d images" % (opts.train_iters, *train_size))
+    print_table(['model', 'step ms', 'val mIoU'], rows)
+
+def bench_prune(opts, device):
+    """Structured channel pruning: params, MACs, latency and mIoU after a short fine-tuning,
+    for BN-gamma and Taylor ranking at a few ratios, on a model trained on synthetic data"""
+    import copy
+    names = opts.models or ['deeplabv3plus_resnet50']
+    n_classes, train_size = 6, (96, 96)
+    train_data = synthetic_segmentation(64, train_size, n_classes, seed=0)
+    val_data = synthetic_segmentation(16, train_size, n_classes, seed=1)
+    x = torch.randn(opts.batch_size, 3, opts.crop_size, opts.crop_size, device=device)
+    rows = []
+    for name in names:
+        kwargs = {'fl_maxpool': True, 'fl_stemstride': True} if 'resnet' in name else {}
+        torch.manual_seed(0)
+        base = network.modeling.__dict__[name](num_classes=n_classes, output_stride=16, pretrained_backbone=False,
+                                               **kwargs).to(device)
+        train_synthetic(base, train_data, val_data, n_classes, opts, device)
+        for importance, ratio in [(None, 0.), ('bn', 0.25), ('taylor', 0.25), ('bn', 0.5), ('taylor', 0.5)]:
+            model = copy.deepcopy(base)
+            if importance == 'taylor':
+                groups, scores = network.channel_groups(model, residual=True), {}
+                model.train()
+                images, labels = train_data
+                for k in range(0, len(images), 8):
+                    model.zero_grad()
+                    F.cross_entropy(model(images[k:k + 8].to(device)), labels[k:k + 8].to(device),
+                                    ignore_index=255).backward()
+                    network.accumulate_taylor(groups, scores)
+                model.zero_grad()
+            if importance is not None:
+                network.prune_channels(model, ratio=ratio, importance=importance,
+                                       scores=scores if importance == 'taylor' else None, residual=True)
+            model.eval()
+            params = sum(p.numel() for p in model.parameters()) / 1e6
+            gmacs = network.conv_macs(model, x) / 1e9
+            with torch.no_grad():
+                ms = timeit(lambda: model(x), opts.n_warmup, opts.n_iters)
+            torch.manual_seed(0)
+            _, miou = train_synthetic(model, train_data, val_data, n_classes, opts, device, lr=0.01)
+            rows.append([name, importance or '-', '%d%%' % (ratio * 100), '%.2f' % params, '%.2f' % gmacs,
+                         '%.1f' % ms, '%.3f' % miou])
+        del base
+    print("residual channels pruned too, %dx%d input, batch %d, fine-tuned %d iterations on synthetic %dx%d images"
+          % (opts.crop_size, opts.crop_size, opts.batch_size, opts.train_iters, *train_size))
+    print_table(['model', 'importance', 'pruned', 'params (M)', 'GMACs', 'ms', 'val mIoU'], rows)
+
+
+def bench_cost_model(opts, device):
+    """Latency and memory predicted by the cost model (network/cost.py) against real runs.
+    The latency table is calibrated on the first model. The 'fit only' column predicts each
+    model from the ops of the others, with the ops it alone has predicted by the fit (n/a for
+    a single model)"""
+    from network.cost import LatencyTable, trace_model
+    resnet = {'fl_maxpool': True, 'fl_stemstride': True}
+    if opts.models:
+        configs = [(name, resnet if 'resnet' in name else {}) for name in opts.models]
+    else:
+        configs = [('deeplabv3plus_resnet50', resnet), ('deeplabv3plus_resnet50', {'fl_maxpool': True}),
+                   ('deeplabv3plus_resnet50', dict(resnet, fl_transpose=True)), ('deeplabv3_resnet50', resnet),
+                   ('deeplabv3plus_resnet50', dict(resnet, fl_lfe=True)), ('deeplabv3plus_mobilenet', {}),
+                   ('deeplabv3plus_hrnetv2_32', {})]
+    shape = (opts.batch_size, 3, opts.crop_size, opts.crop_size)
+    x = torch.randn(shape, device=device)
+    x_train = torch.randn((max(opts.batch_size, 2),) + shape[1:], device=device)
+    models, traces = [], []
+    table = LatencyTable(device=device.type)
+    start = time.perf_counter()
+    for name, kwargs in configs:
+        model = network.modeling.__dict__[name](num_classes=21, output_stride=16, pretrained_backbone=False,
+                                                **kwargs).to(device).eval()
+        models.append(model)
+        traces.append(trace_model(model, shape))
+        table.measure(traces[-1].ops)
+    ratios = table.calibrate(models[:1], shape)
+    print("latency table: %d ops measured in %.1fs, calibration scale %.3f" % (
+        len(table.entries), time.perf_counter() - start, ratios[0]))
+
+    def err(predicted, measured):
+        return '%+.1f%%' % (100 * (predicted - measured) / measured)
+
+    rows = []
+    for (name, kwargs), model, trace in zip(configs, models, traces):
+        with torch.no_grad():
+            ms = timeit(lambda: model(x), opts.n_warmup, opts.n_iters)
+            peak = peak_memory_bytes(lambda: model(x))
+        model.train()
+        _, saved = saved_tensor_bytes(lambda: model(x_train), (x_train,))
+        model.eval()
+        ms_pred = table.predict(trace, measure=False)
+        fit_only = ['n/a', 'n/a']
+        if len(traces) > 1:
+            others = set(op.key for t in traces if t is not trace for op in t.ops)
+            loo = LatencyTable(device=device.type)
+            loo.entries = {k: v for k, v in table.entries.items() if k in others}
+            loo.scale = table.scale
+            ms_loo = loo.predict(trace, measure=False)
+            fit_only = ['%.1f (%d fit)' % (ms_loo, sum(op.key not in loo.entries for op in trace.ops)),
+                        err(ms_loo, ms)]
+        peak_pred = table.peak_bytes(trace)
+        saved_pred = trace_model(model, x_train.shape, train=True).saved_bytes
+        flags = '+'.join(k[3:] for k, v in sorted(kwargs.items()) if v)
+        rows.append(['%s %s' % (name, flags), len(trace.ops), '%.1f' % ms, '%.1f' % ms_pred, err(ms_pred, ms),
+                     *fit_only,
+                     '%.1f' % (peak / 2 ** 20), '%.1f' % (peak_pred / 2 ** 20), err(peak_pred, peak),
+                     '%.0f' % (saved / 2 ** 20), '%.0f' % (saved_pred / 2 ** 20), err(saved_pred, saved)])
+    print("output stride 16, %dx%d input, batch %d (training batch %d)" % (
+        opts.crop_size, opts.crop_size, opts.batch_size, x_train.shape[0]))
+    print_table(['model', 'ops', 'ms', 'predicted', 'err', 'fit only', 'err', 'peak MiB', 'predicted', 'err',
+                 'saved MiB', 'predicted', 'err'], rows)
+
+
+def bench_space_to_batch(opts, device):
+    """Dilated convs run in space-to-batch layout (network/space_to_batch.py) against the dilated
+    convs, per backbone at OS8 and OS16: every run in phases ('phase'), and the autotuned choice
+    per run ('tuned', the first pass of a shape times both layouts)"""
+    from network.space_to_batch import convert_to_space_to_batch, revert_space_to_batch
+    names = opts.models or ['deeplabv3plus_resnet50', 'deeplabv3plus_resnet101', 'deeplabv3plus_mobilenet']
+    x = torch.randn(opts.batch_size, 3, opts.crop_size, opts.crop_size, device=device)
+    rows = []
+    for name in names:
+        kwargs = {'fl_maxpool': True, 'fl_stemstride': True} if 'resnet' in name else {}
+        for output_stride in [8, 16]:
+            model = network.modeling.__dict__[name](num_classes=21, output_stride=output_stride,
+                                                    pretrained_backbone=False, **kwargs).to(device).eval()
+            with torch.no_grad():
+                ref = model(x)
+                ms = timeit(lambda: model(x), opts.n_warmup, opts.n_iters)
+                convert_to_space_to_batch(model, autotune=False)
+                err = (model(x) - ref).abs().max().item() / ref.abs().max().item()
+                ms_phase = timeit(lambda: model(x), opts.n_warmup, opts.n_iters)
+                revert_space_to_batch(model)
+                runs = convert_to_space_to_batch(model)
+                start = time.perf_counter()
+                model(x)
+                tuning = time.perf_counter() - start
+                ms_tuned = timeit(lambda: model(x), opts.n_warmup, opts.n_iters)
+                err = max(err, (model(x) - ref).abs().max().item() / ref.abs().max().item())
+            modes = [r.mode for r in model.space_to_batch_runs]
+            rows.append([name, 'OS%d' % output_stride, ' '.join('d%dx%d' % r for r in runs),
+                         '%d/%d/%d' % tuple(modes.count(m) for m in ('phase', 'center', 'dilated')),
+                         '%.1f' % ms, '%.1f' % ms_phase, '%.2fx' % (ms / ms_phase),
+                         '%.1f' % ms_tuned, '%.2fx' % (ms / ms_tuned), '%.1f' % tuning, '%.1e' % err])
+    print("%dx%d input, batch %d" % (opts.crop_size, opts.crop_size, opts.batch_size))
+    print_table(['model', 'OS', 'runs (dilation x blocks)', 'tuned phase/center/dilated', 'dilated ms',
+                 'phase ms', 'speedup', 'tuned ms', 'speedup', 'tuning s', 'rel err'], rows)
+
+
+def bench_upsampler(opts, device):
+    """Decoder upsamplers of DeepLabV3+ (network/upsample.py) against Interpolate ('bilinear')
+    and the transposed convs: decoder latency and inference peak memory, memory saved for
+    backward by the whole model, and mIoU after training on synthetic data"""
+    names = opts.models or ['deeplabv3plus_resnet50']
+    n_classes, train_size = 6, (96, 96)
+    train_data = synthetic_segmentation(64, train_size, n_classes, seed=0)
+    val_data = synthetic_segmentation(16, train_size, n_classes, seed=1)
+    x = torch.randn(opts.batch_size, 3, opts.crop_size, opts.crop_size, device=device)
+    x_train = torch.randn(max(opts.batch_size, 2), 3, opts.crop_size, opts.crop_size, device=device)
+    resnet = {'fl_maxpool': True, 'fl_stemstride': True}
+    rows = []
+    for name in names:
+        kwargs = resnet if 'resnet' in name else {}
+        for upsampler in network.UPSAMPLERS:
+            torch.manual_seed(0)
+            model = network.modeling.__dict__[name](num_classes=n_classes, output_stride=16, pretrained_backbone=False,
+                                                    upsampler=upsampler, **kwargs).to(device).eval()
+            head = model.classifier
+            with torch.no_grad():
+                features = model.backbone(x)
+                ms = timeit(lambda: head(features), opts.n_warmup, opts.n_iters)
+                peak = peak_memory_bytes(lambda: head(features))
+            model.train()
+            _, saved = saved_tensor_bytes(lambda: model(x_train), (x_train,))
+            _, miou = train_synthetic(model, train_data, val_data, n_classes, opts, device)
+            rows.append([name, upsampler, '%.2f' % (sum(p.numel() for p in head.parameters()) / 1e6), '%.1f' % ms,
+                         '%.1f' % (peak / 2 ** 20), '%.0f' % (saved / 2 ** 20), '%.3f' % miou])
+            del model, features
+    print("output stride 16, decoder on %dx%d inputs, batch %d (training batch %d), trained %d iterations on "
+          "synthetic %dx%d images" % (opts.crop_size, opts.crop_size, opts.batch_size, x_train.shape[0],
+                                      opts.train_iters, *train_size))
+    print_table(['model', 'upsampler', 'head params (M)', 'decoder ms', 'decoder peak MiB', 'saved MiB',
+                 'val mIoU'], rows)
+
+
+BENCHMARKS = {
+    'aspp': bench_aspp,
+    'labels': bench_labels,
+    'output_stride': bench_output_stride,
+    'video': bench_video,
+    'formats': bench_formats,
+    'render': bench_render,
+    'manifest': bench_manifest,
+    'download': bench_download,
+    'label_stats': bench_label_stats,
+    'loss': bench_loss,
+    'decoder_res': bench_decoder_res,
+    'fast_val': bench_fast_val,
+    'logging': bench_logging,
+    'compile': bench_compile,
+    'branches': bench_branches,
+    'hrnet_head': bench_hrnet_head,
+    'mobilenet': bench_mobilenet,
+    'prune': bench_prune,
+    'cost_model': bench_cost_model,
+    'space_to_batch': bench_space_to_batch,
+    'upsampler': bench_upsampler,
+}
+
+
+def main():
+    opts = get_argparser().parse_args()
+    if opts.threads is not None:
+        torch.set_num_threads(opts.threads)
+    if opts.gpu_id is not None and torch.cuda.is_available():
+        device = torch.device('cuda:%s' % opts.gpu_id)
+    else:
+        device = torch.device('cpu')
+    print("Platform: %s, torch %s, device: %s, threads: %d" %
+          (platform.platform(), torch.__version__, device, torch.get_num_threads()))
+    BENCHMARKS[opts.bench](opts, device)
+
+
+if __name__ == '__main__':
+    main()
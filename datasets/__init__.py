@@ -1,2 +1,5 @@
 from .voc import VOCSegmentation
-from .cityscapes import Cityscapes
\ No newline at end of file
+from .cityscapes import Cityscapes
+from .manifest import load_manifest, verify_manifest
+from .label_stats import LabelStats, ClassAwareSampler
+from .decoded_cache import DecodedCache
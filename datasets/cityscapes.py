@@ -7,6 +7,9 @@ import torch.utils.data as data
 from PIL import Image
 import numpy as np
 
+from .manifest import load_manifest
+from .decoded_cache import DecodedCache
+
 
 class Cityscapes(data.Dataset):
     """Cityscapes <http://www.cityscapes-dataset.com/> Dataset.
@@ -17,6 +20,11 @@ class Cityscapes(data.Dataset):
         - **mode** (string, optional): The quality mode to use, 'gtFine' or 'gtCoarse' or 'color'. Can also be a list to output a tuple with all specified target types.
         - **transform** (callable, optional): A function/transform that takes in a PIL image and returns a transformed version. E.g, ``transforms.RandomCrop``
         - **target_transform** (callable, optional): A function/transform that takes in the target and transforms it.
+        - **use_manifest** (bool, optional): Load the file list from a cached manifest (see ``datasets.manifest``)
+          instead of listing every city directory. The manifest is rebuilt when a directory changed.
+        - **manifest_dir** (string, optional): Where manifests are stored, ``root/.manifests`` by default.
+        - **rebuild_manifest** (bool, optional): Force rebuilding the manifest.
+        - **decoded_cache** (string, optional): Directory of a ``DecodedCache`` shared by concurrent runs.
     """
 
     # Based on https://github.com/mcordts/cityscapesScripts
@@ -70,7 +78,8 @@ class Cityscapes(data.Dataset):
     #train_id_to_color = np.array(train_id_to_color)
     #id_to_train_id = np.array([c.category_id for c in classes], dtype='uint8') - 1
 
-    def __init__(self, root, split='train', mode='fine', target_type='semantic', transform=None):
+    def __init__(self, root, split='train', mode='fine', target_type='semantic', transform=None,
+                 use_manifest=True, manifest_dir=None, rebuild_manifest=False, decoded_cache=None):
         self.root = os.path.expanduser(root)
         self.mode = 'gtFine'
         self.target_type = target_type
@@ -78,10 +87,12 @@ class Cityscapes(data.Dataset):
 
         self.targets_dir = os.path.join(self.root, self.mode, split)
         self.transform = transform
+        self.decoded_cache = DecodedCache(decoded_cache) if decoded_cache is not None else None
 
         self.split = split
         self.images = []
         self.targets = []
+        self.image_sizes = None
 
         if split not in ['train', 'test', 'val']:
             raise ValueError('Invalid split for mode! Please use split="train", split="test"'
@@ -90,16 +101,32 @@ class Cityscapes(data.Dataset):
         if not os.path.isdir(self.images_dir) or not os.path.isdir(self.targets_dir):
             raise RuntimeError('Dataset not found or incomplete. Please make sure all required folders for the'
                                ' specified "split" and "mode" are inside the "root" directory')
-        
-        for city in os.listdir(self.images_dir):
+
+        if use_manifest:
+            cities = sorted(os.listdir(self.images_dir))
+            signature_paths = [self.images_dir, self.targets_dir]
+            for city in cities:
+                signature_paths += [os.path.join(self.images_dir, city), os.path.join(self.targets_dir, city)]
+            manifest_dir = manifest_dir or os.path.join(self.root, '.manifests')
+            manifest = load_manifest(os.path.join(manifest_dir, 'cityscapes_%s_%s.json' % (split, target_type)),
+                                     signature_paths, self._list_files, rebuild=rebuild_manifest)
+            self.images, self.targets = manifest['images'], manifest['targets']
+            self.image_sizes = [tuple(s) for s in manifest['sizes']]
+        else:
+            self.images, self.targets = self._list_files()
+
+    def _list_files(self):
+        images, targets = [], []
+        for city in sorted(os.listdir(self.images_dir)):
             img_dir = os.path.join(self.images_dir, city)
             target_dir = os.path.join(self.targets_dir, city)
 
-            for file_name in os.listdir(img_dir):
-                self.images.append(os.path.join(img_dir, file_name))
+            for file_name in sorted(os.listdir(img_dir)):
+                images.append(os.path.join(img_dir, file_name))
                 target_name = '{}_{}'.format(file_name.split('_leftImg8bit')[0],
                                              self._get_target_suffix(self.mode, self.target_type))
-                self.targets.append(os.path.join(target_dir, target_name))
+                targets.append(os.path.join(target_dir, target_name))
+        return images, targets
 
     @classmethod
     def encode_target(cls, target):
@@ -119,8 +146,12 @@ class Cityscapes(data.Dataset):
             tuple: (image, target) where target is a tuple of all target types if target_type is a list with more
             than one item. Otherwise target is a json object if target_type="polygon", else the image segmentation.
         """
-        image = Image.open(self.images[index]).convert('RGB')
-        target = Image.open(self.targets[index])
+        if self.decoded_cache is not None:
+            image = self.decoded_cache.open(self.images[index], 'RGB')
+            target = self.decoded_cache.open(self.targets[index])
+        else:
+            image = Image.open(self.images[index]).convert('RGB')
+            target = Image.open(self.targets[index])
         if self.transform:
             image, target = self.transform(image, target)
         target = self.encode_target(target)
@@ -0,0 +1,52 @@
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+
+class DecodedCache(object):
+    """ Decoded images stored as ``.npy`` files that any number of processes can share
+
+    The first reader of an image decodes it and writes the pixel array with an atomic
+    rename. The others memory-map it, so concurrent training runs share one decode and
+    one copy in the page cache instead of each decoding JPEG/PNG files. Keys hash the
+    path, size and mtime of the source file, so edited files are decoded again.
+
+    Args:
+        root (str): cache directory, about ``H * W * 3`` bytes per RGB image.
+    """
+    def __init__(self, root):
+        self.root = os.path.expanduser(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, path, mode):
+        st = os.stat(path)
+        key = hashlib.sha1(('%s\n%d\n%d\n%s' % (os.path.abspath(path), st.st_size,
+                                                 st.st_mtime_ns, mode)).encode()).hexdigest()
+        return os.path.join(self.root, key[:2], key + '.npy')
+
+    def open(self, path, mode=None):
+        """ ``Image.open(path)`` (converted to ``mode``) through the cache. Paletted images
+        come back as 'L' images of their indices, which is what label maps need. """
+        cache_path = self._path(path, mode)
+        try:
+            return Image.fromarray(np.load(cache_path, mmap_mode='r'))
+        except (OSError, ValueError):  # not cached yet, or being written
+            pass
+        img = Image.open(path)
+        if mode is not None:
+            img = img.convert(mode)
+        array = np.asarray(img)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return Image.fromarray(array)
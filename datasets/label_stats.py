@@ -0,0 +1,174 @@
+import os
+import multiprocessing
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Sampler
+
+#
+#  Per-image class statistics of segmentation masks
+#
+
+
+def _mask_stats(args):
+    path, encode_fn, num_classes = args
+    label = Image.open(path)
+    label = np.asarray(encode_fn(label) if encode_fn is not None else label)
+    counts = np.bincount(label.ravel(), minlength=256)[:num_classes]
+    boxes = np.zeros((num_classes, 4), dtype=np.uint16)
+    for c in np.flatnonzero(counts):
+        mask = label == c
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        boxes[c] = rows[0], cols[0], rows[-1] + 1, cols[-1] + 1
+    return counts, boxes
+
+
+class LabelStats(object):
+    """Class pixel counts and class bounding boxes of every mask of a dataset
+
+    Attributes:
+        images (list): image paths, in dataset order.
+        counts (array): (N, C) uint32 number of pixels of class c in mask i.
+        boxes (array): (N, C, 4) uint16 (top, left, bottom, right) box of class c in
+            mask i, zeros where the class is absent.
+    """
+    def __init__(self, images, counts, boxes):
+        self.images = list(images)
+        self.counts = counts
+        self.boxes = boxes
+
+    @property
+    def num_classes(self):
+        return self.counts.shape[1]
+
+    @classmethod
+    def compute(cls, dataset, num_classes, num_workers=4):
+        """One pass over the masks of a VOCSegmentation or Cityscapes dataset"""
+        masks = dataset.masks if hasattr(dataset, 'masks') else dataset.targets
+        encode_fn = getattr(dataset, 'encode_target', None)
+        jobs = [(path, encode_fn, num_classes) for path in masks]
+        if num_workers > 0:
+            with multiprocessing.Pool(num_workers) as pool:
+                results = pool.map(_mask_stats, jobs, chunksize=16)
+        else:
+            results = [_mask_stats(job) for job in jobs]
+        counts = np.stack([r[0] for r in results]).astype(np.uint32)
+        boxes = np.stack([r[1] for r in results])
+        return cls(dataset.images, counts, boxes)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        np.savez_compressed(path, images=np.array(self.images), counts=self.counts, boxes=self.boxes)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['images'].tolist(), f['counts'], f['boxes'])
+
+    @classmethod
+    def load_or_compute(cls, path, dataset, num_classes, num_workers=4):
+        """Loads ``path`` if it indexes the same images, otherwise computes and saves it"""
+        if os.path.isfile(path):
+            stats = cls.load(path)
+            if stats.images == list(dataset.images) and stats.num_classes == num_classes:
+                return stats
+        stats = cls.compute(dataset, num_classes, num_workers=num_workers)
+        stats.save(path)
+        return stats
+
+    def class_pixels(self):
+        return self.counts.sum(axis=0, dtype=np.int64)
+
+    def class_images(self):
+        """number of images containing each class"""
+        return (self.counts > 0).sum(axis=0)
+
+    def images_with_class(self, c):
+        return np.flatnonzero(self.counts[:, c])
+
+    def class_weights(self, method='median_freq'):
+        """Per-class loss weights, e.g. for ``nn.CrossEntropyLoss(weight=...)``
+
+        Args:
+            method (str): ``median_freq`` (median frequency balancing), ``inverse``
+                or ``inverse_sqrt`` of the class pixel frequency.
+        """
+        freq = self.class_pixels() / max(self.class_pixels().sum(), 1)
+        present = freq > 0
+        weights = np.zeros_like(freq)
+        if method == 'median_freq':
+            weights[present] = np.median(freq[present]) / freq[present]
+        elif method == 'inverse':
+            weights[present] = 1. / freq[present]
+        elif method == 'inverse_sqrt':
+            weights[present] = 1. / np.sqrt(freq[present])
+        else:
+            raise ValueError('Unknown class weighting %s' % method)
+        weights[present] /= weights[present].mean()
+        return torch.tensor(weights, dtype=torch.float32)
+
+    def crop_weights(self, value_to_class=None):
+        """(256,) crop priority of every label value: inverse square root of the class
+        pixel frequency, 0 for ignored values. ``value_to_class`` maps the values seen by
+        the transforms to classes, e.g. ``Cityscapes.id_to_train_id``."""
+        class_weights = np.zeros(256)
+        class_weights[:self.num_classes] = self.class_weights('inverse_sqrt').numpy()
+        if value_to_class is None:
+            return class_weights
+        weights = np.zeros(256)
+        value_to_class = np.asarray(value_to_class)
+        weights[:len(value_to_class)] = class_weights[value_to_class.clip(0, 255)]
+        return weights
+
+    def sample_weights(self, power=1.0):
+        """Per-image sampling weights. ``power=1`` is equivalent to drawing a class uniformly,
+        then an image containing it; ``power=0`` is uniform sampling."""
+        present = self.counts > 0
+        n_images = present.sum(axis=0)
+        class_prob = np.where(n_images > 0, 1. / np.maximum(n_images, 1), 0.)
+        weights = (present * class_prob).sum(axis=1)
+        weights = np.where(weights > 0, weights, class_prob[class_prob > 0].min())  # unlabeled images
+        return weights ** power
+
+    def stratified_subset(self, n, seed=0):
+        """Fixed subset of ``n`` image indices stratified by the rarest class of each image,
+        so that rare classes keep their share of the images (at least one per class
+        when ``n`` allows it)"""
+        n = min(n, len(self.counts))
+        present = self.counts > 0
+        n_images = present.sum(axis=0)
+        rarity = np.where(present, n_images[None, :], np.iinfo(np.int64).max)
+        strata = np.where(present.any(axis=1), rarity.argmin(axis=1), -1)
+        rng = np.random.RandomState(seed)
+        groups = [rng.permutation(np.flatnonzero(strata == s)) for s in np.unique(strata)]
+        quotas = np.array([len(g) for g in groups]) * n / len(strata)
+        take = np.minimum(np.maximum(np.floor(quotas), 1), [len(g) for g in groups]).astype(int)
+        while take.sum() > n:  # more strata than images requested: trim the strata most above their quota
+            take[np.argmax(take - quotas)] -= 1
+        while take.sum() < n:  # distribute the remainder by largest rounding loss
+            room = np.array([len(g) for g in groups]) - take
+            take[np.argmax(np.where(room > 0, quotas - take, -np.inf))] += 1
+        return np.sort(np.concatenate([g[:k] for g, k in zip(groups, take)]))
+
+
+class ClassAwareSampler(Sampler):
+    """Samples images with replacement so that rare classes show up as often as frequent ones
+
+    Arguments:
+        stats (LabelStats): statistics of the sampled dataset.
+        num_samples (int, optional): samples per epoch, the dataset size by default.
+        power (float): interpolates between uniform (0) and class-balanced (1) sampling.
+    """
+    def __init__(self, stats, num_samples=None, power=1.0, generator=None):
+        self.weights = torch.as_tensor(stats.sample_weights(power), dtype=torch.double)
+        self.num_samples = num_samples or len(self.weights)
+        self.generator = generator
+
+    def __iter__(self):
+        return iter(torch.multinomial(self.weights, self.num_samples, replacement=True,
+                                      generator=self.generator).tolist())
+
+    def __len__(self):
+        return self.num_samples
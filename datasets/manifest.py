@@ -0,0 +1,121 @@
+import os
+import json
+import tempfile
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+#
+#  Cached per-split index of a dataset (paths, image sizes, file sizes, mtimes)
+#
+MANIFEST_VERSION = 1
+
+
+def path_signature(paths):
+    """[path, mtime_ns, size] of each path, None for missing ones.
+
+    Adding or removing files changes the mtime of their directory, so the signature
+    of a few directories (and split files) is enough to detect a stale manifest.
+    """
+    sig = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            sig.append([p, st.st_mtime_ns, st.st_size])
+        except OSError:
+            sig.append([p, None, None])
+    return sig
+
+
+def _scan(pair):
+    image, target = pair
+    img_st = os.stat(image)
+    tgt_st = os.stat(target)
+    with Image.open(image) as img:  # only parses the header
+        width, height = img.size
+    return [width, height, img_st.st_size, img_st.st_mtime_ns, tgt_st.st_size, tgt_st.st_mtime_ns]
+
+
+def scan_files(images, targets, num_workers=16):
+    """Reads image sizes, file sizes and mtimes of (image, target) pairs in parallel"""
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(_scan, zip(images, targets), chunksize=64))
+
+
+def _write_json(path, obj):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_manifest(path, signature_paths, list_fn, rebuild=False, num_workers=16):
+    """Loads the manifest at ``path``, rebuilding it when missing or stale.
+
+    Args:
+        path (str): manifest file (json).
+        signature_paths (list): directories and split files whose ``path_signature``
+            validates the manifest.
+        list_fn (callable): returns the (images, targets) path lists of the split.
+        rebuild (bool): ignore an existing manifest.
+        num_workers (int): threads used to stat the files and read image headers.
+
+    Returns:
+        dict: 'images', 'targets', 'sizes' ((width, height) per image), 'image_bytes',
+        'image_mtimes', 'target_bytes' and 'target_mtimes'.
+    """
+    signature = path_signature(signature_paths)
+    if not rebuild and os.path.isfile(path):
+        try:
+            with open(path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION and manifest.get('signature') == signature:
+                return manifest
+        except ValueError:  # truncated or corrupted, rebuild
+            pass
+
+    images, targets = list_fn()
+    records = scan_files(images, targets, num_workers=num_workers)
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'signature': signature,
+        'images': images,
+        'targets': targets,
+        'sizes': [r[0:2] for r in records],
+        'image_bytes': [r[2] for r in records],
+        'image_mtimes': [r[3] for r in records],
+        'target_bytes': [r[4] for r in records],
+        'target_mtimes': [r[5] for r in records],
+    }
+    try:
+        _write_json(path, manifest)
+    except OSError as e:  # read-only dataset, keep going without the cache
+        warnings.warn('Could not write dataset manifest %s: %s' % (path, e))
+    return manifest
+
+
+def verify_manifest(manifest, num_workers=16):
+    """Full check that every file still has the recorded size and mtime.
+
+    Returns:
+        list: indices of the samples that changed or disappeared.
+    """
+    def changed(i):
+        try:
+            img_st = os.stat(manifest['images'][i])
+            tgt_st = os.stat(manifest['targets'][i])
+        except OSError:
+            return True
+        return (img_st.st_size != manifest['image_bytes'][i] or img_st.st_mtime_ns != manifest['image_mtimes'][i] or
+                tgt_st.st_size != manifest['target_bytes'][i] or tgt_st.st_mtime_ns != manifest['target_mtimes'][i])
+
+    indices = range(len(manifest['images']))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return [i for i, c in zip(indices, executor.map(changed, indices)) if c]
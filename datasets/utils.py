@@ -2,6 +2,13 @@ import os
 import os.path
 import hashlib
 import errno
+import json
+import queue
+import tarfile
+import threading
+import http.client
+import urllib.parse
+import urllib.request
 from tqdm import tqdm
 
 
@@ -82,6 +89,236 @@ def download_url(url, root, filename=None, md5=None):
                 )
 
 
+def _probe(url, timeout=60):
+    """HEAD request: (final url after redirects, content length or None, byte ranges supported)"""
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method='HEAD'), timeout=timeout) as resp:
+            size = resp.headers.get('Content-Length')
+            ranges = resp.headers.get('Accept-Ranges', '').lower() == 'bytes'
+            return resp.geturl(), int(size) if size else None, ranges
+    except (OSError, http.client.HTTPException, ValueError):  # no HEAD support, fall back to a plain GET
+        return url, None, False
+
+
+class _RangedDownload(object):
+    """Downloads ``url`` into ``part_path`` as fixed-size byte ranges over ``num_connections``
+    kept-alive connections. Completed chunks are recorded in ``part_path + '.json'`` so an
+    interrupted download resumes where it stopped.
+    """
+    def __init__(self, url, part_path, size, chunk_size, num_connections, retries=3, timeout=60):
+        self.url = url
+        self.part_path = part_path
+        self.state_path = part_path + '.json'
+        self.size = size
+        self.chunk_size = chunk_size
+        self.n_chunks = (size + chunk_size - 1) // chunk_size
+        self.num_connections = num_connections
+        self.retries = retries
+        self.timeout = timeout
+        parts = urllib.parse.urlsplit(url)
+        self.scheme, self.netloc = parts.scheme, parts.netloc
+        self.path = parts.path + ('?' + parts.query if parts.query else '')
+        self.cond = threading.Condition()
+        self.error = None
+        self.stopped = False
+        self.done = self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+            if (state['url'] == self.url and state['size'] == self.size and
+                    state['chunk_size'] == self.chunk_size and os.path.getsize(self.part_path) == self.size):
+                return set(state['done'])
+        except (OSError, ValueError, KeyError):
+            pass
+        with open(self.part_path, 'wb') as f:
+            f.truncate(self.size)
+        return set()
+
+    def _save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'url': self.url, 'size': self.size, 'chunk_size': self.chunk_size,
+                       'done': sorted(self.done)}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def _fetch(self, conn, start, end):
+        conn.request('GET', self.path, headers={'Range': 'bytes=%d-%d' % (start, end)})
+        resp = conn.getresponse()
+        data = resp.read()
+        if resp.status != 206 or len(data) != end - start + 1:
+            raise IOError('Bad response to range request %d-%d: status %d, %d bytes' %
+                          (start, end, resp.status, len(data)))
+        return data
+
+    def _worker(self, todo):
+        conn = self._connect()
+        try:
+            with open(self.part_path, 'r+b') as f:
+                while not self.stopped:
+                    try:
+                        i = todo.get_nowait()
+                    except queue.Empty:
+                        break
+                    start = i * self.chunk_size
+                    end = min(start + self.chunk_size, self.size) - 1
+                    for attempt in range(self.retries):
+                        try:
+                            data = self._fetch(conn, start, end)
+                            break
+                        except (OSError, http.client.HTTPException):
+                            conn.close()
+                            conn = self._connect()
+                            if attempt == self.retries - 1:
+                                raise
+                    f.seek(start)
+                    f.write(data)
+                    f.flush()
+                    with self.cond:
+                        self.done.add(i)
+                        self._save_state()
+                        self.cond.notify_all()
+        except BaseException as e:
+            with self.cond:
+                self.error = e
+                self.cond.notify_all()
+        finally:
+            conn.close()
+
+    def chunks(self):
+        """Yields the file content in order, each chunk as soon as it is on disk"""
+        todo = queue.Queue()
+        for i in range(self.n_chunks):
+            if i not in self.done:
+                todo.put(i)
+        threads = [threading.Thread(target=self._worker, args=(todo,), daemon=True)
+                   for _ in range(min(self.num_connections, todo.qsize()))]
+        for t in threads:
+            t.start()
+        try:
+            with open(self.part_path, 'rb') as f:
+                for i in range(self.n_chunks):
+                    with self.cond:
+                        while i not in self.done and self.error is None:
+                            self.cond.wait()
+                        if i not in self.done:
+                            raise self.error
+                    f.seek(i * self.chunk_size)
+                    yield f.read(min(self.chunk_size, self.size - i * self.chunk_size))
+        finally:
+            self.stopped = True
+        for t in threads:
+            t.join()
+
+
+def _serial_chunks(url, part_path, chunk_size, timeout=60):
+    """Single-connection fallback for servers without byte ranges, not resumable"""
+    with urllib.request.urlopen(url, timeout=timeout) as resp, open(part_path, 'wb') as f:
+        for data in iter(lambda: resp.read(chunk_size), b''):
+            f.write(data)
+            yield data
+
+
+class _HashingStream(object):
+    """Read-only file object over an iterator of byte chunks, hashing everything read"""
+    def __init__(self, chunks, hasher, pbar=None):
+        self.chunks = iter(chunks)
+        self.hasher = hasher
+        self.pbar = pbar
+        self.buffer = b''
+        self.offset = 0
+
+    def _next(self):
+        data = next(self.chunks, b'')
+        self.hasher.update(data)
+        if self.pbar is not None:
+            self.pbar.update(len(data))
+        return data
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            parts = [self.buffer[self.offset:]] + list(iter(self._next, b''))
+            self.buffer, self.offset = b'', 0
+            return b''.join(parts)
+        while len(self.buffer) - self.offset < n:
+            data = self._next()
+            if not data:
+                break
+            self.buffer = self.buffer[self.offset:] + data
+            self.offset = 0
+        out = self.buffer[self.offset:self.offset + n]
+        self.offset += len(out)
+        return out
+
+    def drain(self):
+        """Consumes (and hashes) whatever the reader left, e.g. the tar end padding"""
+        for _ in iter(self._next, b''):
+            pass
+
+
+def download_url_parallel(url, root, filename=None, md5=None, extract=False,
+                          num_connections=4, chunk_size=8 * 1024 * 1024):
+    """Download a file with parallel byte-range requests, optionally extracting it on the fly.
+
+    The file is fetched as ``chunk_size`` ranges over ``num_connections`` kept-alive
+    connections into ``<filename>.part``, and an interrupted download resumes from the
+    chunks already on disk. The MD5 is computed while the bytes arrive, in order, and a
+    tar archive is extracted from the same stream, so neither waits for the whole file.
+    Servers without range support are downloaded over a single connection.
+
+    Args:
+        url (str): URL to download file from
+        root (str): Directory to place downloaded file (and extracted archive) in
+        filename (str): Name to save the file under. If None, use the basename of the URL
+        md5 (str): MD5 checksum of the download. If None, do not check
+        extract (bool): Extract the tar archive into root while downloading. With an MD5
+            mismatch the extracted files are not trustworthy either.
+        num_connections (int): Parallel connections
+        chunk_size (int): Bytes per range request
+    """
+    root = os.path.expanduser(root)
+    if not filename:
+        filename = os.path.basename(url)
+    fpath = os.path.join(root, filename)
+    makedir_exist_ok(root)
+
+    if os.path.isfile(fpath) and check_integrity(fpath, md5):
+        print('Using downloaded and verified file: ' + fpath)
+        if extract:
+            with tarfile.open(fpath, "r") as tar:
+                tar.extractall(path=root)
+        return fpath
+
+    part_path = fpath + '.part'
+    final_url, size, ranges = _probe(url)
+    print('Downloading ' + url + ' to ' + fpath)
+    if size and ranges and num_connections > 1:
+        chunks = _RangedDownload(final_url, part_path, size, chunk_size, num_connections).chunks()
+    else:
+        chunks = _serial_chunks(final_url, part_path, chunk_size)
+    hasher = hashlib.md5()
+    with tqdm(total=size, unit='B', unit_scale=True) as pbar:
+        stream = _HashingStream(chunks, hasher, pbar)
+        if extract:
+            with tarfile.open(fileobj=stream, mode='r|*') as tar:
+                tar.extractall(path=root)
+        stream.drain()
+
+    if os.path.exists(part_path + '.json'):
+        os.remove(part_path + '.json')
+    if md5 is not None and hasher.hexdigest() != md5:
+        os.remove(part_path)
+        raise RuntimeError('MD5 mismatch for %s: expected %s, got %s' % (url, md5, hasher.hexdigest()))
+    os.replace(part_path, fpath)
+    return fpath
+
+
 def list_dir(root, prefix=False):
     """List all directories at a given root
     Args:
@@ -7,7 +7,10 @@ import shutil
 import numpy as np
 
 from PIL import Image
-from torchvision.datasets.utils import download_url, check_integrity
+
+from .manifest import load_manifest
+from .utils import download_url_parallel
+from .decoded_cache import DecodedCache
 
 DATASET_YEAR_DICT = {
     '2012': {
@@ -80,6 +83,11 @@ class VOCSegmentation(data.Dataset):
             downloaded again.
         transform (callable, optional): A function/transform that  takes in an PIL image
             and returns a transformed version. E.g, ``transforms.RandomCrop``
+        use_manifest (bool, optional): Load the file list from a cached manifest (see
+            ``datasets.manifest``), rebuilt when the split file or the image directories changed.
+        manifest_dir (string, optional): Where manifests are stored, ``root/.manifests`` by default.
+        rebuild_manifest (bool, optional): Force rebuilding the manifest.
+        decoded_cache (string, optional): Directory of a ``DecodedCache`` shared by concurrent runs.
     """
     cmap = voc_cmap()
     def __init__(self,
@@ -87,7 +95,11 @@ class VOCSegmentation(data.Dataset):
                  year='2012',
                  image_set='train',
                  download=False,
-                 transform=None):
+                 transform=None,
+                 use_manifest=True,
+                 manifest_dir=None,
+                 rebuild_manifest=False,
+                 decoded_cache=None):
 
         is_aug=False
         if year=='2012_aug':
@@ -100,6 +112,7 @@ class VOCSegmentation(data.Dataset):
         self.filename = DATASET_YEAR_DICT[year]['filename']
         self.md5 = DATASET_YEAR_DICT[year]['md5']
         self.transform = transform
+        self.decoded_cache = DecodedCache(decoded_cache) if decoded_cache is not None else None
         
         self.image_set = image_set
         base_dir = DATASET_YEAR_DICT[year]['base_dir']
@@ -127,11 +140,23 @@ class VOCSegmentation(data.Dataset):
                 'Wrong image_set entered! Please use image_set="train" '
                 'or image_set="trainval" or image_set="val"')
 
-        with open(os.path.join(split_f), "r") as f:
-            file_names = [x.strip() for x in f.readlines()]
-        
-        self.images = [os.path.join(image_dir, x + ".jpg") for x in file_names]
-        self.masks = [os.path.join(mask_dir, x + ".png") for x in file_names]
+        def list_files():
+            with open(os.path.join(split_f), "r") as f:
+                file_names = [x.strip() for x in f.readlines()]
+            images = [os.path.join(image_dir, x + ".jpg") for x in file_names]
+            masks = [os.path.join(mask_dir, x + ".png") for x in file_names]
+            return images, masks
+
+        self.image_sizes = None
+        if use_manifest:
+            manifest_dir = manifest_dir or os.path.join(self.root, '.manifests')
+            name = 'voc%s%s_%s.json' % (year, '_aug' if is_aug else '', image_set)
+            manifest = load_manifest(os.path.join(manifest_dir, name), [split_f, image_dir, mask_dir],
+                                     list_files, rebuild=rebuild_manifest)
+            self.images, self.masks = manifest['images'], manifest['targets']
+            self.image_sizes = [tuple(s) for s in manifest['sizes']]
+        else:
+            self.images, self.masks = list_files()
         assert (len(self.images) == len(self.masks))
 
     def __getitem__(self, index):
@@ -141,8 +166,12 @@ class VOCSegmentation(data.Dataset):
         Returns:
             tuple: (image, target) where target is the image segmentation.
         """
-        img = Image.open(self.images[index]).convert('RGB')
-        target = Image.open(self.masks[index])
+        if self.decoded_cache is not None:
+            img = self.decoded_cache.open(self.images[index], 'RGB')
+            target = self.decoded_cache.open(self.masks[index])
+        else:
+            img = Image.open(self.images[index]).convert('RGB')
+            target = Image.open(self.masks[index])
         if self.transform is not None:
             img, target = self.transform(img, target)
 
@@ -157,7 +186,5 @@ class VOCSegmentation(data.Dataset):
         """decode semantic mask to RGB image"""
         return cls.cmap[mask]
 
-def download_extract(url, root, filename, md5):
-    download_url(url, root, filename, md5)
-    with tarfile.open(os.path.join(root, filename), "r") as tar:
-        tar.extractall(path=root)
\ No newline at end of file
+def download_extract(url, root, filename, md5, num_connections=4):
+    download_url_parallel(url, root, filename, md5, extract=True, num_connections=num_connections)
\ No newline at end of file
@@ -0,0 +1,147 @@
+"""Decomposes the 3x3 convs of a trained model into separable or low-rank factorizations
+
+    python decompose.py --model deeplabv3plus_resnet101 --ckpt checkpoints/best_deeplabv3plus_resnet101_voc_os16.pth \
+        --dataset voc --data_root ./datasets/data --crop_val --error_budget 0.3 --parts aspp decoder \
+        --finetune_itrs 1000 --output checkpoints/decomposed.pth
+
+Every conv of the selected parts gets the cheapest decomposition whose weights are within
+--error_budget (relative Frobenius error) of the original, see network/decompose.py. The
+model can then be fine-tuned for a few iterations. FLOPs, latency and mIoU are reported
+before and after. The checkpoint saved to --output records the decomposition, and main.py
+and predict.py rebuild it when they load that checkpoint.
+"""
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils import data
+
+import network
+import utils
+from main import get_argparser, get_dataset, validate, build_model
+from metrics import StreamSegMetrics
+from network._deeplab import ASPP
+
+
+def get_decompose_argparser():
+    parser = get_argparser()
+    parser.add_argument("--error_budget", type=float, default=0.3,
+                        help="maximum relative error of each decomposed conv's weights (default: 0.3)")
+    parser.add_argument("--methods", type=str, nargs='+', default=list(network.decompose.METHODS),
+                        choices=network.decompose.METHODS, help="decompositions to consider")
+    parser.add_argument("--parts", type=str, nargs='+', default=['aspp', 'decoder'],
+                        choices=['aspp', 'decoder', 'backbone'], help="parts of the model to decompose")
+    parser.add_argument("--finetune_itrs", type=int, default=0,
+                        help="fine-tuning iterations after the decomposition (default: 0)")
+    parser.add_argument("--finetune_lr", type=float, default=0.001,
+                        help="fine-tuning learning rate (default: 0.001)")
+    parser.add_argument("--val_samples", type=int, default=None,
+                        help="validate on the first N val images (default: all)")
+    parser.add_argument("--output", type=str, default=None,
+                        help="where to save the decomposed checkpoint")
+    return parser
+
+
+def part_convs(model, parts):
+    """ names of the decomposable convs of ``parts`` (aspp, decoder, backbone) """
+    aspp = [name for name, m in model.named_modules() if isinstance(m, ASPP)]
+    names = []
+    for name, m in model.named_modules():
+        if not network.decompose.decomposable(m):
+            continue
+        in_aspp = any(name.startswith(prefix + '.') for prefix in aspp)
+        part = 'backbone' if name.startswith('backbone.') else 'aspp' if in_aspp else 'decoder'
+        if part in parts:
+            names.append(name)
+    return names
+
+
+def measure(model, loader, opts, device):
+    x = torch.randn(1, 3, opts.crop_size, opts.crop_size, device=device)
+    model.eval()
+    gmacs = network.conv_macs(model, x) / 1e9
+    with torch.no_grad():
+        model(x)
+        times = []
+        for _ in range(5):
+            start = time.perf_counter()
+            model(x)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            times.append(time.perf_counter() - start)
+    score, _ = validate(opts=opts, model=model, loader=loader, device=device, metrics=StreamSegMetrics(opts.num_classes))
+    params = sum(p.numel() for p in model.parameters()) / 1e6
+    return [params, gmacs, np.median(times) * 1000, score['Mean IoU']]
+
+
+def finetune(model, loader, opts, device):
+    optimizer = torch.optim.SGD(model.parameters(), lr=opts.finetune_lr, momentum=0.9, weight_decay=opts.weight_decay)
+    scheduler = utils.PolyLR(optimizer, opts.finetune_itrs, power=0.9)
+    criterion = nn.CrossEntropyLoss(ignore_index=255, reduction='mean')
+    model.train()
+    utils.fix_bn(model)  # few iterations, keep the BatchNorm statistics of the trained model
+    itrs = 0
+    while itrs < opts.finetune_itrs:
+        for images, labels in loader:
+            images = images.to(device, dtype=torch.float32)
+            labels = labels.to(device, dtype=torch.long)
+            optimizer.zero_grad()
+            loss = criterion(model(images), labels)
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            itrs += 1
+            if itrs % 10 == 0:
+                print("Fine-tuning itrs %d/%d, loss=%f" % (itrs, opts.finetune_itrs, loss.item()))
+            if itrs >= opts.finetune_itrs:
+                break
+
+
+def main():
+    opts = get_decompose_argparser().parse_args()
+    opts.num_classes = opts.num_classes or (21 if opts.dataset == 'voc' else 19)
+    opts.save_val_results = False
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    train_dst, val_dst = get_dataset(opts)
+    if opts.val_samples is not None:
+        val_dst = data.Subset(val_dst, range(min(opts.val_samples, len(val_dst))))
+    val_loader = data.DataLoader(val_dst, batch_size=opts.val_batch_size, shuffle=False, num_workers=2)
+
+    model = build_model(opts, pretrained_backbone=False)
+    checkpoint = torch.load(opts.ckpt, map_location=torch.device('cpu'))
+    if checkpoint.get("pruning"):
+        network.prune_channels(model, plan=checkpoint["pruning"])
+    if checkpoint.get("decomposition"):  # decomposed again, on top of an earlier decomposition
+        network.decompose_convs(model, plan=checkpoint["decomposition"])
+    model.load_state_dict(checkpoint["model_state"])
+    model.to(device)
+
+    rows = [['original'] + measure(model, val_loader, opts, device)]
+    plan = network.decompose_convs(model, error_budget=opts.error_budget, methods=opts.methods,
+                                   scopes=part_convs(model, opts.parts))
+    for name, (method, rank, error) in plan.items():
+        print("%s: %s rank %d, weight error %.3f" % (name, method, rank, error))
+    rows.append(['decomposed'] + measure(model, val_loader, opts, device))
+    if opts.finetune_itrs > 0:
+        train_loader = data.DataLoader(train_dst, batch_size=opts.batch_size, shuffle=True, num_workers=2,
+                                       drop_last=True)
+        finetune(model, train_loader, opts, device)
+        rows.append(['fine-tuned %d itrs' % opts.finetune_itrs] + measure(model, val_loader, opts, device))
+
+    header = ['model', 'params (M)', 'GMACs', 'ms', 'mIoU']
+    rows = [[r[0], '%.2f' % r[1], '%.2f' % r[2], '%.1f' % r[3], '%.4f' % r[4]] for r in rows]
+    widths = [max(len(str(v)) for v in col) for col in zip(header, *rows)]
+    for row in [header] + rows:
+        print(' | '.join(str(v).ljust(w) for v, w in zip(row, widths)))
+
+    if opts.output is not None:
+        torch.save({"model_state": model.state_dict(), "pruning": getattr(model, 'pruning', None),
+                    "decomposition": {name: (method, rank) for name, (method, rank, _) in model.decomposition.items()}},
+                   opts.output)
+        print("Decomposed model saved as %s" % opts.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,25 +2,20 @@ from tqdm import tqdm
 import network
 import utils
 import os
+import json
 import random
 import argparse
 import numpy as np
 
 from torch.utils import data
-from datasets import VOCSegmentation, Cityscapes
+from datasets import VOCSegmentation, Cityscapes, LabelStats, ClassAwareSampler
 from utils import ext_transforms as et
-from metrics import StreamSegMetrics
+from metrics import StreamSegMetrics, ImageSegMetrics
 
 import torch
 import torch.nn as nn
-from utils.visualizer import Visualizer
 
 from PIL import Image
-import matplotlib
-import matplotlib.pyplot as plt
-import sys
-sys.path.append('../semantic-seg-utils')
-import training_helpers as th
 
 
 def get_argparser():
@@ -36,7 +31,7 @@ def get_argparser():
 
     # Deeplab Options
     available_models = sorted(name for name in network.modeling.__dict__ if name.islower() and \
-                              not (name.startswith("__") or name.startswith('_')) and callable(
+                              name.startswith('deeplab') and callable(
                               network.modeling.__dict__[name])
                               )
     parser.add_argument("--model", type=str, default='deeplabv3plus_mobilenet',
@@ -44,6 +39,40 @@ def get_argparser():
     parser.add_argument("--separable_conv", action='store_true', default=False,
                         help="apply separable conv to decoder and aspp")
     parser.add_argument("--output_stride", type=int, default=16, choices=[8, 16])
+    parser.add_argument("--stream_aspp", action='store_true', default=False,
+                        help="HRNet: run the ASPP on the streams instead of their upsampled concat "
+                             "(same results and weights, less memory)")
+    parser.add_argument("--fusion_channels", type=int, default=None,
+                        help="HRNet: run the atrous ASPP branches on a reduced fusion of the streams "
+                             "with this many channels (new weights, to train)")
+    parser.add_argument("--pad_in_conv", type=int, default=None, choices=[0, 1],
+                        help="mobilenet: pad in the depthwise convs instead of copying every block input "
+                             "(default: 1 for the _x width variants, 0 for the released checkpoints)")
+    parser.add_argument("--branch_workers", type=int, default=1,
+                        help="threads running the branches of HRNet stages, ASPP and multi-branch stems "
+                             "concurrently (default: 1)")
+    parser.add_argument("--label_only", action='store_true', default=False,
+                        help="validate with chunked upsample-argmax instead of full-size logits")
+
+    # ResNet Options
+    parser.add_argument("--fl_maxpool", type=int, default=1, choices=[0, 1],
+                        help="resnet: keep the stem max-pooling (default: 1)")
+    parser.add_argument("--fl_stemstride", type=int, default=1, choices=[0, 1],
+                        help="resnet: stride 2 in the stem convolution (default: 1)")
+    parser.add_argument("--fl_richstem", type=int, default=0, choices=[0, 1],
+                        help="resnet: three 3x3 convolutions stem (default: 0)")
+    parser.add_argument("--fl_parallelstem", type=int, default=0, choices=[0, 1],
+                        help="resnet: parallel branches stem (default: 0)")
+    parser.add_argument("--fl_lfe", type=int, default=0, choices=[0, 1],
+                        help="resnet: large field extraction dilations (default: 0)")
+    parser.add_argument("--fl_transpose", type=int, default=0, choices=[0, 1],
+                        help="deeplabv3plus resnet: transposed convolutions in the decoder (default: 0)")
+    parser.add_argument("--fl_transpose_odd", type=int, default=0, choices=[0, 1],
+                        help="deeplabv3plus resnet: last transposed convolution of the high-level path is 3x3, "
+                             "for input sizes of 2^k+1 like 513 (default: 0)")
+    parser.add_argument("--upsampler", type=str, default='bilinear', choices=network.UPSAMPLERS,
+                        help="deeplabv3plus: decoder upsampling, bilinear or a learned 2x upsampler "
+                             "initialized bilinear (transpose is --fl_transpose 1, default: bilinear)")
 
     # Train Options
     parser.add_argument("--test_only", action='store_true', default=False)
@@ -70,8 +99,46 @@ def get_argparser():
                         help="Checkpoint directory")
     parser.add_argument("--continue_training", action='store_true', default=False)
 
+    parser.add_argument("--train_at_decoder_res", action='store_true', default=False,
+                        help="compute the training loss on decoder-resolution logits and downsampled labels")
+    parser.add_argument("--label_downsample", type=str, default='mode', choices=['mode', 'nearest'],
+                        help="label downsampling of --train_at_decoder_res (default: mode)")
     parser.add_argument("--loss_type", type=str, default='cross_entropy',
-                        choices=['cross_entropy', 'focal_loss'], help="loss type (default: False)")
+                        choices=['cross_entropy', 'focal_loss', 'ohem'], help="loss type (default: False)")
+    parser.add_argument("--chunked_loss", action='store_true', default=False,
+                        help="compute cross_entropy/focal_loss in row chunks to save memory (ohem always is)")
+    parser.add_argument("--loss_chunk_rows", type=int, default=64,
+                        help="rows per chunk of the chunked losses (default: 64)")
+    parser.add_argument("--ohem_thresh", type=float, default=0.7,
+                        help="ohem: keep pixels whose target probability is below this (default: 0.7)")
+    parser.add_argument("--ohem_min_kept", type=int, default=100000,
+                        help="ohem: minimum number of kept pixels per batch (default: 100000)")
+
+    # Pruning Options
+    parser.add_argument("--prune_ratio", type=float, default=0.,
+                        help="fraction of the channels of every group removed at each pruning step (default: 0, off)")
+    parser.add_argument("--prune_every", type=int, default=5000,
+                        help="iterations of fine-tuning between two pruning steps (default: 5000)")
+    parser.add_argument("--prune_cycles", type=int, default=1,
+                        help="number of pruning steps (default: 1)")
+    parser.add_argument("--prune_importance", type=str, default='bn', choices=['bn', 'taylor'],
+                        help="channel ranking, BatchNorm |gamma| or Taylor estimate of the loss change (default: bn)")
+    parser.add_argument("--prune_residual", action='store_true', default=False,
+                        help="also prune the residual channels of the ResNet stages")
+    parser.add_argument("--prune_min_channels", type=int, default=8,
+                        help="channels always kept in a group (default: 8)")
+
+    # Class balancing Options
+    parser.add_argument("--label_stats", type=str, default=None,
+                        help="per-image class statistics file (default: DATA_ROOT/.manifests/DATASET_train_labelstats.npz)")
+    parser.add_argument("--class_weights", type=str, default='none',
+                        choices=['none', 'median_freq', 'inverse', 'inverse_sqrt'], help="loss class weights")
+    parser.add_argument("--class_aware_sampling", action='store_true', default=False,
+                        help="sample training images so that rare classes are seen as often as frequent ones")
+    parser.add_argument("--sampling_power", type=float, default=1.0,
+                        help="0: uniform sampling, 1: class-balanced sampling (default: 1.0)")
+    parser.add_argument("--rare_crop_prob", type=float, default=0.,
+                        help="probability of centering the training crop on a rare class (default: 0)")
     parser.add_argument("--gpu_id", type=str, default='0',
                         help="GPU ID")
     parser.add_argument("--weight_decay", type=float, default=1e-4,
@@ -82,8 +149,22 @@ def get_argparser():
                         help="print interval of loss (default: 10)")
     parser.add_argument("--val_interval", type=int, default=100,
                         help="epoch interval for eval (default: 100)")
+    parser.add_argument("--fast_val_samples", type=int, default=0,
+                        help="validate on a fixed stratified subset of this many images and run the full "
+                             "validation only when the subset may beat the best score (default: 0, always full)")
+    parser.add_argument("--fast_val_ci", type=float, default=0.95,
+                        help="bootstrap confidence level of the fast validation mIoU (default: 0.95)")
+    parser.add_argument("--fast_val_bootstrap", type=int, default=1000,
+                        help="bootstrap resamples of the fast validation (default: 1000)")
     parser.add_argument("--download", action='store_true', default=False,
                         help="download datasets")
+    parser.add_argument("--rebuild_manifest", action='store_true', default=False,
+                        help="rebuild the cached file lists of the datasets")
+    parser.add_argument("--decoded_cache", type=str, default=None,
+                        help="directory of decoded images shared between runs (default: decode every time)")
+    parser.add_argument("--metrics_file", type=str, default=None,
+                        help="append the validation scores to this json lines file, one per --val_interval: "
+                             "'val' is 'full', or 'subset' for the fast validation estimates")
 
     # PASCAL VOC Options
     parser.add_argument("--year", type=str, default='2012',
@@ -98,6 +179,26 @@ def get_argparser():
                         help='env for visdom')
     parser.add_argument("--vis_num_samples", type=int, default=8,
                         help='number of samples for visualization (default: 8)')
+
+    # Compilation options
+    parser.add_argument("--compile", action='store_true', default=False,
+                        help="run the model with torch.compile, inputs padded to a few shape buckets")
+    parser.add_argument("--compile_backend", type=str, default='inductor',
+                        help="torch.compile backend (default: inductor)")
+    parser.add_argument("--compile_mode", type=str, default=None,
+                        help="torch.compile mode, e.g. max-autotune (default: None)")
+    parser.add_argument("--compile_buckets", type=int, default=4,
+                        help="maximum number of input shapes of variable-size images (default: 4)")
+    parser.add_argument("--compile_cache_dir", type=str, default=None,
+                        help="persistent compiler cache, reused by later runs (default: torch default)")
+
+    # Logging options
+    parser.add_argument("--disable_tensorboard", action='store_true', default=False,
+                        help="do not write TensorBoard events to ckpt_dir")
+    parser.add_argument("--log_jsonl", type=str, default=None,
+                        help="also log all metrics to this json lines file")
+    parser.add_argument("--log_flush_interval", type=float, default=2.0,
+                        help="seconds between metric writes of the logging threads (default: 2)")
     return parser
 
 
@@ -108,7 +209,8 @@ def get_dataset(opts):
         train_transform = et.ExtCompose([
             # et.ExtResize(size=opts.crop_size),
             et.ExtRandomScale((0.5, 2.0)),
-            et.ExtRandomCrop(size=(opts.crop_size, opts.crop_size), pad_if_needed=True),
+            et.ExtRandomCrop(size=(opts.crop_size, opts.crop_size), pad_if_needed=True,
+                             rare_prob=opts.rare_crop_prob),
             et.ExtRandomHorizontalFlip(),
             et.ExtToTensor(),
             et.ExtNormalize(mean=[0.485, 0.456, 0.406],
@@ -129,14 +231,16 @@ def get_dataset(opts):
                                 std=[0.229, 0.224, 0.225]),
             ])
         train_dst = VOCSegmentation(root=opts.data_root, year=opts.year,
-                                    image_set='train', download=opts.download, transform=train_transform)
+                                    image_set='train', download=opts.download, transform=train_transform,
+                                    rebuild_manifest=opts.rebuild_manifest, decoded_cache=opts.decoded_cache)
         val_dst = VOCSegmentation(root=opts.data_root, year=opts.year,
-                                  image_set='val', download=False, transform=val_transform)
+                                  image_set='val', download=False, transform=val_transform,
+                                  rebuild_manifest=opts.rebuild_manifest, decoded_cache=opts.decoded_cache)
 
     if opts.dataset == 'cityscapes':
         train_transform = et.ExtCompose([
             # et.ExtResize( 512 ),
-            et.ExtRandomCrop(size=(opts.crop_size, opts.crop_size)),
+            et.ExtRandomCrop(size=(opts.crop_size, opts.crop_size), rare_prob=opts.rare_crop_prob),
             et.ExtColorJitter(brightness=0.5, contrast=0.5, saturation=0.5),
             et.ExtRandomHorizontalFlip(),
             et.ExtToTensor(),
@@ -152,12 +256,62 @@ def get_dataset(opts):
         ])
 
         train_dst = Cityscapes(root=opts.data_root,
-                               split='train', transform=train_transform)
+                               split='train', transform=train_transform,
+                               rebuild_manifest=opts.rebuild_manifest, decoded_cache=opts.decoded_cache)
         val_dst = Cityscapes(root=opts.data_root,
-                             split='val', transform=val_transform)
+                             split='val', transform=val_transform,
+                             rebuild_manifest=opts.rebuild_manifest, decoded_cache=opts.decoded_cache)
     return train_dst, val_dst
 
 
+def label_stats_path(opts, split):
+    name = 'voc%s' % opts.year if opts.dataset == 'voc' else opts.dataset
+    return os.path.join(opts.data_root, '.manifests', '%s_%s_labelstats.npz' % (name, split))
+
+
+def get_label_stats(opts, train_dst):
+    """ Per-image class statistics of the training set, computed once and cached
+    """
+    path = opts.label_stats or label_stats_path(opts, 'train')
+    stats = LabelStats.load_or_compute(path, train_dst, opts.num_classes)
+
+    if opts.rare_crop_prob > 0:
+        # the crop sees the labels before Cityscapes.encode_target
+        value_to_class = Cityscapes.id_to_train_id if opts.dataset == 'cityscapes' else None
+        for t in train_dst.transform.transforms:
+            if isinstance(t, et.ExtRandomCrop):
+                t.class_weights = stats.crop_weights(value_to_class)
+    return stats
+
+
+def get_model_kwargs(opts):
+    """ the constructor kwargs of the stem, decoder and head options of ``opts.model`` """
+    model_kwargs = {}
+    if 'resnet' in opts.model:
+        model_kwargs = {k: bool(getattr(opts, k)) for k in ['fl_maxpool', 'fl_stemstride', 'fl_richstem',
+                                                            'fl_parallelstem', 'fl_lfe']}
+        if 'plus' in opts.model:
+            model_kwargs['fl_transpose'] = bool(opts.fl_transpose)
+            model_kwargs['fl_transpose_odd'] = bool(opts.fl_transpose_odd)
+    elif 'hrnet' in opts.model:
+        model_kwargs = {'stream_aspp': opts.stream_aspp, 'fusion_channels': opts.fusion_channels}
+    elif 'mobilenet' in opts.model and opts.pad_in_conv is not None:
+        model_kwargs = {'pad_in_conv': bool(opts.pad_in_conv)}
+    if 'plus' in opts.model:
+        model_kwargs['upsampler'] = opts.upsampler
+    return model_kwargs
+
+
+def build_model(opts, **kwargs):
+    """ the ``opts.model`` network (all models are constructed at network.modeling), ``kwargs``
+    are passed to the constructor, e.g. ``pretrained_backbone`` """
+    model = network.modeling.__dict__[opts.model](num_classes=opts.num_classes, output_stride=opts.output_stride,
+                                                  **get_model_kwargs(opts), **kwargs)
+    if opts.separable_conv and 'plus' in opts.model:
+        network.convert_to_separable_conv(model.classifier)
+    return model
+
+
 def validate(opts, model, loader, device, metrics, ret_samples_ids=None):
     """Do validation and return specified samples"""
     metrics.reset()
@@ -165,8 +319,8 @@ def validate(opts, model, loader, device, metrics, ret_samples_ids=None):
     if opts.save_val_results:
         if not os.path.exists('results'):
             os.mkdir('results')
-        denorm = utils.Denormalize(mean=[0.485, 0.456, 0.406],
-                                   std=[0.229, 0.224, 0.225])
+        lut = utils.label_lut(loader.dataset)
+        saver = utils.AsyncImageSaver()
         img_id = 0
 
     with torch.no_grad():
@@ -175,8 +329,11 @@ def validate(opts, model, loader, device, metrics, ret_samples_ids=None):
             images = images.to(device, dtype=torch.float32)
             labels = labels.to(device, dtype=torch.long)
 
-            outputs = model(images)
-            preds = outputs.detach().max(dim=1)[1].cpu().numpy()
+            if opts.label_only:
+                preds = model.predict_labels(images).cpu().numpy()
+            else:
+                outputs = model(images)
+                preds = outputs.detach().max(dim=1)[1].cpu().numpy()
             targets = labels.cpu().numpy()
 
             metrics.update(targets, preds)
@@ -185,30 +342,15 @@ def validate(opts, model, loader, device, metrics, ret_samples_ids=None):
                     (images[0].detach().cpu().numpy(), targets[0], preds[0]))
 
             if opts.save_val_results:
-                for i in range(len(images)):
-                    image = images[i].detach().cpu().numpy()
-                    target = targets[i]
-                    pred = preds[i]
-
-                    image = (denorm(image) * 255).transpose(1, 2, 0).astype(np.uint8)
-                    target = loader.dataset.decode_target(target).astype(np.uint8)
-                    pred = loader.dataset.decode_target(pred).astype(np.uint8)
-
-                    Image.fromarray(image).save('results/%d_image.png' % img_id)
-                    Image.fromarray(target).save('results/%d_target.png' % img_id)
-                    Image.fromarray(pred).save('results/%d_pred.png' % img_id)
-
-                    fig = plt.figure()
-                    plt.imshow(image)
-                    plt.axis('off')
-                    plt.imshow(pred, alpha=0.7)
-                    ax = plt.gca()
-                    ax.xaxis.set_major_locator(matplotlib.ticker.NullLocator())
-                    ax.yaxis.set_major_locator(matplotlib.ticker.NullLocator())
-                    plt.savefig('results/%d_overlay.png' % img_id, bbox_inches='tight', pad_inches=0)
-                    plt.close()
+                panels = utils.render_batch(images, targets, preds, lut,
+                                            mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+                for j in range(len(images)):
+                    for name in ['image', 'target', 'pred', 'overlay']:
+                        saver.save(panels[name][j], 'results/%d_%s.png' % (img_id, name))
                     img_id += 1
 
+        if opts.save_val_results:
+            saver.close()
         score = metrics.get_results()
     return score, ret_samples
 
@@ -220,11 +362,20 @@ def main():
     elif opts.dataset.lower() == 'cityscapes':
         opts.num_classes = 19
 
-    # Setup visualization
-    vis = Visualizer(port=opts.vis_port,
-                     env=opts.vis_env) if opts.enable_vis else None
-    if vis is not None:  # display options
-        vis.vis_table("Options", vars(opts))
+    # Setup visualization and logging, written from background threads
+    utils.mkdir(opts.ckpt_dir)
+    sinks = []
+    if opts.enable_vis:
+        sinks.append(utils.VisdomSink(port=opts.vis_port, env=opts.vis_env))
+    if not opts.disable_tensorboard:
+        try:
+            sinks.append(utils.TensorBoardSink(opts.ckpt_dir))
+        except ImportError:
+            print("[!] tensorboard is not installed, TensorBoard logging disabled")
+    if opts.log_jsonl is not None:
+        sinks.append(utils.JSONLSink(opts.log_jsonl))
+    logger = utils.MetricsLogger(sinks, flush_interval=opts.log_flush_interval)
+    logger.table("Options", vars(opts))
 
     os.environ['CUDA_VISIBLE_DEVICES'] = opts.gpu_id
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -240,51 +391,91 @@ def main():
         opts.val_batch_size = 1
 
     train_dst, val_dst = get_dataset(opts)
+    stats = None
+    if opts.class_aware_sampling or opts.rare_crop_prob > 0 or opts.class_weights != 'none':
+        stats = get_label_stats(opts, train_dst)
+    sampler = ClassAwareSampler(stats, power=opts.sampling_power) if opts.class_aware_sampling else None
     train_loader = data.DataLoader(
-        train_dst, batch_size=opts.batch_size, shuffle=True, num_workers=2,
+        train_dst, batch_size=opts.batch_size, shuffle=sampler is None, sampler=sampler, num_workers=2,
         drop_last=True)  # drop_last=True to ignore single-image batches.
     val_loader = data.DataLoader(
         val_dst, batch_size=opts.val_batch_size, shuffle=True, num_workers=2)
+    fast_val_loader = None
+    if opts.fast_val_samples > 0:
+        val_stats = LabelStats.load_or_compute(label_stats_path(opts, 'val'), val_dst, opts.num_classes)
+        fast_val_ids = val_stats.stratified_subset(opts.fast_val_samples, seed=opts.random_seed)
+        fast_val_loader = data.DataLoader(
+            data.Subset(val_dst, fast_val_ids), batch_size=opts.val_batch_size, shuffle=False, num_workers=2)
+        print("Fast validation on %d of %d val images" % (len(fast_val_ids), len(val_dst)))
     print("Dataset: %s, Train set: %d, Val set: %d" %
           (opts.dataset, len(train_dst), len(val_dst)))
 
     # Set up model (all models are 'constructed at network.modeling)
-    model = network.modeling.__dict__[opts.model](num_classes=opts.num_classes, output_stride=opts.output_stride)
-    if opts.separable_conv and 'plus' in opts.model:
-        network.convert_to_separable_conv(model.classifier)
+    model = build_model(opts)
+    checkpoint = None
+    if opts.ckpt is not None and os.path.isfile(opts.ckpt):
+        # https://github.com/VainF/DeepLabV3Plus-Pytorch/issues/8#issuecomment-605601402, @PytaichukBohdan
+        checkpoint = torch.load(opts.ckpt, map_location=torch.device('cpu'))
+        if checkpoint.get("pruning"):  # pruned channels, rebuilt before the decomposition and the optimizer
+            network.prune_channels(model, plan=checkpoint["pruning"])
+        if checkpoint.get("decomposition"):  # saved by decompose.py, rebuild its convs before the optimizer
+            network.decompose_convs(model, plan=checkpoint["decomposition"])
     utils.set_bn_momentum(model.backbone, momentum=0.01)
+    if opts.branch_workers > 1:
+        network.convert_to_parallel_branches(model, num_workers=opts.branch_workers)
 
     # Set up metrics
     metrics = StreamSegMetrics(opts.num_classes)
 
     # Set up optimizer
-    optimizer = torch.optim.SGD(params=[
-        {'params': model.backbone.parameters(), 'lr': 0.1 * opts.lr},
-        {'params': model.classifier.parameters(), 'lr': opts.lr},
-    ], lr=opts.lr, momentum=0.9, weight_decay=opts.weight_decay)
-    # optimizer = torch.optim.SGD(params=model.parameters(), lr=opts.lr, momentum=0.9, weight_decay=opts.weight_decay)
-    # torch.optim.lr_scheduler.StepLR(optimizer, step_size=opts.lr_decay_step, gamma=opts.lr_decay_factor)
-    if opts.lr_policy == 'poly':
-        scheduler = utils.PolyLR(optimizer, opts.total_itrs, power=0.9)
-    elif opts.lr_policy == 'step':
-        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=opts.step_size, gamma=0.1)
+    def make_optimizer():
+        """ optimizer and scheduler of the current parameters, rebuilt after every pruning step
+        """
+        optimizer = torch.optim.SGD(params=[
+            {'params': model.backbone.parameters(), 'lr': 0.1 * opts.lr},
+            {'params': model.classifier.parameters(), 'lr': opts.lr},
+        ], lr=opts.lr, momentum=0.9, weight_decay=opts.weight_decay)
+        # optimizer = torch.optim.SGD(params=model.parameters(), lr=opts.lr, momentum=0.9, weight_decay=opts.weight_decay)
+        # torch.optim.lr_scheduler.StepLR(optimizer, step_size=opts.lr_decay_step, gamma=opts.lr_decay_factor)
+        if opts.lr_policy == 'poly':
+            scheduler = utils.PolyLR(optimizer, opts.total_itrs, power=0.9)
+        elif opts.lr_policy == 'step':
+            scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=opts.step_size, gamma=0.1)
+        return optimizer, scheduler
+
+    optimizer, scheduler = make_optimizer()
 
     # Set up criterion
     # criterion = utils.get_loss(opts.loss_type)
-    if opts.loss_type == 'focal_loss':
-        criterion = utils.FocalLoss(ignore_index=255, size_average=True)
+    class_weights = stats.class_weights(opts.class_weights) if opts.class_weights != 'none' else None
+    if opts.loss_type == 'focal_loss' and opts.chunked_loss:
+        criterion = utils.ChunkedFocalLoss(ignore_index=255, size_average=True, weight=class_weights,
+                                           chunk_rows=opts.loss_chunk_rows)
+    elif opts.loss_type == 'focal_loss':
+        criterion = utils.FocalLoss(ignore_index=255, size_average=True, weight=class_weights)
+    elif opts.loss_type == 'cross_entropy' and opts.chunked_loss:
+        criterion = utils.ChunkedCrossEntropyLoss(weight=class_weights, ignore_index=255,
+                                                  chunk_rows=opts.loss_chunk_rows)
     elif opts.loss_type == 'cross_entropy':
-        criterion = nn.CrossEntropyLoss(ignore_index=255, reduction='mean')
+        criterion = nn.CrossEntropyLoss(weight=class_weights, ignore_index=255, reduction='mean')
+    elif opts.loss_type == 'ohem':
+        criterion = utils.OHEMCrossEntropyLoss(thresh=opts.ohem_thresh, min_kept=opts.ohem_min_kept,
+                                               weight=class_weights, ignore_index=255,
+                                               chunk_rows=opts.loss_chunk_rows)
+    criterion.to(device)
 
     def save_ckpt(path):
         """ save current model
         """
         torch.save({
             "cur_itrs": cur_itrs,
-            "model_state": model.module.state_dict(),
+            "model_state": model.state_dict(),
             "optimizer_state": optimizer.state_dict(),
             "scheduler_state": scheduler.state_dict(),
-            "best_score": best_score,
+            "best_score": float(best_score),
+            "pruning": getattr(model, 'pruning', None),
+            "prune_steps": prune_steps,
+            "decomposition": getattr(model, 'decomposition', None),
         }, path)
         print("Model saved as %s" % path)
 
@@ -293,9 +484,8 @@ def main():
     best_score = 0.0
     cur_itrs = 0
     cur_epochs = 0
-    if opts.ckpt is not None and os.path.isfile(opts.ckpt):
-        # https://github.com/VainF/DeepLabV3Plus-Pytorch/issues/8#issuecomment-605601402, @PytaichukBohdan
-        checkpoint = torch.load(opts.ckpt, map_location=torch.device('cpu'))
+    prune_steps = 0
+    if checkpoint is not None:
         model.load_state_dict(checkpoint["model_state"])
         # model = nn.DataParallel(model)
         model.to(device)
@@ -304,6 +494,8 @@ def main():
             scheduler.load_state_dict(checkpoint["scheduler_state"])
             cur_itrs = checkpoint["cur_itrs"]
             best_score = checkpoint['best_score']
+            if checkpoint.get("pruning"):  # pruning steps already done, older checkpoints did not save them
+                prune_steps = checkpoint.get("prune_steps", min(cur_itrs // opts.prune_every, opts.prune_cycles))
             print("Training state restored from %s" % opts.ckpt)
         print("Model restored from %s" % opts.ckpt)
         del checkpoint  # free memory
@@ -312,20 +504,37 @@ def main():
         # model = nn.DataParallel(model)
         model.to(device)
 
+    if opts.compile:
+        if opts.crop_val or val_dst.image_sizes is None:  # unknown val sizes are rounded up to their own bucket
+            val_sizes = [(opts.crop_size, opts.crop_size)]
+        else:
+            val_sizes = [(h, w) for w, h in val_dst.image_sizes]
+        val_buckets = network.ShapeBuckets.from_sizes(val_sizes, max_buckets=opts.compile_buckets)
+        buckets = network.ShapeBuckets([(opts.crop_size, opts.crop_size)] + val_buckets.shapes,
+                                       batch_size=opts.val_batch_size)
+        network.compile_model(model, buckets, backend=opts.compile_backend, mode=opts.compile_mode,
+                              cache_dir=opts.compile_cache_dir)
+        timings = network.warmup_compiled(model, device, train_batch_size=None if opts.test_only else opts.batch_size,
+                                          train_shapes=[(opts.crop_size, opts.crop_size)])
+        print("Compiled %s, %d variants in %.1fs, val padding %.1f%%" % (
+            buckets, len(timings), sum(t for _, _, t in timings), 100 * buckets.padding_ratio(val_sizes)))
+
     # ==========   Train Loop   ==========#
     vis_sample_id = np.random.randint(0, len(val_loader), opts.vis_num_samples,
                                       np.int32) if opts.enable_vis else None  # sample idxs for visualization
-    denorm = utils.Denormalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])  # denormalization for ori images
+    vis_lut = utils.label_lut(train_dst)  # colors of the visualized samples
 
     if opts.test_only:
         model.eval()
         val_score, ret_samples = validate(
             opts=opts, model=model, loader=val_loader, device=device, metrics=metrics, ret_samples_ids=vis_sample_id)
         print(metrics.to_str(val_score))
+        logger.close()
         return
 
-
-    writer = th.get_default_writer(0, True, opts.ckpt_dir)
+    prune_groups, prune_scores = None, None
+    if opts.prune_ratio > 0 and opts.prune_importance == 'taylor':
+        prune_groups, prune_scores = network.channel_groups(model, residual=opts.prune_residual), {}
 
     interval_loss = 0
     while True:  # cur_itrs < opts.total_itrs:
@@ -339,15 +548,21 @@ def main():
             labels = labels.to(device, dtype=torch.long)
 
             optimizer.zero_grad()
-            outputs = model(images)
+            if opts.train_at_decoder_res:
+                outputs = model(images, upsample=False)
+                labels = utils.downsample_labels(labels, outputs.shape[-2:], opts.num_classes,
+                                                 ignore_index=255, mode=opts.label_downsample)
+            else:
+                outputs = model(images)
             loss = criterion(outputs, labels)
             loss.backward()
+            if prune_scores is not None:
+                network.accumulate_taylor(prune_groups, prune_scores)
             optimizer.step()
 
             np_loss = loss.detach().cpu().numpy()
             interval_loss += np_loss
-            if vis is not None:
-                vis.vis_scalar('Loss', cur_itrs, np_loss)
+            logger.scalar('Loss', cur_itrs, np_loss)
 
             if (cur_itrs) % opts.print_interval == 0:
                 interval_loss = interval_loss / 10
@@ -360,36 +575,71 @@ def main():
                           (opts.model, opts.dataset, opts.output_stride))
                 print("validation...")
                 model.eval()
-                val_score, ret_samples = validate(
-                    opts=opts, model=model, loader=val_loader, device=device, metrics=metrics,
-                    ret_samples_ids=vis_sample_id)
-
-                writer.add_scalars('mIoU', {'val': val_score['Mean IoU']}, cur_itrs)
-                # writer.add_scalars('classIoU', {'val': val_score['Class IoU']}, cur_itrs)
-                writer.add_scalars('Acc', {'val': val_score['Overall Acc']}, cur_itrs)
-                writer.flush()
-
-                print(metrics.to_str(val_score))
-                if val_score['Mean IoU'] > best_score:  # save best model
-                    best_score = val_score['Mean IoU']
-                    save_ckpt(os.path.join(opts.ckpt_dir, 'best_%s_%s_os%d.pth') %
-                              (opts.model, opts.dataset, opts.output_stride))
-
-                if vis is not None:  # visualize validation score and samples
-                    vis.vis_scalar("[Val] Overall Acc", cur_itrs, val_score['Overall Acc'])
-                    vis.vis_scalar("[Val] Mean IoU", cur_itrs, val_score['Mean IoU'])
-                    vis.vis_table("[Val] Class IoU", val_score['Class IoU'])
+                full_val = True
+                if fast_val_loader is not None:
+                    fast_metrics = ImageSegMetrics(opts.num_classes)
+                    fast_score, _ = validate(
+                        opts=argparse.Namespace(**dict(vars(opts), save_val_results=False)), model=model,
+                        loader=fast_val_loader, device=device, metrics=fast_metrics)
+                    low, high = fast_metrics.bootstrap(opts.fast_val_bootstrap, opts.fast_val_ci)
+                    print("Fast val mIoU: %f, %d%% CI [%f, %f], best: %f" %
+                          (fast_score['Mean IoU'], 100 * opts.fast_val_ci, low, high, best_score))
+                    logger.scalar("[Fast Val] Mean IoU", cur_itrs, fast_score['Mean IoU'])
+                    full_val = high > best_score  # otherwise it cannot beat the best checkpoint
+                    if not full_val and opts.metrics_file is not None:  # the estimate, for the sweep pruning
+                        with open(opts.metrics_file, 'a') as f:
+                            f.write(json.dumps({'itrs': cur_itrs, 'Mean IoU': fast_score['Mean IoU'],
+                                                'Overall Acc': fast_score['Overall Acc'], 'val': 'subset',
+                                                'ci': [float(low), float(high)]}) + '\n')
+                if full_val:
+                    val_score, ret_samples = validate(
+                        opts=opts, model=model, loader=val_loader, device=device, metrics=metrics,
+                        ret_samples_ids=vis_sample_id)
+
+                    print(metrics.to_str(val_score))
+                    if opts.metrics_file is not None:
+                        with open(opts.metrics_file, 'a') as f:
+                            f.write(json.dumps({'itrs': cur_itrs, 'Mean IoU': val_score['Mean IoU'],
+                                                'Overall Acc': val_score['Overall Acc'], 'val': 'full'}) + '\n')
+                    if val_score['Mean IoU'] > best_score:  # save best model
+                        best_score = val_score['Mean IoU']
+                        save_ckpt(os.path.join(opts.ckpt_dir, 'best_%s_%s_os%d.pth') %
+                                  (opts.model, opts.dataset, opts.output_stride))
+
+                    # log validation score and samples
+                    logger.scalar("[Val] Overall Acc", cur_itrs, val_score['Overall Acc'])
+                    logger.scalar("[Val] Mean IoU", cur_itrs, val_score['Mean IoU'])
+                    logger.table("[Val] Class IoU", val_score['Class IoU'], cur_itrs)
 
                     for k, (img, target, lbl) in enumerate(ret_samples):
-                        img = (denorm(img) * 255).astype(np.uint8)
-                        target = train_dst.decode_target(target).transpose(2, 0, 1).astype(np.uint8)
-                        lbl = train_dst.decode_target(lbl).transpose(2, 0, 1).astype(np.uint8)
-                        concat_img = np.concatenate((img, target, lbl), axis=2)  # concat along width
-                        vis.vis_image('Sample %d' % k, concat_img)
+                        panels = utils.render_batch(img[None], target[None], lbl[None], vis_lut,
+                                                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+                        concat_img = np.concatenate((panels['image'][0], panels['target'][0], panels['pred'][0]),
+                                                    axis=1).transpose(2, 0, 1)  # concat along width
+                        logger.image('Sample %d' % k, concat_img, cur_itrs)
                 model.train()
             scheduler.step()
 
+            if opts.prune_ratio > 0 and prune_steps < opts.prune_cycles and cur_itrs % opts.prune_every == 0:
+                n_params = sum(p.numel() for p in model.parameters())
+                network.prune_channels(model, ratio=opts.prune_ratio, importance=opts.prune_importance,
+                                       scores=prune_scores, residual=opts.prune_residual,
+                                       min_channels=opts.prune_min_channels)
+                prune_steps += 1
+                # the pruned parameters are new tensors, the lr schedule continues where it was
+                scheduler_state = scheduler.state_dict()
+                optimizer, scheduler = make_optimizer()
+                scheduler.load_state_dict(scheduler_state)
+                for group, lr in zip(optimizer.param_groups, scheduler.get_last_lr()):
+                    group['lr'] = lr
+                if prune_scores is not None:
+                    prune_groups, prune_scores = network.channel_groups(model, residual=opts.prune_residual), {}
+                print("Pruning step %d/%d: %.2fM -> %.2fM params" % (
+                    prune_steps, opts.prune_cycles, n_params / 1e6, sum(p.numel() for p in model.parameters()) / 1e6))
+
             if cur_itrs >= opts.total_itrs:
+                logger.close()
+                print(logger.report())
                 return
 
 
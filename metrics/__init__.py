@@ -1,2 +1 @@
-from .stream_metrics import StreamSegMetrics, AverageMeter
-
+from .stream_metrics import StreamSegMetrics, ImageSegMetrics, AverageMeter
@@ -82,6 +82,43 @@ class StreamSegMetrics(_StreamMetrics):
     def reset(self):
         self.confusion_matrix = np.zeros((self.n_classes, self.n_classes))
 
+class ImageSegMetrics(StreamSegMetrics):
+    """
+    StreamSegMetrics that also keeps the confusion matrix of every image, for bootstrap
+    confidence intervals of the mIoU over the evaluated images
+    """
+    def __init__(self, n_classes):
+        super(ImageSegMetrics, self).__init__(n_classes)
+        self.image_hists = []
+
+    def update(self, label_trues, label_preds):
+        for lt, lp in zip(label_trues, label_preds):
+            hist = self._fast_hist(lt.flatten(), lp.flatten())
+            self.image_hists.append(hist)
+            self.confusion_matrix += hist
+
+    @staticmethod
+    def _mean_iu(hists):
+        diag = np.diagonal(hists, axis1=-2, axis2=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            iu = diag / (hists.sum(axis=-1) + hists.sum(axis=-2) - diag)
+        return np.nanmean(iu, axis=-1)
+
+    def bootstrap(self, n_boot=1000, ci=0.95, seed=0):
+        """(low, high) bounds of the ``ci`` confidence interval of the mIoU, resampling images"""
+        hists = np.stack(self.image_hists).astype(np.int64)
+        rng = np.random.RandomState(seed)
+        samples = np.empty(n_boot)
+        for b in range(n_boot):
+            counts = np.bincount(rng.randint(len(hists), size=len(hists)), minlength=len(hists))
+            samples[b] = self._mean_iu(np.tensordot(counts, hists, axes=1))
+        alpha = (1 - ci) / 2
+        return np.quantile(samples, alpha), np.quantile(samples, 1 - alpha)
+
+    def reset(self):
+        super(ImageSegMetrics, self).reset()
+        self.image_hists = []
+
 class AverageMeter(object):
     """Computes average values"""
     def __init__(self):
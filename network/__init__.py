@@ -1,2 +1,11 @@
 from .modeling import *
-from ._deeplab import convert_to_separable_conv
\ No newline at end of file
+from ._deeplab import convert_to_separable_conv, convert_to_fused_aspp
+from .video import VideoSegmenter
+from .parallel import convert_to_parallel_branches
+from .compiled import ShapeBuckets, compile_model, uncompile_model, warmup_compiled
+from .decompose import decompose_convs, conv_macs
+from .prune import prune_channels, channel_groups, accumulate_taylor
+from .search import resnet_configs, pareto_front
+from .cost import LatencyTable, trace_model, predict_cost
+from .space_to_batch import convert_to_space_to_batch, revert_space_to_batch
+from .upsample import UPSAMPLERS, make_upsampler
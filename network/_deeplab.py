@@ -2,8 +2,11 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 import numpy as np
+import torch.utils.checkpoint
 
-from .utils import _SimpleSegmentationModel
+from .utils import _SimpleSegmentationModel, _source_index
+from .parallel import run_branches
+from .upsample import UPSAMPLERS, make_upsampler, _Upsample2x
 
 
 __all__ = ["DeepLabV3"]
@@ -45,8 +48,16 @@ class Interpolate(nn.Module):
 
 class DeepLabHeadV3Plus(nn.Module):
     def __init__(self, in_channels, low_level_channels, num_classes, aspp_dilate=[12, 24, 36],
-                 fl_transpose=False, fl_transpose_odd=False, output_stride_lowlevel=4, output_stride_diff=4, **kwargs):
+                 fl_transpose=False, fl_transpose_odd=False, output_stride_lowlevel=4, output_stride_diff=4,
+                 upsampler='bilinear', **kwargs):
         super(DeepLabHeadV3Plus, self).__init__()
+        # upsampler: 'bilinear' (Interpolate), or a learned 2x upsampler per step, with BN/ReLU:
+        # 'transpose' (fl_transpose) or one of network/upsample.py
+        if fl_transpose and upsampler not in ('bilinear', 'transpose'):
+            raise ValueError('fl_transpose selects the transpose upsampler, not %s' % upsampler)
+        if upsampler not in UPSAMPLERS:
+            raise ValueError('Unknown upsampler %s, should be one of %s' % (upsampler, ', '.join(UPSAMPLERS)))
+        upsampler = 'transpose' if fl_transpose else upsampler
 
         self.project = nn.Sequential(
             nn.Conv2d(low_level_channels, 48, 1, bias=False),
@@ -55,21 +66,23 @@ class DeepLabHeadV3Plus(nn.Module):
         )
 
         self.aspp = ASPP(in_channels, aspp_dilate)
-        self.fl_transpose = fl_transpose
+        self.fl_transpose = upsampler == 'transpose'
+        self.upsampler = upsampler
+        self.learned_upsampling = upsampler != 'bilinear'
+
+        def upsample_block(odd=False):
+            if upsampler == 'transpose':
+                up = convT_doubleinputsize(256, 256, groups=256, ks=3 if odd else 4)
+            else:
+                up = make_upsampler(upsampler, 256, odd=odd)
+            return [up, nn.BatchNorm2d(256), nn.ReLU(inplace=True)]
 
         # First upsampling operation to turn high_level feats as the same low_level feats resolution
-        if fl_transpose and output_stride_diff > 1:
+        if self.learned_upsampling and output_stride_diff > 1:
             convT_block = []
             n_ups = int(np.log2(output_stride_diff))
             for i_up in range(n_ups):
-                if i_up == (n_ups - 1) and fl_transpose_odd:
-                    ks = 3
-                else:
-                    ks = 4
-                convT_block.extend([convT_doubleinputsize(256, 256, groups=256, ks=ks),
-                                    nn.BatchNorm2d(256),
-                                    nn.ReLU(inplace=True),
-                                    ])
+                convT_block.extend(upsample_block(odd=i_up == (n_ups - 1) and fl_transpose_odd))
             self.upsample_out = nn.Sequential(*convT_block)
         else:
             self.upsample_out = Interpolate(output_stride_diff)
@@ -82,14 +95,11 @@ class DeepLabHeadV3Plus(nn.Module):
         ]
 
         # Second upsampling operation conv to turn low_level feats as the same input resolution
-        if fl_transpose and output_stride_lowlevel > 1:
+        if self.learned_upsampling and output_stride_lowlevel > 1:
             convT_block = []
             n_ups = int(np.log2(output_stride_lowlevel))
             for _ in range(n_ups):
-                convT_block.extend([convT_doubleinputsize(256, 256, groups=256),
-                                    nn.BatchNorm2d(256),
-                                    nn.ReLU(inplace=True),
-                                    ])
+                convT_block.extend(upsample_block())
             self.classifier.extend(convT_block)
 
         self.classifier.append(nn.Conv2d(256, num_classes, 1))
@@ -98,12 +108,21 @@ class DeepLabHeadV3Plus(nn.Module):
         self._init_weight()
 
     def forward(self, feature):
-        low_level_feature = self.project(feature['low_level'])
-        output_feature = self.aspp(feature['out'])
-        if self.fl_transpose:
+        output_feature = self.forward_high(feature['out'], feature['low_level'].shape[2:])
+        return self.forward_low(feature['low_level'], output_feature)
+
+    def forward_high(self, out_feature, low_level_size):
+        """ ASPP features brought to the low-level resolution """
+        output_feature = self.aspp(out_feature)
+        if self.learned_upsampling:
             output_feature = self.upsample_out(output_feature)
         else:
-            output_feature = F.interpolate(output_feature, size=low_level_feature.shape[2:], mode='bilinear', align_corners=False)
+            output_feature = F.interpolate(output_feature, size=low_level_size, mode='bilinear', align_corners=False)
+        return output_feature
+
+    def forward_low(self, low_level_feature, output_feature):
+        """ fuses the low-level features with the output of ``forward_high`` """
+        low_level_feature = self.project(low_level_feature)
         return self.classifier(torch.cat([low_level_feature, output_feature], dim=1))
     
     def _init_weight(self):
@@ -113,6 +132,9 @@ class DeepLabHeadV3Plus(nn.Module):
             elif isinstance(m, (nn.BatchNorm2d, nn.GroupNorm)):
                 nn.init.constant_(m.weight, 1)
                 nn.init.constant_(m.bias, 0)
+        for m in self.modules():  # the learned upsamplers start bilinear
+            if isinstance(m, _Upsample2x):
+                m.reset_bilinear()
 
 class DeepLabHead(nn.Module):
     def __init__(self, in_channels, num_classes, aspp_dilate=[12, 24, 36]):
@@ -173,6 +195,18 @@ class ASPPConv(nn.Sequential):
         ]
         super(ASPPConv, self).__init__(*modules)
 
+
+def atrous_conv(conv):
+    """ the dilated ``nn.Conv2d`` of an ASPP branch conv: ``conv`` itself, the depthwise conv of
+    an ``AtrousSeparableConvolution`` or the first conv of a decomposition (``network.decompose``) """
+    if isinstance(conv, AtrousSeparableConvolution):
+        conv = conv.body[0]
+    elif isinstance(conv, nn.Sequential):
+        conv = conv[0]
+    if not isinstance(conv, nn.Conv2d):
+        raise ValueError('Unsupported ASPP branch conv %s' % type(conv).__name__)
+    return conv
+
 class ASPPPooling(nn.Sequential):
     def __init__(self, in_channels, out_channels):
         super(ASPPPooling, self).__init__(
@@ -186,7 +220,13 @@ class ASPPPooling(nn.Sequential):
         x = super(ASPPPooling, self).forward(x)
         return F.interpolate(x, size=size, mode='bilinear', align_corners=False)
 
+    def forward_pooled(self, x):
+        """ returns the (N, C, 1, 1) map without expanding it to the input size """
+        return super(ASPPPooling, self).forward(x)
+
 class ASPP(nn.Module):
+    branch_workers = 1  # concurrent branches, see network.convert_to_parallel_branches
+
     def __init__(self, in_channels, atrous_rates):
         super(ASPP, self).__init__()
         out_channels = 256
@@ -211,17 +251,193 @@ class ASPP(nn.Module):
             nn.Dropout(0.1),)
 
     def forward(self, x):
-        res = []
-        for conv in self.convs:
-            res.append(conv(x))
+        res = run_branches([(conv, (x,)) for conv in self.convs], self.branch_workers)
         res = torch.cat(res, dim=1)
         return self.project(res)
 
+    def branch_channels(self):
+        """ output channels of each branch, 256 unless pruned """
+        return [[m for m in conv.modules() if isinstance(m, nn.BatchNorm2d)][0].num_features for conv in self.convs]
+
+
+class FusedASPP(ASPP):
+    """ ASPP with the projection folded into each branch
+
+    The 1x1 ``project`` conv over the concatenated branches equals the sum of
+    per-branch 1x1 convs over the matching slices of its weight, so every branch
+    is projected right away and accumulated into a single 256-channel buffer
+    instead of materializing the 5*256-channel concat. The pooling branch is
+    constant over space and is broadcast-added rather than interpolated.
+
+    Parameters and buffers are the ones of ``ASPP``, so existing checkpoints load
+    unchanged. With ``num_workers > 1`` the independent branches run concurrently
+    on a thread pool (torch ops release the GIL).
+    """
+    def __init__(self, in_channels, atrous_rates, num_workers=1):
+        super(FusedASPP, self).__init__(in_channels, atrous_rates)
+        self.branch_workers = num_workers
+
+    @property
+    def num_workers(self):
+        return self.branch_workers
+
+    @classmethod
+    def from_aspp(cls, aspp, num_workers=1):
+        """ builds a FusedASPP sharing the modules (and weights) of ``aspp`` """
+        in_channels = aspp.convs[0][0].in_channels
+        atrous_rates = [atrous_conv(aspp.convs[i][0]).dilation[0] for i in range(1, 4)]
+        fused = cls(in_channels, atrous_rates, num_workers=num_workers)
+        fused.convs = aspp.convs
+        fused.project = aspp.project
+        fused.train(aspp.training)
+        return fused
+
+    def _branch(self, conv, weight, x):
+        if isinstance(conv, ASPPPooling):
+            return F.conv2d(conv.forward_pooled(x), weight)
+        return F.conv2d(conv(x), weight)
+
+    def forward(self, x):
+        weights = self.project[0].weight.split(self.branch_channels(), dim=1)
+        res = run_branches([(self._branch, (conv, w, x)) for conv, w in zip(self.convs, weights)],
+                           self.branch_workers)
+
+        out = res[0]
+        for r in res[1:]:
+            out.add_(r)  # the pooling branch (N, C, 1, 1) broadcasts here
+        return self.project[1:](out)
+
+
+class StreamASPP(ASPP):
+    """ ASPP over the multi-resolution streams of HRNetV2, without their upsampled concat
+
+    HRNetV2 bilinearly upsamples its streams to the highest resolution and concatenates
+    them (15c channels at 1/4 resolution) before the ASPP. StreamASPP takes the list of
+    streams instead:
+
+    * the 1x1 branch runs on each stream before upsampling (a 1x1 conv commutes with
+      bilinear upsampling), and the pooling branch averages each stream with the weight
+      bilinear upsampling gives to each of its pixels. Both are exact.
+    * the atrous branches do not commute with upsampling. By default they accumulate
+      their conv over ``chunk_channels`` upsampled channels at a time, which is exact.
+      With ``fusion_channels`` the streams are instead projected to ``fusion_channels``,
+      upsampled and summed, and the atrous convs run on that reduced fusion (different
+      weights, the model has to be trained that way).
+    * the projection is folded into each branch as in ``FusedASPP``.
+
+    Without ``fusion_channels`` the parameters are the ones of ``ASPP``, so existing
+    checkpoints load unchanged.
+    """
+    def __init__(self, stream_channels, atrous_rates, fusion_channels=None, chunk_channels=64):
+        super(StreamASPP, self).__init__(sum(stream_channels), atrous_rates)
+        self.stream_channels = list(stream_channels)
+        self.fusion_channels = fusion_channels
+        self.chunk_channels = chunk_channels
+        if fusion_channels is not None:
+            out_channels = self.convs[0][0].out_channels
+            self.reduce = nn.ModuleList([nn.Conv2d(c, fusion_channels, 1, bias=False) for c in stream_channels])
+            self.reduce_bn = nn.Sequential(nn.BatchNorm2d(fusion_channels), nn.ReLU(inplace=True))
+            for i, rate in enumerate(atrous_rates):
+                self.convs[1 + i] = ASPPConv(fusion_channels, out_channels, rate)
+
+    @classmethod
+    def from_aspp(cls, aspp, stream_channels, chunk_channels=64):
+        """ builds an exact StreamASPP sharing the modules (and weights) of ``aspp`` """
+        atrous_rates = [atrous_conv(aspp.convs[i][0]).dilation[0] for i in range(1, 4)]
+        stream_aspp = cls(stream_channels, atrous_rates, chunk_channels=chunk_channels)
+        stream_aspp.convs = aspp.convs
+        stream_aspp.project = aspp.project
+        stream_aspp.train(aspp.training)
+        return stream_aspp
+
+    @staticmethod
+    def _upsample(x, size):
+        if x.shape[-2:] == size:
+            return x
+        return F.interpolate(x, size=size, mode='bilinear', align_corners=False)
+
+    @staticmethod
+    def _pool_weights(in_size, out_size, x):
+        """ weight of each input row (or column) in the mean of the upsampled map """
+        idx0, idx1, lambda1 = _source_index(in_size, out_size, x.device)
+        weights = torch.zeros(in_size, device=x.device, dtype=x.dtype)
+        weights.index_add_(0, idx0, (1 - lambda1).to(x.dtype))
+        weights.index_add_(0, idx1, lambda1.to(x.dtype))
+        return weights / out_size
+
+    def _pooled(self, xs, size):
+        pooled = [torch.einsum('nchw,h,w->nc', x, self._pool_weights(x.shape[2], size[0], x),
+                               self._pool_weights(x.shape[3], size[1], x)) for x in xs]
+        return torch.cat(pooled, dim=1)[:, :, None, None]
+
+    @staticmethod
+    def _after_conv(branch, x):
+        """ the layers of ``branch`` following its conv (BN, ReLU), in place at inference """
+        for module in list(branch)[1:]:
+            if isinstance(module, nn.BatchNorm2d) and not module.training and not torch.is_grad_enabled():
+                scale = module.weight / torch.sqrt(module.running_var + module.eps)
+                x = x.mul_(scale.view(-1, 1, 1)).add_((module.bias - module.running_mean * scale).view(-1, 1, 1))
+            else:
+                x = module(x)
+        return x
+
+    def _atrous_conv(self, conv, size, *xs):
+        """ conv of the upsampled concat, accumulated over slices of upsampled channels """
+        out = None
+        for x, w in zip(xs, conv.weight.split(self.stream_channels, dim=1)):
+            chunk = x.shape[1] if x.shape[-2:] == size else self.chunk_channels
+            for c0 in range(0, x.shape[1], chunk):
+                y = F.conv2d(self._upsample(x[:, c0:c0 + chunk], size), w[:, c0:c0 + chunk], None,
+                             conv.stride, conv.padding, conv.dilation)
+                out = y if out is None else out.add_(y)
+                del y
+        return out
+
+    def forward(self, xs):
+        size = xs[0].shape[-2:]
+        project = self.project[0].weight.split(self.branch_channels(), dim=1)
+
+        # 1x1 branch: convolve each stream, then upsample
+        y = None
+        for x, w in zip(xs, self.convs[0][0].weight.split(self.stream_channels, dim=1)):
+            z = self._upsample(F.conv2d(x, w), size)
+            y = z if y is None else y.add_(z)
+        out = F.conv2d(self._after_conv(self.convs[0], y), project[0])
+        del y, z  # one full size map alive per step
+
+        # atrous branches
+        fused = concat = None
+        if self.fusion_channels is not None:
+            for x, reduce in zip(xs, self.reduce):
+                z = self._upsample(reduce(x), size)
+                fused = z if fused is None else fused.add_(z)
+            fused = self.reduce_bn(fused)
+            del z
+        for branch, w in zip(self.convs[1:4], project[1:4]):
+            if fused is not None:
+                y = branch(fused)
+            elif isinstance(branch[0], nn.Conv2d):
+                if self.training and torch.is_grad_enabled():  # recompute the upsampled slices in backward
+                    y = torch.utils.checkpoint.checkpoint(self._atrous_conv, branch[0], size, *xs, use_reentrant=False)
+                else:
+                    y = self._atrous_conv(branch[0], size, *xs)
+                y = self._after_conv(branch, y)
+            else:  # e.g. separable convs, run on the concat
+                if concat is None:
+                    concat = torch.cat([self._upsample(x, size) for x in xs], dim=1)
+                y = branch(concat)
+            out = out.add_(F.conv2d(y, w))
+            del y
+
+        # pooling branch, constant over space: broadcast
+        pooled = self._after_conv(self.convs[4], self._pooled(xs, size))
+        out = out.add_(F.conv2d(pooled, project[4]))
+        return self.project[1:](out)
 
 
 def convert_to_separable_conv(module):
     new_module = module
-    if isinstance(module, nn.Conv2d) and module.kernel_size[0]>1:
+    if isinstance(module, nn.Conv2d) and module.kernel_size[0]>1 and module.groups == 1:  # depthwise convs are kept
         new_module = AtrousSeparableConvolution(module.in_channels,
                                       module.out_channels, 
                                       module.kernel_size,
@@ -232,3 +448,12 @@ def convert_to_separable_conv(module):
     for name, child in module.named_children():
         new_module.add_module(name, convert_to_separable_conv(child))
     return new_module
+
+
+def convert_to_fused_aspp(module, num_workers=1):
+    """ Replaces every ``ASPP`` in ``module`` by a ``FusedASPP`` sharing its weights """
+    if isinstance(module, ASPP) and not isinstance(module, (FusedASPP, StreamASPP)):
+        return FusedASPP.from_aspp(module, num_workers=num_workers)
+    for name, child in module.named_children():
+        module.add_module(name, convert_to_fused_aspp(child, num_workers=num_workers))
+    return module
@@ -3,6 +3,8 @@ from torch import nn
 import torch.nn.functional as F
 import os
 
+from ..parallel import run_branches
+
 __all__ = ['HRNet', 'hrnetv2_48', 'hrnetv2_32']
 
 # Checkpoint path of pre-trained backbone (edit to your path). Download backbone pretrained model hrnetv2-32 @
@@ -82,6 +84,9 @@ class BasicBlock(nn.Module):
 
 
 class StageModule(nn.Module):
+    branch_workers = 1  # concurrent branches and fusions, see network.convert_to_parallel_branches
+    group_fusion = False  # one conv for the upsampling fusions of each branch, in eval mode
+
     def __init__(self, stage, output_branches, c):
         super(StageModule, self).__init__()
 
@@ -139,9 +144,42 @@ class StageModule(nn.Module):
 
         self.relu = nn.ReLU(inplace=True)
 
+    def _grouped_upsampling(self, j, x):
+        """ The 1x1 conv + BN fusions of branch ``j`` towards every higher resolution output,
+        as a single conv with the BatchNorms folded in (eval mode) """
+        targets = range(min(j, self.output_branches))
+        weights, biases = [], []
+        for i in targets:
+            conv, bn = self.fuse_layers[i][j][0], self.fuse_layers[i][j][1]
+            scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+            weights.append(conv.weight * scale.view(-1, 1, 1, 1))
+            biases.append(bn.bias - bn.running_mean * scale)
+        out = F.conv2d(x, torch.cat(weights), torch.cat(biases))
+        out = out.split([w.shape[0] for w in weights], dim=1)
+        return [F.interpolate(o, scale_factor=2 ** (j - i), mode='nearest') for i, o in zip(targets, out)]
+
+    def _fuse(self, i, x, upsampled):
+        """ output branch ``i``: sum of the fusions of every branch, then ReLU """
+        out = None
+        for j in range(self.number_of_branches):
+            y = upsampled[j][i] if j in upsampled and i < j else self.fuse_layers[i][j](x[j])
+            out = y if out is None else out + y
+        return self.relu(out)
+
     def forward(self, x):
 
         # input to each stage is a list of inputs for each branch
+        if self.branch_workers > 1 or self.group_fusion:
+            x = run_branches([(branch, (branch_input,)) for branch, branch_input in zip(self.branches, x)],
+                             self.branch_workers)
+            upsampled = {}
+            if self.group_fusion and not self.training:
+                ups = run_branches([(self._grouped_upsampling, (j, x[j])) for j in range(1, self.number_of_branches)],
+                                   self.branch_workers)
+                upsampled = dict(zip(range(1, self.number_of_branches), ups))
+            return run_branches([(self._fuse, (i, x, upsampled)) for i in range(self.output_branches)],
+                                self.branch_workers)
+
         x = [branch(branch_input) for branch, branch_input in zip(self.branches, x)]
 
         x_fused = []
@@ -34,14 +34,83 @@ def _make_divisible(v, divisor, min_value=None):
 
 
 class ConvBNReLU(nn.Sequential):
-    def __init__(self, in_planes, out_planes, kernel_size=3, stride=1, dilation=1, groups=1):
+    def __init__(self, in_planes, out_planes, kernel_size=3, stride=1, dilation=1, groups=1, padding=0):
         #padding = (kernel_size - 1) // 2
         super(ConvBNReLU, self).__init__(
-            nn.Conv2d(in_planes, out_planes, kernel_size, stride, 0, dilation=dilation, groups=groups, bias=False),
+            nn.Conv2d(in_planes, out_planes, kernel_size, stride, padding, dilation=dilation, groups=groups, bias=False),
             nn.BatchNorm2d(out_planes),
             nn.ReLU6(inplace=True)
         )
 
+DEFAULT_INVERTED_RESIDUAL_SETTING = [
+    # t, c, n, s
+    [1, 16, 1, 1],
+    [6, 24, 2, 2],
+    [6, 32, 3, 2],
+    [6, 64, 4, 2],
+    [6, 96, 3, 1],
+    [6, 160, 3, 2],
+    [6, 320, 1, 1],
+]
+
+
+def _block_strides(inverted_residual_setting, output_stride):
+    """ (stride, dilation) of every inverted residual block, after the stride-2 stem """
+    current_stride = 2
+    dilation = 1
+    strides = []
+    for t, c, n, s in inverted_residual_setting:
+        previous_dilation = dilation
+        if current_stride == output_stride:
+            stride = 1
+            dilation *= s
+        else:
+            stride = s
+            current_stride *= s
+        strides.append((stride, previous_dilation))
+        strides.extend([(1, dilation)] * (n - 1))
+    return strides
+
+
+def set_blocks_output_stride(blocks, output_stride, inverted_residual_setting=None):
+    """ Re-configures stride and dilation of built ``InvertedResidual`` blocks in place
+
+    Args:
+        blocks (list): all inverted residual blocks of the network, in order
+        output_stride (int): the new output stride
+    """
+    if inverted_residual_setting is None:
+        inverted_residual_setting = DEFAULT_INVERTED_RESIDUAL_SETTING
+    block_strides = _block_strides(inverted_residual_setting, output_stride)
+    if len(block_strides) != len(blocks):
+        raise ValueError("inverted_residual_setting does not match the given blocks")
+    for block, (stride, dilation) in zip(blocks, block_strides):
+        dw = _depthwise_conv(block)
+        dw.stride = (stride, stride)
+        dw.dilation = (dilation, dilation)
+        block.stride = stride
+        block.input_padding = fixed_padding(3, dilation)
+        dw.padding = (dilation, dilation) if block.pad_in_conv else (0, 0)
+
+
+def set_blocks_padding(blocks, pad_in_conv=True):
+    """ Moves the padding of built ``InvertedResidual`` blocks into their depthwise conv
+    (``pad_in_conv=True``) or back to a padded copy of the block input
+
+    The weights are unchanged. Padded in the conv, the depthwise conv sees zeros around
+    the expanded features; padded before the block, it sees the expansion of zeros
+    (``ReLU6(BN(0))``), so the two differ along the borders.
+    """
+    for block in blocks:
+        dilation = _depthwise_conv(block).dilation[0]
+        _depthwise_conv(block).padding = (dilation, dilation) if pad_in_conv else (0, 0)
+        block.pad_in_conv = pad_in_conv
+
+
+def _depthwise_conv(block):
+    return [m for m in block.conv.modules() if isinstance(m, nn.Conv2d) and m.groups > 1][0]
+
+
 def fixed_padding(kernel_size, dilation):
     kernel_size_effective = kernel_size + (kernel_size - 1) * (dilation - 1)
     pad_total = kernel_size_effective - 1
@@ -50,9 +119,10 @@ def fixed_padding(kernel_size, dilation):
     return (pad_beg, pad_end, pad_beg, pad_end) 
 
 class InvertedResidual(nn.Module):
-    def __init__(self, inp, oup, stride, dilation, expand_ratio):
+    def __init__(self, inp, oup, stride, dilation, expand_ratio, pad_in_conv=False):
         super(InvertedResidual, self).__init__()
         self.stride = stride
+        self.pad_in_conv = pad_in_conv
         assert stride in [1, 2]
 
         hidden_dim = int(round(inp * expand_ratio))
@@ -65,7 +135,8 @@ class InvertedResidual(nn.Module):
 
         layers.extend([
             # dw
-            ConvBNReLU(hidden_dim, hidden_dim, stride=stride, dilation=dilation, groups=hidden_dim),
+            ConvBNReLU(hidden_dim, hidden_dim, stride=stride, dilation=dilation, groups=hidden_dim,
+                       padding=dilation if pad_in_conv else 0),
             # pw-linear
             nn.Conv2d(hidden_dim, oup, 1, 1, 0, bias=False),
             nn.BatchNorm2d(oup),
@@ -75,14 +146,16 @@ class InvertedResidual(nn.Module):
         self.input_padding = fixed_padding( 3, dilation )
 
     def forward(self, x):
-        x_pad = F.pad(x, self.input_padding)
+        # 3x3 kernels: the padding is symmetric, the depthwise conv can pad without a copy
+        x_pad = x if self.pad_in_conv else F.pad(x, self.input_padding)
         if self.use_res_connect:
             return x + self.conv(x_pad)
         else:
             return self.conv(x_pad)
 
 class MobileNetV2(nn.Module):
-    def __init__(self, num_classes=1000, output_stride=8, width_mult=1.0, inverted_residual_setting=None, round_nearest=8):
+    def __init__(self, num_classes=1000, output_stride=8, width_mult=1.0, inverted_residual_setting=None, round_nearest=8,
+                 pad_in_conv=False):
         """
         MobileNet V2 main class
 
@@ -92,24 +165,15 @@ class MobileNetV2(nn.Module):
             inverted_residual_setting: Network structure
             round_nearest (int): Round the number of channels in each layer to be a multiple of this number
             Set to 1 to turn off rounding
+            pad_in_conv (bool): pad in the depthwise convs instead of padding a copy of every block input
         """
         super(MobileNetV2, self).__init__()
         block = InvertedResidual
         input_channel = 32
         last_channel = 1280
         self.output_stride = output_stride
-        current_stride = 1
         if inverted_residual_setting is None:
-            inverted_residual_setting = [
-                # t, c, n, s
-                [1, 16, 1, 1],
-                [6, 24, 2, 2],
-                [6, 32, 3, 2],
-                [6, 64, 4, 2],
-                [6, 96, 3, 1],
-                [6, 160, 3, 2],
-                [6, 320, 1, 1],
-            ]
+            inverted_residual_setting = DEFAULT_INVERTED_RESIDUAL_SETTING
 
         # only check the first element, assuming user knows t,c,n,s are required
         if len(inverted_residual_setting) == 0 or len(inverted_residual_setting[0]) != 4:
@@ -120,27 +184,16 @@ class MobileNetV2(nn.Module):
         input_channel = _make_divisible(input_channel * width_mult, round_nearest)
         self.last_channel = _make_divisible(last_channel * max(1.0, width_mult), round_nearest)
         features = [ConvBNReLU(3, input_channel, stride=2)]
-        current_stride *= 2
-        dilation=1
-        previous_dilation = 1
+        block_strides = iter(_block_strides(inverted_residual_setting, output_stride))
 
         # building inverted residual blocks
         for t, c, n, s in inverted_residual_setting:
             output_channel = _make_divisible(c * width_mult, round_nearest)
-            previous_dilation = dilation
-            if current_stride == output_stride:
-                stride = 1
-                dilation *= s
-            else:
-                stride = s
-                current_stride *= s
-            output_channel = int(c * width_mult)
 
             for i in range(n):
-                if i==0:
-                    features.append(block(input_channel, output_channel, stride, previous_dilation, expand_ratio=t))
-                else:
-                    features.append(block(input_channel, output_channel, 1, dilation, expand_ratio=t))
+                stride, dilation = next(block_strides)
+                features.append(block(input_channel, output_channel, stride, dilation, expand_ratio=t,
+                                      pad_in_conv=pad_in_conv))
                 input_channel = output_channel
         # building last several layers
         features.append(ConvBNReLU(input_channel, self.last_channel, kernel_size=1))
@@ -184,6 +237,8 @@ def mobilenet_v2(pretrained=False, progress=True, **kwargs):
     """
     model = MobileNetV2(**kwargs)
     if pretrained:
+        if kwargs.get('width_mult', 1.0) != 1.0:
+            raise ValueError('ImageNet weights are only available for width_mult=1.0')
         state_dict = load_state_dict_from_url(model_urls['mobilenet_v2'],
                                               progress=progress)
         model.load_state_dict(state_dict)
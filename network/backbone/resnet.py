@@ -1,5 +1,7 @@
 import torch
 import torch.nn as nn
+
+from ..parallel import run_branches
 try:  # for torchvision<0.4
     from torchvision.models.utils import load_state_dict_from_url
 except:  # for torchvision>=0.4
@@ -175,6 +177,8 @@ class StemBlock1(nn.Module):
 
 
 class StemBlock2(nn.Module):
+    branch_workers = 1  # concurrent branches, see network.convert_to_parallel_branches
+
     def __init__(self, inplanes, planes, stride=2, channel_reduction=16, dilation=1):
         super().__init__()
         self.conv1 = conv1x1(inplanes, planes[0], stride=stride)
@@ -202,26 +206,27 @@ class StemBlock2(nn.Module):
         self.conv5 = conv1x1(sum(planes), 64, stride=1)
         self.bn5 = nn.BatchNorm2d(64)
 
-    def forward(self, x):
-        identity = x
+    def _branch1(self, x):
+        return self.bn1(self.conv1(x))
 
-        out_1 = self.conv1(x)
-        out_1 = self.bn1(out_1)
+    def _branch2(self, x):
+        return self.bn2(self.conv2_2(self.conv2_1(x)))
 
-        out_2 = self.conv2_1(x)
-        out_2 = self.conv2_2(out_2)
-        out_2 = self.bn2(out_2)
+    def _branch3(self, x):
+        return self.bn3(self.conv3_2(self.conv3_1(x)))
 
-        out_3 = self.conv3_1(x)
-        out_3 = self.conv3_2(out_3)
-        out_3 = self.bn3(out_3)
+    def _branch4(self, x):
+        return self.bn4(self.conv4(self.maxpool(x)))
 
-        out_4 = self.maxpool(x)
-        out_4 = self.conv4(out_4)
-        out_4 = self.bn4(out_4)
+    def forward(self, x):
+        identity = x
+
+        *outs, shortcut = run_branches([(self._branch1, (x,)), (self._branch2, (x,)), (self._branch3, (x,)),
+                                        (self._branch4, (x,)), (self.downsample, (identity,))],
+                                       self.branch_workers)
 
-        out = torch.cat([out_1, out_2, out_3, out_4], dim=1)
-        out += self.downsample(identity)
+        out = torch.cat(outs, dim=1)
+        out += shortcut
         out = self.relu(out)
 
         out = self.conv5(out)
@@ -256,6 +261,8 @@ class ClassicStem(nn.Module):
 
 
 class ParallelStem(nn.Module):
+    branch_workers = 1  # concurrent branches, see network.convert_to_parallel_branches
+
     def __init__(self, **kwargs):
         super().__init__()
         self.classic = ClassicStem()
@@ -263,7 +270,8 @@ class ParallelStem(nn.Module):
         self.rich = StemBlock3()
 
     def forward(self, x):
-        return self.classic(x) + self.rich(x)
+        classic, rich = run_branches([(self.classic, (x,)), (self.rich, (x,))], self.branch_workers)
+        return classic + rich
 
 
 class ResNet(nn.Module):
@@ -330,30 +338,10 @@ class ResNet(nn.Module):
                     nn.init.constant_(m.bn2.weight, 0)
 
     def _make_layer(self, block, planes, blocks, stride=1, dilate=False, block_id=None):
-        if self.fl_lfe and block_id is not None:
-            assert block_id in [2, 3, 4], 'LFE is only used in the blocks 2, 3, 4.'
-            if block_id == 2:
-                lfe_factors = [1, 2, 2, 1]
-            elif block_id == 3:
-                lfe_factors = [1, 2, 3, 3, 2, 1]
-            elif block_id == 4:
-                lfe_factors = [1, 2, 1]
-
         norm_layer = self._norm_layer
         downsample = None
-        previous_dilation = self.dilation
-
-        if dilate:
-            if self.fl_lfe and block_id > 2:
-                if block_id == 3:
-                    self.dilation = self.output_stride_diff / self.dilation
-                elif self.dilation > 1:
-                    self.dilation /= stride
-                else:
-                    pass
-            else:
-                self.dilation *= stride
-            stride = 1
+        stride, self.dilation, list_dilations = _layer_dilations(
+            self.dilation, blocks, stride, dilate, block_id, self.fl_lfe, self.output_stride_diff)
 
         if stride != 1 or self.inplanes != planes * block.expansion:
             downsample = nn.Sequential(
@@ -361,21 +349,6 @@ class ResNet(nn.Module):
                 norm_layer(planes * block.expansion),
             )
 
-        list_dilations = []
-        if self.fl_lfe and block_id is not None:
-            for f in lfe_factors:
-                if f == 1:
-                    list_dilations.append(1)
-                elif f == 2:
-                    list_dilations.append(self.dilation)
-                elif f == 3:
-                    list_dilations.append(2 * self.dilation - 1)
-        else:
-            list_dilations = [previous_dilation]
-            list_dilations.extend([self.dilation for _ in range(1, blocks)])
-
-        list_dilations = [int(d) for d in list_dilations]
-
         layers = []
         layers.append(block(self.inplanes, planes, stride, downsample, self.groups,
                             self.base_width, list_dilations[0], norm_layer))
@@ -404,6 +377,80 @@ class ResNet(nn.Module):
         return x
 
 
+def _layer_dilations(dilation, blocks, stride=1, dilate=False, block_id=None, fl_lfe=False, output_stride_diff=8):
+    """Stride and dilation bookkeeping of ``ResNet._make_layer``
+
+    Returns the stride of the first block, the dilation carried over to the next
+    layer and the dilation of every block in the layer.
+    """
+    if fl_lfe and block_id is not None:
+        assert block_id in [2, 3, 4], 'LFE is only used in the blocks 2, 3, 4.'
+        if block_id == 2:
+            lfe_factors = [1, 2, 2, 1]
+        elif block_id == 3:
+            lfe_factors = [1, 2, 3, 3, 2, 1]
+        elif block_id == 4:
+            lfe_factors = [1, 2, 1]
+
+    previous_dilation = dilation
+
+    if dilate:
+        if fl_lfe and block_id > 2:
+            if block_id == 3:
+                dilation = output_stride_diff / dilation
+            elif dilation > 1:
+                dilation /= stride
+            else:
+                pass
+        else:
+            dilation *= stride
+        stride = 1
+
+    list_dilations = []
+    if fl_lfe and block_id is not None:
+        for f in lfe_factors:
+            if f == 1:
+                list_dilations.append(1)
+            elif f == 2:
+                list_dilations.append(dilation)
+            elif f == 3:
+                list_dilations.append(2 * dilation - 1)
+    else:
+        list_dilations = [previous_dilation]
+        list_dilations.extend([dilation for _ in range(1, blocks)])
+
+    list_dilations = [int(d) for d in list_dilations]
+    return stride, dilation, list_dilations
+
+
+def set_layers_dilation(layers, replace_stride_with_dilation, fl_lfe=False, output_stride_diff=8):
+    """Re-configures strides and dilations of built ``layer2``-``layer4`` in place
+
+    Args:
+        layers (list): the ``layer2``, ``layer3`` and ``layer4`` modules of a ResNet
+        replace_stride_with_dilation (list): same meaning as in ``ResNet``
+    """
+    dilation = 1
+    for block_id, layer, dilate in zip([2, 3, 4], layers, replace_stride_with_dilation):
+        stride, dilation, list_dilations = _layer_dilations(
+            dilation, len(layer), 2, dilate, block_id, fl_lfe, output_stride_diff)
+        for i, (block, d) in enumerate(zip(layer, list_dilations)):
+            block_stride = stride if i == 0 else 1
+            if isinstance(block, Bottleneck):
+                convs, strided = [block.conv2], block.conv2
+            else:
+                convs, strided = [block.conv1, block.conv2], block.conv1
+            for conv in convs:
+                conv.dilation = (d, d)
+                conv.padding = (d, d)
+            strided.stride = (block_stride, block_stride)
+            block.stride = block_stride
+            if block.downsample is not None:
+                block.downsample[0].stride = (block_stride, block_stride)
+            elif block_stride != 1:
+                raise ValueError('Block without downsample path cannot be strided')
+
+
 def _resnet(arch, block, layers, pretrained, progress, **kwargs):
     model = ResNet(block, layers, **kwargs)
 
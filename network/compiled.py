@@ -0,0 +1,171 @@
+import os
+import time
+import warnings
+from collections import Counter
+
+import torch
+import torch.nn.functional as F
+
+#
+#  torch.compile with a fixed set of input shapes
+#
+
+
+def _round_up(v, multiple):
+    return -(-v // multiple) * multiple
+
+
+class ShapeBuckets(object):
+    """ Small set of input sizes that every input is zero-padded (bottom and right) to
+
+    A compiled graph is specialized to one input shape, so variable image sizes (VOC
+    val, folders of images) would recompile at every new size. Padding to a few
+    buckets bounds the number of graphs; the outputs are cropped back to the input size.
+
+    Arguments:
+        shapes (list): (H, W) bucket sizes, rounded up to ``multiple``.
+        multiple (int): sizes are multiples of it, 32 keeps every output stride aligned.
+        batch_size (int, optional): in eval mode smaller batches (e.g. the last one of a
+            loader) are padded to this size too.
+    """
+    def __init__(self, shapes, multiple=32, batch_size=None):
+        self.multiple = multiple
+        self.batch_size = batch_size
+        self.shapes = sorted({(_round_up(h, multiple), _round_up(w, multiple)) for h, w in shapes},
+                             key=lambda s: (s[0] * s[1], s))
+
+    @classmethod
+    def from_sizes(cls, sizes, max_buckets=4, multiple=32, batch_size=None):
+        """ Picks at most ``max_buckets`` shapes for the (H, W) ``sizes`` of a dataset,
+        greedily minimizing the number of padded pixels. The largest size always fits. """
+        counts = Counter((_round_up(h, multiple), _round_up(w, multiple)) for h, w in sizes)
+        chosen = [(max(h for h, _ in counts), max(w for _, w in counts))]
+
+        def cost(buckets):
+            return sum(n * min(bh * bw for bh, bw in buckets if bh >= h and bw >= w)
+                       for (h, w), n in counts.items())
+
+        while len(chosen) < max_buckets:
+            candidates = [c for c in counts if c not in chosen]
+            if not candidates:
+                break
+            best = min(candidates, key=lambda c: cost(chosen + [c]))
+            if cost(chosen + [best]) >= cost(chosen):
+                break
+            chosen.append(best)
+        return cls(chosen, multiple=multiple, batch_size=batch_size)
+
+    def bucket(self, h, w):
+        """ smallest bucket holding a (h, w) input, or (h, w) rounded up if none does """
+        for bh, bw in self.shapes:
+            if bh >= h and bw >= w:
+                return bh, bw
+        return _round_up(h, self.multiple), _round_up(w, self.multiple)
+
+    def pad(self, x, pad_batch=False):
+        n, _, h, w = x.shape
+        bh, bw = self.bucket(h, w)
+        if (bh, bw) != (h, w):
+            x = F.pad(x, (0, bw - w, 0, bh - h))
+        if pad_batch and self.batch_size is not None and n < self.batch_size:
+            x = torch.cat([x, x.new_zeros((self.batch_size - n,) + x.shape[1:])])
+        return x
+
+    def padding_ratio(self, sizes):
+        """ padded pixels / image pixels over the (H, W) ``sizes`` """
+        pixels = sum(h * w for h, w in sizes)
+        padded = sum(bh * bw for bh, bw in (self.bucket(h, w) for h, w in sizes))
+        return padded / max(pixels, 1) - 1
+
+    def __repr__(self):
+        return 'ShapeBuckets(%s)' % ', '.join('%dx%d' % s for s in self.shapes)
+
+
+def set_compile_cache(cache_dir):
+    """ Keeps the compiled kernels and graphs of Inductor in ``cache_dir``, so later runs
+    with the same model and shapes skip code generation """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+    import torch._inductor.config
+    torch._inductor.config.fx_graph_cache = True
+    try:
+        import torch._functorch.config
+        torch._functorch.config.enable_autograd_cache = True
+    except (ImportError, AttributeError):
+        pass
+
+
+def compile_model(model, buckets, backend='inductor', mode=None, cache_dir=None):
+    """ Compiles the backbone and the classifier of a ``network.modeling`` model in place
+
+    The state dict keys are unchanged, so checkpoints load and save as before. Inputs
+    are padded to ``buckets`` (``ShapeBuckets``) by the model's forward, outside the
+    compiled graphs. Compilation errors, and shapes beyond the recompile limit, run eagerly.
+    The global dynamo settings this changes are restored by ``uncompile_model``.
+    """
+    if cache_dir is not None:
+        set_compile_cache(cache_dir)
+    import torch._dynamo
+    if getattr(model, '_dynamo_config', None) is None:  # kept from the first compilation
+        model._dynamo_config = {k: getattr(torch._dynamo.config, k) for k in ('cache_size_limit', 'suppress_errors')}
+    limit = 2 * len(buckets.shapes) + 4  # train and eval graphs of each bucket, and a few strays
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, limit)
+    torch._dynamo.config.suppress_errors = True
+    model.backbone.compile(backend=backend, mode=mode, dynamic=False)
+    model.classifier.compile(backend=backend, mode=mode, dynamic=False)
+    model.shape_buckets = buckets
+    return model
+
+
+def uncompile_model(model):
+    """ back to eager execution, without padding, and to the dynamo settings before ``compile_model`` """
+    for module in (model.backbone, model.classifier):
+        module._compiled_call_impl = None
+    model.shape_buckets = None
+    if getattr(model, '_dynamo_config', None) is not None:
+        import torch._dynamo
+        for k, v in model._dynamo_config.items():
+            setattr(torch._dynamo.config, k, v)
+        model._dynamo_config = None
+    return model
+
+
+def warmup_compiled(model, device, batch_size=None, train_batch_size=None, train_shapes=None):
+    """ Compiles the graphs of every bucket before the first real batch
+
+    Eval graphs are compiled for every bucket. With ``train_batch_size`` the forward and
+    backward graphs of training mode are compiled too, for ``train_shapes`` (all buckets
+    by default), which are not padded in training; BatchNorm statistics and gradients are
+    restored afterwards. Falls back to eager execution (with a warning) if compilation fails.
+
+    Returns:
+        list: (mode, (H, W), seconds) of each compiled variant.
+    """
+    buckets = model.shape_buckets
+    batch_size = batch_size or buckets.batch_size or 1
+    train_shapes = buckets.shapes if train_shapes is None else list(train_shapes)  # not padded in training
+    was_training = model.training
+    state = {k: v.clone() for k, v in model.state_dict().items()}
+    timings = []
+    try:
+        if train_batch_size is not None:
+            model.train()
+            for h, w in train_shapes:
+                start = time.perf_counter()
+                model(torch.zeros(train_batch_size, 3, h, w, device=device)).float().mean().backward()
+                timings.append(('train', (h, w), time.perf_counter() - start))
+        model.eval()
+        with torch.no_grad():
+            for h, w in buckets.shapes:
+                start = time.perf_counter()
+                model(torch.zeros(batch_size, 3, h, w, device=device))
+                timings.append(('eval', (h, w), time.perf_counter() - start))
+    except Exception as e:
+        warnings.warn('Compilation failed, running eagerly: %r' % e)
+        uncompile_model(model)
+    finally:
+        model.load_state_dict(state)
+        for p in model.parameters():
+            p.grad = None
+        model.train(was_training)
+    return timings
@@ -0,0 +1,340 @@
+import json
+import os
+import platform
+import time
+import warnings
+import weakref
+
+import numpy as np
+import torch
+from torch.func import functional_call
+from torch.overrides import TorchFunctionMode
+
+#
+#  Latency and memory cost model
+#
+#  A model is traced once on the meta device: no compute, only the shapes of every torch
+#  op it runs (conv2d, batch_norm, interpolate, cat, ...). The latency of an op depends
+#  only on its function and argument shapes, so each distinct op is timed once per
+#  machine on random inputs and kept in a lookup table (``LatencyTable``). The latency of
+#  a model is the sum over its ops, scaled by a factor calibrated on end-to-end runs
+#  (module call overhead, colder caches than ops timed alone). Ops missing from the table
+#  can be predicted from the others of the same function by a linear fit on their MACs
+#  (convs) or bytes moved.
+#
+#  Memory follows the tensors of the trace, with the Python lifetimes of the real forward.
+#  The inference peak is the maximum over the ops of the bytes alive after the op plus
+#  its workspace (e.g. the weights reordered by oneDNN), also measured once per op. The
+#  training activation memory is the bytes autograd saves for backward.
+#
+
+
+def _tensors(obj):
+    if isinstance(obj, torch.Tensor):
+        return [obj]
+    if isinstance(obj, (list, tuple)):
+        return [t for o in obj for t in _tensors(o)]
+    if isinstance(obj, dict):
+        return [t for o in obj.values() for t in _tensors(o)]
+    return []
+
+
+def _spec(obj):
+    """ the arguments of an op with the tensors replaced by their shape and dtype """
+    if isinstance(obj, torch.Tensor):
+        return ('tensor', tuple(obj.shape), str(obj.dtype).replace('torch.', ''))
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_spec(o) for o in obj)
+    if isinstance(obj, dict):
+        return {k: _spec(v) for k, v in obj.items()}
+    if isinstance(obj, torch.Size):
+        return tuple(obj)
+    return obj
+
+
+def _materialize(spec, device):
+    """ random tensors for the specs of ``_spec`` """
+    if isinstance(spec, tuple) and len(spec) == 3 and spec[0] == 'tensor':
+        dtype = getattr(torch, spec[2])
+        if dtype.is_floating_point:
+            return torch.randn(spec[1], dtype=dtype, device=device)
+        return torch.zeros(spec[1], dtype=dtype, device=device)
+    if isinstance(spec, (list, tuple)):
+        return type(spec)(_materialize(s, device) for s in spec)
+    if isinstance(spec, dict):
+        return {k: _materialize(v, device) for k, v in spec.items()}
+    return spec
+
+
+def _nbytes(t):
+    return t.numel() * t.element_size()
+
+
+def _peak_bytes(fn, device):
+    """ peak of the memory allocated while running ``fn()`` (CUDA allocator statistics, or
+    the profiler memory timeline on CPU) """
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - base
+    from torch.profiler import profile, ProfilerActivity
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True, record_shapes=True, with_stack=True) as prof:
+        fn()
+    try:
+        sizes = [size if action.name == 'CREATE' else -size if action.name == 'DESTROY' else 0
+                 for _, action, _, size in prof._memory_profile().timeline]
+    except Exception:  # private API, fall back on the allocation events of the profiler
+        events = [e for e in prof.profiler.kineto_results.events() if e.name() == '[memory]']
+        sizes = [e.nbytes() for e in sorted(events, key=lambda e: e.start_ns())]
+    live = peak = 0
+    for size in sizes:
+        live += size
+        peak = max(peak, live)
+    return peak
+
+
+class Op(object):
+    """ one torch call of a trace: ``func`` with the argument specs ``args``/``kwargs`` """
+    def __init__(self, func, args, kwargs, inputs, outputs):
+        self.func = func
+        self.name = getattr(func, '__name__', str(func))
+        self.args, self.kwargs = _spec(args), _spec(kwargs)
+        self.key = '%s%r%r' % (self.name, self.args, sorted(self.kwargs.items()))
+        self.bytes = sum(_nbytes(t) for t in inputs + outputs)
+        self.out_bytes = 0  # new allocations of the op
+        self.live_bytes = 0  # bytes alive after the op, set by the trace
+        self.macs = 0
+        if self.name in ('conv2d', 'conv_transpose2d') and len(inputs) > 1:
+            x, w = inputs[0], inputs[1]
+            if self.name == 'conv2d':
+                self.macs = outputs[0].numel() * w[0].numel()
+            else:
+                self.macs = x.numel() * w[0].numel()
+
+    def run(self, device):
+        args, kwargs = _materialize(self.args, device), _materialize(self.kwargs, device)
+        return lambda: self.func(*args, **kwargs)
+
+
+class _Recorder(TorchFunctionMode):
+    _skip = {'__get__', '__set__', 'dim', 'size', 'numel', 'is_floating_point', 'is_complex', 'element_size',
+             'stride', 'data_ptr', 'untyped_storage', 'requires_grad_', 'detach', 'to'}
+
+    def __init__(self):
+        super(_Recorder, self).__init__()
+        self.ops = []
+        self.live = {}  # id -> bytes of the tensors allocated by the ops, while they are alive
+        self.current = 0
+
+    def _free(self, key):
+        self.current -= self.live.pop(key)
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        out = func(*args, **kwargs)
+        name = getattr(func, '__name__', '')
+        outputs = _tensors(out)
+        if name in self._skip or not outputs:
+            return out
+        inputs = _tensors(args) + _tensors(kwargs)
+        self.ops.append(Op(func, args, kwargs, inputs, outputs))
+        op, input_ids = self.ops[-1], set(id(t) for t in inputs)
+        for t in outputs:  # new storage: not an input (in-place ops) nor a view
+            if id(t) in input_ids or t._base is not None or id(t) in self.live:
+                continue
+            self.live[id(t)] = _nbytes(t)
+            self.current += self.live[id(t)]
+            op.out_bytes += self.live[id(t)]
+            weakref.finalize(t, self._free, id(t))
+        op.live_bytes = self.current
+        return out
+
+
+class Trace(object):
+    """ ops and memory of a traced forward pass
+
+    Attributes:
+        ops (list): the ``Op`` of every torch call, in order.
+        saved_bytes (int, optional): bytes saved for backward by a training forward pass.
+    """
+    def __init__(self, ops, saved_bytes=None):
+        self.ops = ops
+        self.saved_bytes = saved_bytes
+
+
+def trace_model(model, input_shape, train=False):
+    """ Traces ``model`` on a meta input of ``input_shape`` (N, C, H, W)
+
+    The parameters and buffers are swapped for meta tensors for the duration of the
+    trace, so nothing is computed and the model is unchanged. With ``train`` the pass
+    runs in training mode with gradients, and ``saved_bytes`` is measured.
+    """
+    state = {k: torch.empty_like(v, device='meta').requires_grad_(v.requires_grad and train)
+             for k, v in list(model.named_parameters()) + list(model.named_buffers())}
+    saved = {}
+
+    def pack(t):
+        base = t if t._base is None else t._base
+        saved[id(base)] = _nbytes(base)
+        return t
+
+    was_training = model.training
+    model.train(train)
+    recorder = _Recorder()
+    try:
+        with torch.set_grad_enabled(train), torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            x = torch.empty(input_shape, device='meta')
+            with recorder:
+                out = functional_call(model, state, (x,))
+            del out
+    finally:
+        model.train(was_training)
+    return Trace(recorder.ops, sum(saved.values()) if train else None)
+
+
+def machine_info():
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'torch': torch.__version__,
+            'threads': torch.get_num_threads()}
+
+
+class LatencyTable(object):
+    """ Latencies (ms) of the distinct ops met in traces, measured once per machine
+
+    Arguments:
+        path (str, optional): json file the table is loaded from and saved to. A table
+            measured on another machine, torch version or thread count is not loaded.
+        device (str): device the ops are timed on.
+        n_warmup, n_iters (int): runs of each op, the median of the timed runs is kept.
+    """
+    def __init__(self, path=None, device='cpu', n_warmup=2, n_iters=10):
+        self.path = path
+        self.device = torch.device(device)
+        self.n_warmup, self.n_iters = n_warmup, n_iters
+        self.entries = {}  # key -> {'name', 'ms', 'workspace', 'macs', 'bytes'}
+        self.fits = None
+        self.scale = None  # set by calibrate
+        if path is not None and os.path.isfile(path):
+            with open(path) as f:
+                content = json.load(f)
+            if content.get('machine') == self._machine():
+                self.entries = content['ops']
+                self.scale = content.get('scale')
+            else:
+                warnings.warn('%s was measured on another machine, not loaded' % path)
+
+    def _machine(self):
+        return dict(machine_info(), device=self.device.type)
+
+    def save(self, path=None):
+        path = path or self.path
+        with open(path, 'w') as f:
+            json.dump({'machine': self._machine(), 'scale': self.scale, 'ops': self.entries}, f, indent=1)
+
+    def _time(self, fn):
+        times = []
+        with torch.no_grad():
+            for i in range(self.n_warmup + self.n_iters):
+                if self.device.type == 'cuda':
+                    torch.cuda.synchronize(self.device)
+                start = time.perf_counter()
+                fn()
+                if self.device.type == 'cuda':
+                    torch.cuda.synchronize(self.device)
+                if i >= self.n_warmup:
+                    times.append(time.perf_counter() - start)
+        return float(np.median(times)) * 1000
+
+    def measure(self, ops):
+        """ times the ops missing from the table and measures their workspace, returns
+        how many were measured """
+        missing = {op.key: op for op in ops if op.key not in self.entries}
+        for key, op in missing.items():
+            fn = op.run(self.device)
+            ms = self._time(fn)
+            with torch.no_grad():
+                workspace = max(_peak_bytes(fn, self.device) - op.out_bytes, 0)
+            self.entries[key] = {'name': op.name, 'ms': ms, 'workspace': workspace,
+                                 'macs': op.macs, 'bytes': op.bytes}
+        if missing:
+            self.fits = None
+        return len(missing)
+
+    def fit(self):
+        """ per function, least squares ``ms = a + b * work`` with work the MACs of convs
+        and the bytes moved by other ops; ``None`` fits all the non-conv ops together """
+        groups = {}
+        for e in self.entries.values():
+            work = e['macs'] or e['bytes']
+            groups.setdefault(e['name'], []).append((work, e['ms']))
+            if not e['macs']:
+                groups.setdefault(None, []).append((work, e['ms']))
+        self.fits = {}
+        for name, points in groups.items():
+            work, ms = np.array(points, dtype=np.float64).T
+            if len(set(work)) > 1:
+                b, a = np.polyfit(work, ms, 1)
+                if b <= 0:  # noise on a few points, fall back to the mean throughput
+                    a, b = 0., ms.sum() / max(work.sum(), 1)
+            else:
+                a, b = 0., ms.sum() / max(work.sum(), 1)
+            self.fits[name] = (float(a), float(b))
+        return self.fits
+
+    def op_ms(self, op):
+        if op.key in self.entries:
+            return self.entries[op.key]['ms']
+        if self.fits is None:
+            self.fit()
+        fit = self.fits.get(op.name, self.fits.get(None))
+        if fit is None:
+            warnings.warn('%s is not in the table and cannot be fitted (no measured op of its kind), '
+                          'counted as 0 ms' % op.name)
+            return 0.
+        a, b = fit
+        return max(a + b * (op.macs or op.bytes), 0.)
+
+    def predict(self, trace, measure=True):
+        """ latency (ms) of a ``Trace``, timing its missing ops first with ``measure`` """
+        if measure:
+            self.measure(trace.ops)
+        return (self.scale or 1.) * sum(self.op_ms(op) for op in trace.ops)
+
+    def calibrate(self, models, input_shape):
+        """ sets ``scale`` to the median ratio of the measured to the predicted latency of
+        ``models`` (on the table's device), returns the ratios """
+        ratios = []
+        for model in models:
+            trace = trace_model(model, input_shape)
+            self.measure(trace.ops)
+            x = torch.randn(input_shape, device=self.device)
+            was_training = model.training
+            model.eval()
+            ratios.append(self._time(lambda: model(x)) / sum(self.op_ms(op) for op in trace.ops))
+            model.train(was_training)
+        self.scale = float(np.median(ratios))
+        return ratios
+
+    def peak_bytes(self, trace):
+        """ inference memory peak of a ``Trace``, without the workspace of unmeasured ops """
+        return max([op.live_bytes + self.entries.get(op.key, {}).get('workspace', 0) for op in trace.ops] or [0])
+
+
+def predict_cost(model, input_shape, table, measure=True, train_batch=None):
+    """ Predicted latency and memory of ``model`` on ``input_shape`` inputs
+
+    Returns:
+        dict: ``ms`` (inference latency from ``table``), ``peak_mib`` (inference tensor
+        memory), ``ops`` and ``unmeasured`` (ops predicted by the fit), and with
+        ``train_batch`` the ``saved_mib`` of a training forward pass of that batch size.
+    """
+    trace = trace_model(model, input_shape)
+    ms = table.predict(trace, measure=measure)
+    cost = {'ms': ms, 'peak_mib': table.peak_bytes(trace) / 2 ** 20, 'ops': len(trace.ops),
+            'unmeasured': sum(op.key not in table.entries for op in trace.ops)}
+    if train_batch is not None:
+        train_shape = (train_batch,) + tuple(input_shape[1:])
+        cost['saved_mib'] = trace_model(model, train_shape, train=True).saved_bytes / 2 ** 20
+    return cost
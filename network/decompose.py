@@ -0,0 +1,159 @@
+import torch
+import torch.nn as nn
+
+#
+#  Low-rank decompositions of trained convolutions
+#
+#  A k x k conv W (O, I, k, k) is replaced by two convs that approximate it:
+#
+#  * 'separable': for every input channel i, W[:, i] (O x k*k) is approximated with
+#    rank r by SVD. That is a depthwise k x k conv with r filters per input channel,
+#    then a 1x1 conv (O x I*r). With r=1 it is the depthwise + pointwise structure of
+#    ``AtrousSeparableConvolution``.
+#  * 'lowrank': W as an (O x I*k*k) matrix is approximated with rank r by SVD, a k x k
+#    conv to r channels then a 1x1 conv to O channels.
+#
+#  Both are the best approximations of their rank in Frobenius norm.
+#
+METHODS = ('separable', 'lowrank')
+
+
+def _separable_svd(weight):
+    O, I, kh, kw = weight.shape
+    u, s, vh = torch.linalg.svd(weight.detach().float().permute(1, 0, 2, 3).reshape(I, O, kh * kw),
+                                full_matrices=False)
+    return u, s, vh  # (I, O, m), (I, m), (I, m, k*k)
+
+
+def _lowrank_svd(weight):
+    O = weight.shape[0]
+    return torch.linalg.svd(weight.detach().float().reshape(O, -1), full_matrices=False)
+
+
+def _relative_errors(s):
+    """ relative Frobenius error of keeping the first r singular values, for r = 0..len(s) """
+    energy = (s ** 2).flip(-1).cumsum(-1).flip(-1)  # energy[..., r] = sum of s[r:]^2
+    energy = torch.cat([energy, torch.zeros_like(energy[..., :1])], dim=-1)
+    if energy.dim() > 1:
+        energy = energy.sum(0)
+    return (energy / energy[0].clamp(min=1e-12)).sqrt()
+
+
+def conv_cost(conv, method=None, rank=None):
+    """ multiply-accumulates per output pixel of ``conv``, or of its decomposition """
+    O, I, kh, kw = conv.weight.shape
+    if method is None:
+        return O * I * kh * kw
+    if method == 'separable':
+        return I * rank * kh * kw + O * I * rank
+    return rank * I * kh * kw + O * rank
+
+
+def decomposable(conv):
+    return isinstance(conv, nn.Conv2d) and conv.groups == 1 and conv.kernel_size[0] * conv.kernel_size[1] > 1
+
+
+def choose_rank(conv, error_budget, methods=METHODS):
+    """ Cheapest (method, rank, error) approximating ``conv.weight`` within ``error_budget``
+    (relative Frobenius error), or None if no decomposition is cheaper than the conv """
+    best = None
+    for method in methods:
+        s = _separable_svd(conv.weight)[1] if method == 'separable' else _lowrank_svd(conv.weight)[1]
+        errors = _relative_errors(s)  # non-increasing in the rank
+        rank = max(int((errors > error_budget).sum()), 1)
+        cost = conv_cost(conv, method, rank)
+        if cost < conv_cost(conv) and (best is None or cost < best[0]):
+            best = (cost, method, rank, float(errors[rank]))
+    return None if best is None else best[1:]
+
+
+def decompose_conv(conv, method, rank, fit=True):
+    """ Two convs (an ``nn.Sequential``) approximating ``conv`` with the given method and rank
+
+    With ``fit=False`` only the structure is built, e.g. to load a decomposed checkpoint.
+    """
+    O, I, kh, kw = conv.weight.shape
+    bias = conv.bias is not None
+    if method == 'separable':
+        first = nn.Conv2d(I, I * rank, conv.kernel_size, conv.stride, conv.padding, conv.dilation,
+                          groups=I, bias=False, padding_mode=conv.padding_mode)
+        second = nn.Conv2d(I * rank, O, 1, bias=bias)
+    elif method == 'lowrank':
+        first = nn.Conv2d(I, rank, conv.kernel_size, conv.stride, conv.padding, conv.dilation,
+                          bias=False, padding_mode=conv.padding_mode)
+        second = nn.Conv2d(rank, O, 1, bias=bias)
+    else:
+        raise ValueError('Unknown decomposition %s' % method)
+    new = nn.Sequential(first, second).to(conv.weight.device, conv.weight.dtype)
+    if not fit:
+        return new
+
+    with torch.no_grad():
+        if method == 'separable':
+            u, s, vh = _separable_svd(conv.weight)
+            first.weight.copy_(vh[:, :rank].reshape(I * rank, 1, kh, kw))
+            pointwise = (u[:, :, :rank] * s[:, None, :rank]).permute(1, 0, 2)  # (O, I, r)
+            second.weight.copy_(pointwise.reshape(O, I * rank, 1, 1))
+        else:
+            u, s, vh = _lowrank_svd(conv.weight)
+            first.weight.copy_(vh[:rank].reshape(rank, I, kh, kw))
+            second.weight.copy_((u[:, :rank] * s[:rank]).reshape(O, rank, 1, 1))
+        if bias:
+            second.bias.copy_(conv.bias)
+    return new
+
+
+def _in_scope(name, scopes):
+    return scopes is None or any(name == s or name.startswith(s + '.') for s in scopes)
+
+
+def decompose_convs(model, error_budget=0.1, methods=METHODS, scopes=None, plan=None):
+    """ Replaces the k x k convs of ``model`` by their cheapest decomposition within ``error_budget``
+
+    Arguments:
+        error_budget (float): maximum relative Frobenius error of each layer's weights.
+        methods (tuple): decompositions to consider, from ``METHODS``.
+        scopes (list, optional): module name prefixes to decompose, e.g. ``['classifier']``.
+        plan (dict, optional): {conv name: (method, rank)} of an earlier call. The same
+            structure is built without fitting, to load a decomposed checkpoint.
+
+    Returns:
+        dict: {conv name: (method, rank, relative error)} of the decomposed convs, also
+        stored as ``model.decomposition`` (save it with the checkpoint).
+    """
+    convs = [(name, m) for name, m in model.named_modules() if decomposable(m) and _in_scope(name, scopes)]
+    if plan is not None:
+        convs = [(name, m) for name, m in model.named_modules() if name in plan]
+    done = {}
+    for name, conv in convs:
+        if plan is not None:
+            method, rank = plan[name][:2]
+            error = None
+        else:
+            choice = choose_rank(conv, error_budget, methods)
+            if choice is None:
+                continue
+            method, rank, error = choice
+        parent_name, _, attr = name.rpartition('.')
+        parent = model.get_submodule(parent_name)
+        setattr(parent, attr, decompose_conv(conv, method, rank, fit=plan is None))
+        done[name] = (method, rank, error)
+    model.decomposition = dict(getattr(model, 'decomposition', None) or {}, **done)
+    return done
+
+
+def conv_macs(model, x):
+    """ multiply-accumulates of the convolutions of ``model`` on the input ``x`` """
+    total = [0]
+
+    def hook(m, inputs, output):
+        total[0] += output.numel() * m.weight[0].numel()
+
+    handles = [m.register_forward_hook(hook) for m in model.modules() if isinstance(m, nn.Conv2d)]
+    try:
+        with torch.no_grad():
+            model(x)
+    finally:
+        for h in handles:
+            h.remove()
+    return total[0]
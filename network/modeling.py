@@ -1,10 +1,11 @@
 from .utils import IntermediateLayerGetter
-from ._deeplab import DeepLabHead, DeepLabHeadV3Plus, DeepLabV3
+from ._deeplab import DeepLabHead, DeepLabHeadV3Plus, DeepLabV3, StreamASPP, atrous_conv
 from .backbone import resnet
 from .backbone import mobilenetv2
 from .backbone import hrnetv2
 
-def _segm_hrnet(name, backbone_name, num_classes, pretrained_backbone, **kwargs):
+def _segm_hrnet(name, backbone_name, num_classes, pretrained_backbone, stream_aspp=False, fusion_channels=None,
+                upsampler='bilinear', **kwargs):
 
     backbone = hrnetv2.__dict__[backbone_name](pretrained_backbone)
     # HRNetV2 config:
@@ -17,19 +18,25 @@ def _segm_hrnet(name, backbone_name, num_classes, pretrained_backbone, **kwargs)
 
     if name=='deeplabv3plus':
         return_layers = {'stage4': 'out', 'layer1': 'low_level'}
-        classifier = DeepLabHeadV3Plus(inplanes, low_level_planes, num_classes, aspp_dilate)
+        # both at stride 4: the streams are fused at the highest resolution
+        classifier = DeepLabHeadV3Plus(inplanes, low_level_planes, num_classes, aspp_dilate,
+                                       output_stride_lowlevel=4, output_stride_diff=1, upsampler=upsampler)
     elif name=='deeplabv3':
         return_layers = {'stage4': 'out'}
         classifier = DeepLabHead(inplanes, num_classes, aspp_dilate)
 
     backbone = IntermediateLayerGetter(backbone, return_layers=return_layers, hrnet_flag=True)
     model = DeepLabV3(backbone, classifier)
+    if fusion_channels is not None:  # atrous branches on a reduced fusion of the streams
+        aspp = StreamASPP([hrnet_channels * 2 ** i for i in range(4)], aspp_dilate, fusion_channels=fusion_channels)
+        _set_aspp(classifier, aspp)
+        classifier._init_weight()
+        backbone.hrnet_concat = False
+    elif stream_aspp:
+        convert_to_stream_aspp(model)
     return model
 
-def _segm_resnet(name, backbone_name, num_classes, output_stride, pretrained_backbone, **kwargs):
-
-    fl_maxpool = kwargs.get('fl_maxpool')
-    fl_stemstride = kwargs.get('fl_stemstride')
+def _resnet_stride_config(output_stride, fl_maxpool=None, fl_stemstride=None):
     output_stride_lowlevel = 4 // max(2 * ((not fl_maxpool) + (not fl_stemstride)), 1)
     assert output_stride >= output_stride_lowlevel, 'Final output stride should be at least equal to the OS_lowlevel'
     output_stride_diff = output_stride // output_stride_lowlevel
@@ -54,6 +61,17 @@ def _segm_resnet(name, backbone_name, num_classes, output_stride, pretrained_bac
         aspp_dilate = [24, 48, 72]
     else:
         raise ValueError('output_stride_diff must be at most equal 8')
+    return output_stride_lowlevel, output_stride_diff, replace_stride_with_dilation, aspp_dilate
+
+def _mobilenet_aspp_dilate(output_stride):
+    if output_stride==8:
+        return [12, 24, 36]
+    return [6, 12, 18]
+
+def _segm_resnet(name, backbone_name, num_classes, output_stride, pretrained_backbone, **kwargs):
+
+    output_stride_lowlevel, output_stride_diff, replace_stride_with_dilation, aspp_dilate = \
+        _resnet_stride_config(output_stride, kwargs.get('fl_maxpool'), kwargs.get('fl_stemstride'))
 
     kwargs['output_stride_lowlevel'] = output_stride_lowlevel
     kwargs['output_stride_diff'] = output_stride_diff
@@ -78,15 +96,17 @@ def _segm_resnet(name, backbone_name, num_classes, output_stride, pretrained_bac
 
     backbone = IntermediateLayerGetter(backbone, return_layers=return_layers)
     model = DeepLabV3(backbone, classifier)
+    model.stride_config = {'backbone': 'resnet', 'output_stride': output_stride,
+                           'fl_maxpool': kwargs.get('fl_maxpool'), 'fl_stemstride': kwargs.get('fl_stemstride'),
+                           'fl_lfe': kwargs.get('fl_lfe', False)}
     return model
 
-def _segm_mobilenet(name, backbone_name, num_classes, output_stride, pretrained_backbone):
-    if output_stride==8:
-        aspp_dilate = [12, 24, 36]
-    else:
-        aspp_dilate = [6, 12, 18]
+def _segm_mobilenet(name, backbone_name, num_classes, output_stride, pretrained_backbone, width_mult=1.0,
+                    pad_in_conv=False, upsampler='bilinear'):
+    aspp_dilate = _mobilenet_aspp_dilate(output_stride)
 
-    backbone = mobilenetv2.mobilenet_v2(pretrained=pretrained_backbone, output_stride=output_stride)
+    backbone = mobilenetv2.mobilenet_v2(pretrained=pretrained_backbone, output_stride=output_stride,
+                                        width_mult=width_mult, pad_in_conv=pad_in_conv)
 
     # rename layers
     backbone.low_level_features = backbone.features[0:4]
@@ -94,41 +114,112 @@ def _segm_mobilenet(name, backbone_name, num_classes, output_stride, pretrained_
     backbone.features = None
     backbone.classifier = None
 
-    inplanes = 320
-    low_level_planes = 24
+    inplanes = backbone.high_level_features[-1].conv[-1].num_features  # 320 * width_mult
+    low_level_planes = backbone.low_level_features[-1].conv[-1].num_features  # 24 * width_mult
 
     if name=='deeplabv3plus':
         return_layers = {'high_level_features': 'out', 'low_level_features': 'low_level'}
-        classifier = DeepLabHeadV3Plus(inplanes, low_level_planes, num_classes, aspp_dilate)
+        classifier = DeepLabHeadV3Plus(inplanes, low_level_planes, num_classes, aspp_dilate,
+                                       output_stride_lowlevel=4, output_stride_diff=output_stride // 4,
+                                       upsampler=upsampler)
     elif name=='deeplabv3':
         return_layers = {'high_level_features': 'out'}
         classifier = DeepLabHead(inplanes , num_classes, aspp_dilate)
     backbone = IntermediateLayerGetter(backbone, return_layers=return_layers)
 
     model = DeepLabV3(backbone, classifier)
+    model.stride_config = {'backbone': 'mobilenetv2', 'output_stride': output_stride}
     return model
 
 def _load_model(arch_type, backbone, num_classes, output_stride, pretrained_backbone, **kwargs):
 
     if backbone=='mobilenetv2':
-        model = _segm_mobilenet(arch_type, backbone, num_classes, output_stride=output_stride, pretrained_backbone=pretrained_backbone)
+        model = _segm_mobilenet(arch_type, backbone, num_classes, output_stride=output_stride, pretrained_backbone=pretrained_backbone, **kwargs)
     elif backbone.startswith('resnet'):
         model = _segm_resnet(arch_type, backbone, num_classes, output_stride=output_stride, pretrained_backbone=pretrained_backbone, **kwargs)
     elif backbone.startswith('hrnetv2'):
-        model = _segm_hrnet(arch_type, backbone, num_classes, pretrained_backbone=pretrained_backbone)
+        model = _segm_hrnet(arch_type, backbone, num_classes, pretrained_backbone=pretrained_backbone, **kwargs)
     else:
         raise NotImplementedError
     return model
 
 
+def _get_aspp(classifier):
+    return classifier.aspp if isinstance(classifier, DeepLabHeadV3Plus) else classifier.classifier[0]
+
+def _set_aspp(classifier, aspp):
+    if isinstance(classifier, DeepLabHeadV3Plus):
+        classifier.aspp = aspp
+    else:
+        classifier.classifier[0] = aspp
+
+def convert_to_stream_aspp(model, chunk_channels=64):
+    """Runs the ASPP of a HRNetV2 model on the stream list instead of the upsampled concat (exact).
+
+    Same parameters, so checkpoints of the concat model load before or after the conversion.
+    """
+    backbone = model.backbone
+    if not getattr(backbone, 'hrnet_flag', False):
+        raise ValueError('StreamASPP needs a HRNetV2 model built by network.modeling')
+    c = backbone.stage4[-1].branches[0][0].conv1.in_channels
+    aspp = _get_aspp(model.classifier)
+    if not isinstance(aspp, StreamASPP):
+        _set_aspp(model.classifier, StreamASPP.from_aspp(aspp, [c * 2 ** i for i in range(4)],
+                                                         chunk_channels=chunk_channels))
+    backbone.hrnet_concat = False
+    return model
+
+def _set_aspp_dilate(classifier, aspp_dilate):
+    aspp = _get_aspp(classifier)
+    for conv, rate in zip(aspp.convs[1:4], aspp_dilate):
+        conv = atrous_conv(conv[0])  # also inside separable or decomposed convs
+        conv.dilation = (rate, rate)
+        conv.padding = (rate, rate)
+
+def set_output_stride(model, output_stride):
+    """Re-configures the output stride of a model built by ``network.modeling`` in place.
+
+    Strides and dilations of the backbone and the ASPP rates are set as if the model
+    had been constructed with ``output_stride``. No parameter is touched, so a
+    checkpoint trained at one output stride can be served at another one.
+
+    Args:
+        model (nn.Module): a DeepLabV3/DeepLabV3+ model with a ResNet or MobileNetV2 backbone.
+        output_stride (int): the new output stride.
+    """
+    config = getattr(model, 'stride_config', None)
+    if config is None:
+        raise ValueError('Output stride can only be changed for ResNet and MobileNetV2 models built by network.modeling')
+    if output_stride == config['output_stride']:
+        return model
+
+    if config['backbone'] == 'resnet':
+        output_stride_lowlevel, output_stride_diff, replace_stride_with_dilation, aspp_dilate = \
+            _resnet_stride_config(output_stride, config['fl_maxpool'], config['fl_stemstride'])
+        if isinstance(model.classifier, DeepLabHeadV3Plus):
+            if model.classifier.learned_upsampling:
+                raise ValueError('Output stride cannot be changed when the decoder uses learned upsampling')
+            model.classifier.upsample_out.scale_factor = output_stride_diff
+        resnet.set_layers_dilation([model.backbone.layer2, model.backbone.layer3, model.backbone.layer4],
+                                   replace_stride_with_dilation, config['fl_lfe'], output_stride_diff)
+    elif config['backbone'] == 'mobilenetv2':
+        aspp_dilate = _mobilenet_aspp_dilate(output_stride)
+        blocks = list(model.backbone.low_level_features[1:]) + list(model.backbone.high_level_features)
+        mobilenetv2.set_blocks_output_stride(blocks, output_stride)
+
+    _set_aspp_dilate(model.classifier, aspp_dilate)
+    config['output_stride'] = output_stride
+    return model
+
+
 # Deeplab v3
-def deeplabv3_hrnetv2_48(num_classes=21, output_stride=4, pretrained_backbone=False): # no pretrained backbone yet
-    return _load_model('deeplabv3', 'hrnetv2_48', output_stride, num_classes, pretrained_backbone=pretrained_backbone)
+def deeplabv3_hrnetv2_48(num_classes=21, output_stride=4, pretrained_backbone=False, **kwargs): # no pretrained backbone yet
+    return _load_model('deeplabv3', 'hrnetv2_48', num_classes, output_stride, pretrained_backbone=pretrained_backbone, **kwargs)
 
-def deeplabv3_hrnetv2_32(num_classes=21, output_stride=4, pretrained_backbone=True):
-    return _load_model('deeplabv3', 'hrnetv2_32', output_stride, num_classes, pretrained_backbone=pretrained_backbone)
+def deeplabv3_hrnetv2_32(num_classes=21, output_stride=4, pretrained_backbone=True, **kwargs):
+    return _load_model('deeplabv3', 'hrnetv2_32', num_classes, output_stride, pretrained_backbone=pretrained_backbone, **kwargs)
 
-def deeplabv3_resnet50(num_classes=21, output_stride=8, pretrained_backbone=True):
+def deeplabv3_resnet50(num_classes=21, output_stride=8, pretrained_backbone=True, **kwargs):
     """Constructs a DeepLabV3 model with a ResNet-50 backbone.
 
     Args:
@@ -136,9 +227,9 @@ def deeplabv3_resnet50(num_classes=21, output_stride=8, pretrained_backbone=True
         output_stride (int): output stride for deeplab.
         pretrained_backbone (bool): If True, use the pretrained backbone.
     """
-    return _load_model('deeplabv3', 'resnet50', num_classes, output_stride=output_stride, pretrained_backbone=False)
+    return _load_model('deeplabv3', 'resnet50', num_classes, output_stride=output_stride, pretrained_backbone=False, **kwargs)
 
-def deeplabv3_resnet101(num_classes=21, output_stride=8, pretrained_backbone=True):
+def deeplabv3_resnet101(num_classes=21, output_stride=8, pretrained_backbone=True, **kwargs):
     """Constructs a DeepLabV3 model with a ResNet-101 backbone.
 
     Args:
@@ -146,7 +237,7 @@ def deeplabv3_resnet101(num_classes=21, output_stride=8, pretrained_backbone=Tru
         output_stride (int): output stride for deeplab.
         pretrained_backbone (bool): If True, use the pretrained backbone.
     """
-    return _load_model('deeplabv3', 'resnet101', num_classes, output_stride=output_stride, pretrained_backbone=pretrained_backbone)
+    return _load_model('deeplabv3', 'resnet101', num_classes, output_stride=output_stride, pretrained_backbone=pretrained_backbone, **kwargs)
 
 def deeplabv3_mobilenet(num_classes=21, output_stride=8, pretrained_backbone=True, **kwargs):
     """Constructs a DeepLabV3 model with a MobileNetv2 backbone.
@@ -155,8 +246,10 @@ def deeplabv3_mobilenet(num_classes=21, output_stride=8, pretrained_backbone=Tru
         num_classes (int): number of classes.
         output_stride (int): output stride for deeplab.
         pretrained_backbone (bool): If True, use the pretrained backbone.
+        width_mult (float): channel multiplier of the backbone (ImageNet weights for 1.0 only).
+        pad_in_conv (bool): pad in the depthwise convs instead of copying every block input.
     """
-    return _load_model('deeplabv3', 'mobilenetv2', num_classes, output_stride=output_stride, pretrained_backbone=pretrained_backbone)
+    return _load_model('deeplabv3', 'mobilenetv2', num_classes, output_stride=output_stride, pretrained_backbone=pretrained_backbone, **kwargs)
 
 
 # Deeplab v3+
@@ -164,8 +257,8 @@ def deeplabv3plus_hrnetv2_48(num_classes=21, output_stride=4, pretrained_backbon
     return _load_model('deeplabv3plus', 'hrnetv2_48', num_classes, output_stride, pretrained_backbone=pretrained_backbone, **kwargs)
 
 
-def deeplabv3plus_hrnetv2_32(num_classes=21, output_stride=4, pretrained_backbone=True):
-    return _load_model('deeplabv3plus', 'hrnetv2_32', num_classes, output_stride, pretrained_backbone=pretrained_backbone)
+def deeplabv3plus_hrnetv2_32(num_classes=21, output_stride=4, pretrained_backbone=True, **kwargs):
+    return _load_model('deeplabv3plus', 'hrnetv2_32', num_classes, output_stride, pretrained_backbone=pretrained_backbone, **kwargs)
 
 
 def deeplabv3plus_resnet34(num_classes=21, output_stride=8, pretrained_backbone=True, **kwargs):
@@ -194,12 +287,32 @@ def deeplabv3plus_resnet101(num_classes=21, output_stride=8, pretrained_backbone
     return _load_model('deeplabv3plus', 'resnet101', num_classes, output_stride=output_stride, pretrained_backbone=pretrained_backbone, **kwargs)
 
 
-def deeplabv3plus_mobilenet(num_classes=21, output_stride=8, pretrained_backbone=True):
+def deeplabv3plus_mobilenet(num_classes=21, output_stride=8, pretrained_backbone=True, **kwargs):
     """Constructs a DeepLabV3+ model with a MobileNetv2 backbone.
 
     Args:
         num_classes (int): number of classes.
         output_stride (int): output stride for deeplab.
         pretrained_backbone (bool): If True, use the pretrained backbone.
+        width_mult (float): channel multiplier of the backbone (ImageNet weights for 1.0 only).
+        pad_in_conv (bool): pad in the depthwise convs instead of copying every block input.
+        upsampler (str): decoder upsampling, 'bilinear' or a learned upsampler of network/upsample.py.
     """
-    return _load_model('deeplabv3plus', 'mobilenetv2', num_classes, output_stride=output_stride, pretrained_backbone=pretrained_backbone)
+    return _load_model('deeplabv3plus', 'mobilenetv2', num_classes, output_stride=output_stride, pretrained_backbone=pretrained_backbone, **kwargs)
+
+
+# MobileNetV2 width family: no ImageNet weights, padded in the convs by default
+def deeplabv3plus_mobilenet_x0_35(num_classes=21, output_stride=8, pretrained_backbone=False, pad_in_conv=True, **kwargs):
+    return deeplabv3plus_mobilenet(num_classes, output_stride, pretrained_backbone, width_mult=0.35, pad_in_conv=pad_in_conv, **kwargs)
+
+
+def deeplabv3plus_mobilenet_x0_5(num_classes=21, output_stride=8, pretrained_backbone=False, pad_in_conv=True, **kwargs):
+    return deeplabv3plus_mobilenet(num_classes, output_stride, pretrained_backbone, width_mult=0.5, pad_in_conv=pad_in_conv, **kwargs)
+
+
+def deeplabv3plus_mobilenet_x0_75(num_classes=21, output_stride=8, pretrained_backbone=False, pad_in_conv=True, **kwargs):
+    return deeplabv3plus_mobilenet(num_classes, output_stride, pretrained_backbone, width_mult=0.75, pad_in_conv=pad_in_conv, **kwargs)
+
+
+def deeplabv3plus_mobilenet_x1_4(num_classes=21, output_stride=8, pretrained_backbone=False, pad_in_conv=True, **kwargs):
+    return deeplabv3plus_mobilenet(num_classes, output_stride, pretrained_backbone, width_mult=1.4, pad_in_conv=pad_in_conv, **kwargs)
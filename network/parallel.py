@@ -0,0 +1,63 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+#
+#  Concurrent execution of the independent branches of multi-branch modules
+#
+_executors = {}
+_local = threading.local()
+
+
+def get_executor(num_workers):
+    if num_workers not in _executors:
+        _executors[num_workers] = ThreadPoolExecutor(max_workers=num_workers)
+    return _executors[num_workers]
+
+
+def _run_task(fn, args, grad_enabled, inference_mode):
+    # grad mode is thread-local, the tasks run with the mode of the calling thread
+    _local.in_worker = True
+    try:
+        with torch.inference_mode(inference_mode), torch.set_grad_enabled(grad_enabled):
+            return fn(*args)
+    finally:
+        _local.in_worker = False
+
+
+def run_branches(tasks, num_workers=1):
+    """ Runs ``tasks`` ((fn, args) pairs) and returns their results in order
+
+    With ``num_workers > 1`` the tasks run concurrently on a thread pool; torch ops
+    release the GIL, so independent branches overlap on a multi-core CPU (or queue
+    kernels concurrently on a GPU). Tasks started from a worker run sequentially,
+    so nested multi-branch modules cannot exhaust the pool.
+    """
+    if num_workers <= 1 or len(tasks) <= 1 or getattr(_local, 'in_worker', False):
+        return [fn(*args) for fn, args in tasks]
+    executor = get_executor(num_workers)
+    grad_enabled = torch.is_grad_enabled()
+    inference_mode = torch.is_inference_mode_enabled()
+    futures = [executor.submit(_run_task, fn, args, grad_enabled, inference_mode) for fn, args in tasks[1:]]
+    results = [fn(*args) for fn, args in tasks[:1]]  # the calling thread takes the first task
+    return results + [f.result() for f in futures]
+
+
+def convert_to_parallel_branches(module, num_workers=2, group_fusion=True):
+    """ Runs the branches of every multi-branch module in ``module`` concurrently
+
+    Covers the HRNet ``StageModule`` (resolution branches, then one fusion task per
+    output), ``ASPP``/``FusedASPP``, ``StemBlock2`` and ``ParallelStem``. With
+    ``group_fusion`` the 1x1 upsampling fusion convs of an HRNet branch are run as one
+    conv with BatchNorm folded in, in eval mode. The weights are untouched.
+
+    Intra-op threads are shared by the concurrent branches, ``torch.set_num_threads``
+    around ``cores / num_workers`` avoids oversubscription.
+    """
+    for m in module.modules():
+        if hasattr(m, 'branch_workers'):
+            m.branch_workers = num_workers
+        if hasattr(m, 'group_fusion'):
+            m.group_fusion = group_fusion
+    return module
@@ -0,0 +1,211 @@
+import torch
+import torch.nn as nn
+
+from .backbone.resnet import Bottleneck, BasicBlock
+from ._deeplab import DeepLabHeadV3Plus, DeepLabHead
+
+#
+#  Structured channel pruning, with physical removal of the channels
+#
+#  A ``ChannelGroup`` is a set of channels that have to be removed together: the output
+#  channels of some convs and of their BatchNorm (the producers), and the matching input
+#  channels of the convs reading them (the consumers). A consumer may read the group
+#  inside a concat, as the ASPP projection and the DeepLabV3+ decoder do. The residual
+#  channels of a ResNet stage are one group: the downsample conv, the last conv of every
+#  block, and every conv reading the stage output.
+#
+
+
+class ChannelGroup(object):
+    """
+    Arguments:
+        name (str): stable name of the group, the key of the pruning plan.
+        convs (list): convs whose output channels are the group.
+        bns (list): BatchNorm2d normalizing them.
+        consumers (list): (conv, parts) pairs, ``conv`` reads the concat of the groups
+            ``parts`` (``[self]`` without concat).
+    """
+    def __init__(self, name, convs, bns, consumers=()):
+        self.name = name
+        self.convs = list(convs)
+        self.bns = list(bns)
+        self.consumers = [(conv, parts if parts is not None else [self]) for conv, parts in consumers]
+
+    @property
+    def channels(self):
+        return self.bns[0].num_features
+
+    def bn_importance(self):
+        """ sum of |gamma| of the BatchNorm layers, the scaling of each channel """
+        return sum(bn.weight.detach().abs() for bn in self.bns)
+
+    def taylor_importance(self):
+        """ first order Taylor estimate of the loss change when a channel is removed,
+        through its BatchNorm scale and shift (needs gradients) """
+        score = 0
+        for bn in self.bns:
+            if bn.weight.grad is None:
+                continue
+            score = score + (bn.weight * bn.weight.grad + bn.bias * bn.bias.grad).detach() ** 2
+        return score
+
+    def prune(self, keep):
+        """ keeps the channels ``keep`` (sorted indices), in every producer and consumer """
+        keep = keep.to(self.bns[0].weight.device)
+        for conv, parts in self.consumers:
+            offset = sum(p.channels for p in parts[:parts.index(self)])
+            n = conv.in_channels
+            idx = torch.cat([torch.arange(offset, device=keep.device), offset + keep,
+                             torch.arange(offset + self.channels, n, device=keep.device)])
+            conv.weight = nn.Parameter(conv.weight.detach()[:, idx].clone(), requires_grad=conv.weight.requires_grad)
+            conv.in_channels = len(idx)
+        for conv in self.convs:
+            conv.weight = nn.Parameter(conv.weight.detach()[keep].clone(), requires_grad=conv.weight.requires_grad)
+            if conv.bias is not None:
+                conv.bias = nn.Parameter(conv.bias.detach()[keep].clone(), requires_grad=conv.bias.requires_grad)
+            conv.out_channels = len(keep)
+        for bn in self.bns:
+            bn.weight = nn.Parameter(bn.weight.detach()[keep].clone(), requires_grad=bn.weight.requires_grad)
+            bn.bias = nn.Parameter(bn.bias.detach()[keep].clone(), requires_grad=bn.bias.requires_grad)
+            bn.running_mean = bn.running_mean[keep].clone()
+            bn.running_var = bn.running_var[keep].clone()
+            bn.num_features = len(keep)
+
+
+def _plain(*convs):
+    """ convs that can be sliced: dense ``nn.Conv2d`` (not separable, decomposed or grouped) """
+    return all(type(c) is nn.Conv2d and c.groups == 1 for c in convs)
+
+
+def _block_groups(name, block):
+    if isinstance(block, Bottleneck):
+        groups = [(block.conv1, block.bn1, block.conv2), (block.conv2, block.bn2, block.conv3)]
+    elif isinstance(block, BasicBlock):
+        groups = [(block.conv1, block.bn1, block.conv2)]
+    else:
+        return []
+    return [ChannelGroup('%s.width%d' % (name, i + 1), [conv], [bn], [(consumer, None)])
+            for i, (conv, bn, consumer) in enumerate(groups) if _plain(conv, consumer)]
+
+
+def _aspp_inputs(aspp):
+    """ the convs reading the ASPP input """
+    return [aspp.convs[0][0]] + [aspp.convs[i][0] for i in range(1, 4)] + [aspp.convs[4][1]]
+
+
+def channel_groups(model, residual=False):
+    """ The prunable channel groups of a ``network.modeling`` DeepLab model
+
+    Covers the ``Bottleneck``/``BasicBlock`` widths of a ResNet backbone, the ASPP branches
+    and projection, and the layers of ``DeepLabHeadV3Plus``/``DeepLabHead``. With
+    ``residual`` the residual channels of the ResNet stages are included too (stages of
+    other blocks, as in HRNetV2, are left out).
+    """
+    backbone, head = model.backbone, model.classifier
+    aspp = head.aspp if isinstance(head, DeepLabHeadV3Plus) else head.classifier[0]
+    layers = [n for n in ['layer1', 'layer2', 'layer3', 'layer4'] if n in backbone]
+    outputs = dict(getattr(backbone, 'return_layers', {}))  # layer -> 'out' or 'low_level'
+    groups = []
+
+    for lname in layers:
+        for i, block in enumerate(backbone[lname]):
+            groups += _block_groups('backbone.%s.%d' % (lname, i), block)
+
+    if residual:
+        for k, lname in enumerate(layers):
+            blocks = list(backbone[lname])
+            if not all(isinstance(b, (Bottleneck, BasicBlock)) for b in blocks):  # e.g. the HRNet layer1
+                continue
+            if blocks[0].downsample is None:  # identity shortcut from the stem, not pruned
+                continue
+            last = [(b.conv3, b.bn3) if isinstance(b, Bottleneck) else (b.conv2, b.bn2) for b in blocks]
+            convs = [blocks[0].downsample[0]] + [c for c, _ in last]
+            bns = [blocks[0].downsample[1]] + [bn for _, bn in last]
+            consumers = [b.conv1 for b in blocks[1:]]
+            if k + 1 < len(layers):
+                nxt = backbone[layers[k + 1]][0]
+                if not isinstance(nxt, (Bottleneck, BasicBlock)) or nxt.downsample is None:
+                    continue  # another block type, or an identity shortcut into the next stage
+                consumers += [nxt.conv1, nxt.downsample[0]]
+            if outputs.get(lname) == 'out':
+                consumers += _aspp_inputs(aspp)
+            if outputs.get(lname) == 'low_level':
+                consumers += [head.project[0]]
+            if _plain(*convs + consumers):
+                groups.append(ChannelGroup('backbone.%s.residual' % lname, convs, bns,
+                                           [(c, None) for c in consumers]))
+
+    branches = []
+    for i, branch in enumerate(aspp.convs):
+        modules = list(branch)
+        conv = modules[1] if i == 4 else modules[0]
+        bn = modules[2] if i == 4 else modules[1]
+        branches.append(ChannelGroup('aspp.convs.%d' % i, [conv], [bn]))
+    project = aspp.project[0]
+    if _plain(project, *[g.convs[0] for g in branches]):
+        for g in branches:
+            g.consumers = [(project, branches)]
+            groups.append(g)
+
+    aspp_out = ChannelGroup('aspp.project', [aspp.project[0]], [aspp.project[1]])
+    if isinstance(head, DeepLabHeadV3Plus):
+        low = ChannelGroup('decoder.project', [head.project[0]], [head.project[1]])
+        fuse = head.classifier[0]
+        for g in (low, aspp_out):
+            g.consumers = [(fuse, [low, aspp_out])]
+        groups += [low] + ([aspp_out] if not head.learned_upsampling else [])
+        if not head.learned_upsampling:
+            groups.append(ChannelGroup('decoder.classifier', [fuse], [head.classifier[1]],
+                                       [(head.classifier[-1], None)]))
+    elif isinstance(head, DeepLabHead):
+        aspp_out.consumers = [(head.classifier[1], [aspp_out])]
+        groups += [aspp_out, ChannelGroup('head.classifier', [head.classifier[1]], [head.classifier[2]],
+                                          [(head.classifier[4], None)])]
+    return [g for g in groups if all(_plain(c) for c, _ in g.consumers) and _plain(*g.convs)]
+
+
+def accumulate_taylor(groups, scores):
+    """ adds the Taylor importance of the current gradients to ``scores`` (name -> tensor),
+    call it after every ``backward`` between two pruning steps """
+    for g in groups:
+        s = g.taylor_importance()
+        if torch.is_tensor(s):
+            scores[g.name] = scores[g.name] + s if g.name in scores else s
+
+
+def prune_channels(model, ratio=0.2, importance='bn', scores=None, residual=False, min_channels=8, plan=None):
+    """ Physically removes the least important ``ratio`` of the channels of every group
+
+    Arguments:
+        ratio (float): fraction of the current channels of each group removed.
+        importance (str): ``bn`` (BatchNorm |gamma|) or ``taylor`` (``scores`` gathered
+            with ``accumulate_taylor``, BN |gamma| for groups without scores).
+        residual (bool): also prune the residual channels of the ResNet stages.
+        min_channels (int): channels always kept in a group.
+        plan (dict, optional): {group name: channels} of an earlier pruning. The groups are
+            cut to these sizes without ranking, to load a pruned checkpoint.
+
+    Returns:
+        dict: {group name: channels} of every group, also stored as ``model.pruning`` (save
+        it with the checkpoint). The optimizer has to be rebuilt afterwards.
+    """
+    groups = channel_groups(model, residual=residual or (plan is not None and any(
+        name.endswith('.residual') for name in plan)))
+    for g in groups:
+        n = g.channels
+        if plan is not None:
+            if g.name not in plan or plan[g.name] == n:
+                continue
+            keep = torch.arange(plan[g.name])
+        else:
+            n_keep = min(n, max(min_channels, int(round(n * (1 - ratio)))))
+            if n_keep == n:
+                continue
+            if importance == 'taylor' and scores is not None and g.name in scores:
+                score = scores[g.name]
+            else:
+                score = g.bn_importance()
+            keep = score.topk(n_keep).indices.sort().values
+        g.prune(keep)
+    model.pruning = {g.name: g.channels for g in groups}
+    return model.pruning
@@ -0,0 +1,84 @@
+import itertools
+
+import torch
+
+from . import modeling
+
+#
+#  Configuration space of the ResNet DeepLab models
+#
+#  A config is a dict with the ``model`` name, the ``output_stride`` and the ``kwargs`` of
+#  the model constructor (the ``fl_*`` flags of ``_segm_resnet``, ``ResNet`` and
+#  ``DeepLabHeadV3Plus``):
+#
+#      model = network.modeling.__dict__[c['model']](num_classes, c['output_stride'], **c['kwargs'])
+#
+RESNET_FLAGS = ('fl_maxpool', 'fl_stemstride', 'fl_richstem', 'fl_parallelstem', 'fl_lfe')
+DECODER_FLAGS = ('fl_transpose', 'fl_transpose_odd')
+
+
+def config_name(config):
+    flags = [k[3:] for k, v in sorted(config['kwargs'].items()) if v]
+    return '%s_os%d%s' % (config['model'], config['output_stride'], ''.join('+' + f for f in flags))
+
+
+def valid_config(model, output_stride, kwargs):
+    """ whether the constructors accept the flags, without building the model """
+    if kwargs.get('fl_richstem') and kwargs.get('fl_parallelstem'):
+        return False
+    try:
+        modeling._resnet_stride_config(output_stride, kwargs['fl_maxpool'], kwargs['fl_stemstride'])
+    except (AssertionError, ValueError):
+        return False
+    return True
+
+
+def resnet_configs(models, output_strides=(8, 16), flags=RESNET_FLAGS + DECODER_FLAGS, fixed=None):
+    """ The valid configs of the ResNet ``models`` (e.g. ``deeplabv3plus_resnet50``)
+
+    Every combination of the ``flags`` is tried, the other flags keep their ``fixed``
+    value (False by default). Combinations rejected by the stride assertions are left
+    out, and so are the decoder flags of DeepLabV3 and the ``fl_transpose_odd``
+    duplicates of decoders without transposed convolutions.
+    """
+    configs = []
+    for model in models:
+        names = [f for f in flags if 'plus' in model or f not in DECODER_FLAGS]
+        for output_stride in output_strides:
+            for values in itertools.product([False, True], repeat=len(names)):
+                kwargs = {f: False for f in RESNET_FLAGS + (DECODER_FLAGS if 'plus' in model else ())}
+                kwargs.update({f: v for f, v in (fixed or {}).items() if f in kwargs})
+                kwargs.update(zip(names, values))
+                if kwargs.get('fl_transpose_odd') and not kwargs.get('fl_transpose'):
+                    continue
+                if valid_config(model, output_stride, kwargs):
+                    configs.append({'model': model, 'output_stride': output_stride, 'kwargs': kwargs})
+    return configs
+
+
+def build_config(config, num_classes, pretrained_backbone=False):
+    return modeling.__dict__[config['model']](num_classes=num_classes, output_stride=config['output_stride'],
+                                              pretrained_backbone=pretrained_backbone, **config['kwargs'])
+
+
+def check_config(model, size, device='cpu'):
+    """ whether ``model`` runs on a (size, size) input: the transposed decoder only
+    matches the low-level features for some input sizes """
+    model.eval()
+    try:
+        with torch.no_grad():
+            out = model(torch.zeros(1, 3, size, size, device=device))
+    except RuntimeError:
+        return False
+    return out.shape[-2:] == (size, size)
+
+
+def pareto_front(rows, minimize, maximize):
+    """ the rows (dicts) not dominated on the ``minimize`` and ``maximize`` keys,
+    sorted by the first ``minimize`` key """
+    def dominates(a, b):
+        no_worse = all(a[k] <= b[k] for k in minimize) and all(a[k] >= b[k] for k in maximize)
+        better = any(a[k] < b[k] for k in minimize) or any(a[k] > b[k] for k in maximize)
+        return no_worse and better
+    front = [r for r in rows if not any(dominates(o, r) for o in rows)]
+    return sorted(front, key=lambda r: r[minimize[0]])
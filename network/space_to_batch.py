@@ -0,0 +1,258 @@
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .backbone.resnet import Bottleneck, BasicBlock
+from .backbone.mobilenetv2 import InvertedResidual, fixed_padding, _depthwise_conv
+from ._deeplab import ASPPConv, StreamASPP
+
+#
+#  Space-to-batch execution of dilated convolutions
+#
+#  A k x k conv with dilation d only combines pixels whose coordinates are equal modulo d.
+#  Splitting the map into its d*d phases x[:, :, i::d, j::d], stacked along the batch,
+#  turns it into an ordinary conv (dilation 1) on maps d times smaller. 1x1 convs,
+#  BatchNorm (eval), ReLU and residual adds act per pixel, so a whole run of blocks with
+#  the same dilation runs in that layout: the map is split once before the run and
+#  interleaved back after it.
+#
+#  Sizes that are not multiples of d are zero-padded to the next multiple, and the
+#  padding is zeroed again before every conv of the run (``mask``), where the dilated
+#  conv reads its own zero padding. When d is at least the map size, the taps off the
+#  center only read zero padding, and the conv is a 1x1 conv with its center tap.
+#  The outputs are the dilated ones up to float rounding.
+#
+
+
+def space_to_batch(x, d):
+    """ (N, C, H, W) -> (d*d*N, C, ceil(H/d), ceil(W/d)), the phases of ``x`` zero-padded """
+    n, c, h, w = x.shape
+    ph, pw = -h % d, -w % d
+    if ph or pw:
+        x = F.pad(x, (0, pw, 0, ph))
+    H, W = (h + ph) // d, (w + pw) // d
+    return x.view(n, c, H, d, W, d).permute(3, 5, 0, 1, 2, 4).reshape(d * d * n, c, H, W)
+
+
+def batch_to_space(x, d, h, w):
+    """ inverse of ``space_to_batch``, cropped to (h, w) """
+    dn, c, H, W = x.shape
+    n = dn // (d * d)
+    x = x.view(d, d, n, c, H, W).permute(2, 3, 4, 0, 5, 1).reshape(n, c, H * d, W * d)
+    return x[:, :, :h, :w]
+
+
+class _Run(object):
+    """ consecutive modules whose dilated convs all have dilation ``dilation``
+
+    Splits the input of the first module into phases and interleaves the output of the
+    last one, with forward hooks, in eval mode. ``center`` runs (only convs padded in the
+    conv) switch to the center taps on maps no larger than the dilation. With
+    ``autotune`` the first eval pass of every input shape times the run dilated and in
+    phases, and keeps the faster.
+    """
+    def __init__(self, modules, dilation, center, autotune=True):
+        self.modules = modules
+        self.dilation = dilation
+        self.center = center
+        self.autotune = autotune
+        self.choices = {}  # input shape -> 'dilated' or 'phase'
+        self.mode = 'dilated'
+        self.mask = None
+        self.size = None
+        self.tuning = False
+        self.handles = [modules[0].register_forward_pre_hook(self.enter),
+                        modules[-1].register_forward_hook(self.exit)]
+        # blocks padding a copy of their input: the padding of the phases is zeroed there
+        self.padded_blocks = [b for m in modules for b in m.modules()
+                              if isinstance(b, InvertedResidual) and not b.pad_in_conv]
+        self.handles += [b.register_forward_pre_hook(self.mask_input) for b in self.padded_blocks]
+
+    def set_mode(self, mode, x):
+        self.mode = mode
+        for block in self.padded_blocks:
+            block.input_padding = fixed_padding(3, 1 if mode == 'phase' else self.dilation)
+        self.mask = None
+        if mode == 'phase':
+            h, w = x.shape[-2:]
+            self.size = (h, w)
+            if h % self.dilation or w % self.dilation:
+                self.mask = space_to_batch(x.new_ones(x.shape[0], 1, h, w), self.dilation)
+
+    def _time(self, x, mode, n_iters=2):
+        """ seconds of the run in ``mode``, best of ``n_iters`` after a warm-up pass """
+        self.set_mode(mode, x)
+        times = []
+        for _ in range(n_iters + 1):
+            start = time.perf_counter()
+            y = space_to_batch(x, self.dilation) if mode == 'phase' else x
+            for m in self.modules:
+                y = m(y)
+            if mode == 'phase':
+                y = batch_to_space(y, self.dilation, *self.size)
+            if y.is_cuda:
+                torch.cuda.synchronize(y.device)
+            times.append(time.perf_counter() - start)
+        return min(times[1:])
+
+    def choose(self, x):
+        h, w = x.shape[-2:]
+        if self.center and self.dilation >= h and self.dilation >= w:
+            return 'center'
+        if not self.autotune:
+            return 'phase'
+        key = tuple(x.shape)
+        if key not in self.choices:
+            self.tuning = True
+            try:
+                self.choices[key] = min(['dilated', 'phase'], key=lambda mode: self._time(x, mode))
+            finally:
+                self.tuning = False
+        return self.choices[key]
+
+    def enter(self, module, args):
+        if self.tuning:
+            return None
+        x = args[0]
+        self.set_mode('dilated' if module.training else self.choose(x), x)
+        if self.mode != 'phase':
+            return None
+        return (space_to_batch(x, self.dilation),) + tuple(args[1:])
+
+    def mask_input(self, module, args):
+        if self.mode != 'phase' or self.mask is None:
+            return None
+        return (args[0] * self.mask,) + tuple(args[1:])
+
+    def exit(self, module, args, output):
+        if self.tuning or self.mode != 'phase':
+            return None
+        return batch_to_space(output, self.dilation, *self.size)
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+
+class PhaseConv2d(nn.Conv2d):
+    """ ``nn.Conv2d`` of a space-to-batch run, with the parameters of the original conv """
+    run = None
+
+    @classmethod
+    def from_conv(cls, conv, run):
+        new = cls(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding, conv.dilation,
+                  conv.groups, conv.bias is not None, conv.padding_mode)
+        new.weight, new.bias = conv.weight, conv.bias
+        new.run = run
+        return new
+
+    def to_conv(self):
+        conv = nn.Conv2d(self.in_channels, self.out_channels, self.kernel_size, self.stride, self.padding,
+                         self.dilation, self.groups, self.bias is not None, self.padding_mode)
+        conv.weight, conv.bias = self.weight, self.bias
+        return conv
+
+    def forward(self, x):
+        mode = self.run.mode
+        if mode == 'dilated':
+            return super(PhaseConv2d, self).forward(x)
+        if mode == 'center':
+            kh, kw = self.kernel_size
+            weight = self.weight[:, :, kh // 2:kh // 2 + 1, kw // 2:kw // 2 + 1]
+            return F.conv2d(x, weight, self.bias, 1, 0, 1, self.groups)
+        d = self.dilation[0]
+        if self.padding[0] > 0 and self.run.mask is not None:
+            x = x * self.run.mask
+        return F.conv2d(x, self.weight, self.bias, 1, (self.padding[0] // d, self.padding[1] // d), 1, self.groups)
+
+
+def _block_convs(block):
+    """ (dilation, dilated convs, padded in conv) of a block that can run in phases, or None """
+    if isinstance(block, Bottleneck):
+        convs = [block.conv2]
+    elif isinstance(block, BasicBlock):
+        convs = [block.conv1, block.conv2]
+    elif isinstance(block, InvertedResidual):
+        convs = [_depthwise_conv(block)]
+    elif isinstance(block, ASPPConv):
+        convs = [block[0]]
+    else:
+        return None
+    d = convs[0].dilation[0]
+    same = all(type(c) is nn.Conv2d and c.dilation == (d, d) and c.stride == (1, 1) and
+               c.kernel_size[0] % 2 == 1 and c.kernel_size[1] % 2 == 1 for c in convs)
+    if d <= 1 or not same:
+        return None
+    in_conv = not isinstance(block, InvertedResidual) or block.pad_in_conv
+    for c in convs:  # 'same' padding, in the conv or in front of the block
+        padding = (d * (c.kernel_size[0] // 2), d * (c.kernel_size[1] // 2)) if in_conv else (0, 0)
+        if c.padding != padding:
+            return None
+    return d, convs, in_conv
+
+
+def _replace(root, conv, new):
+    for module in root.modules():
+        for name, child in module.named_children():
+            if child is conv:
+                setattr(module, name, new)
+                return
+
+
+def convert_to_space_to_batch(model, min_dilation=2, autotune=True):
+    """ Runs the dilated blocks of ``model`` in space-to-batch layout, in eval mode
+
+    Covers the ResNet ``Bottleneck``/``BasicBlock`` and MobileNetV2 ``InvertedResidual``
+    blocks of the dilated stages (output stride 8 or 16) and the atrous ASPP branches.
+    Consecutive blocks with the same dilation, at least ``min_dilation``, form one run.
+    The parameters and state dict are unchanged; in training mode the convs run dilated.
+    With ``autotune`` each run keeps the dilated convs for the input shapes where they are
+    faster, timed at the first eval pass of each shape (run it under ``torch.no_grad``).
+
+    Returns:
+        list: (dilation, number of blocks) of every run.
+    """
+    skip = set(m for a in model.modules() if isinstance(a, StreamASPP) for m in a.modules())
+    runs = []
+    for parent in list(model.modules()):
+        if parent in skip or not isinstance(parent, (nn.Sequential, nn.ModuleList)):
+            continue
+        children = list(parent.children())
+        i = 0
+        while i < len(children):
+            info = _block_convs(children[i])
+            if info is None or info[0] < min_dilation:
+                i += 1
+                continue
+            run = [(children[i], info)]
+            # a ModuleList (the ASPP branches) holds parallel modules, every one is a run
+            while isinstance(parent, nn.Sequential) and i + len(run) < len(children):
+                nxt = _block_convs(children[i + len(run)])
+                if nxt is None or nxt[0] != info[0]:
+                    break
+                run.append((children[i + len(run)], nxt))
+            state = _Run([m for m, _ in run], info[0], center=all(in_conv for _, (_, _, in_conv) in run),
+                         autotune=autotune)
+            for block, (_, convs, _) in run:
+                for conv in convs:
+                    _replace(block, conv, PhaseConv2d.from_conv(conv, state))
+            runs.append(state)
+            i += len(run)
+    model.space_to_batch_runs = getattr(model, 'space_to_batch_runs', []) + runs
+    return [(r.dilation, len(r.modules)) for r in runs]
+
+
+def revert_space_to_batch(model):
+    """ back to the dilated convs of ``convert_to_space_to_batch`` """
+    for run in getattr(model, 'space_to_batch_runs', []):
+        run.remove()
+        for block in run.modules:
+            for m in list(block.modules()):
+                if isinstance(m, PhaseConv2d):
+                    _replace(block, m, m.to_conv())
+                if isinstance(m, InvertedResidual) and not m.pad_in_conv:
+                    m.input_padding = fixed_padding(3, run.dilation)
+    model.space_to_batch_runs = []
+    return model
@@ -0,0 +1,127 @@
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+#
+#  Learned 2x upsamplers of the DeepLabV3+ decoder
+#
+#  Alternatives to the grouped ``ConvTranspose2d`` of ``fl_transpose``, all per channel
+#  like it, and all initialized to the bilinear upsampling (align_corners=False) that
+#  ``Interpolate`` does:
+#
+#  - ``pixel_shuffle``: a depthwise conv predicts the 4 output phases of every pixel, each
+#    from its 2x2 window, and they are interleaved (the taps of the 4x4 transposed conv,
+#    as a plain conv and one copy, instead of the scattered transposed conv).
+#  - ``bilinear_dw``: bilinear upsampling refined by a depthwise 3x3 conv.
+#  - ``carafe``: content-aware reassembly (CARAFE, Wang et al. 2019), every output pixel
+#    is a predicted softmax-weighted sum of the k x k input neighbourhood.
+#
+#  The bilinear init is exact: the convs pad by replicating the border, as the
+#  interpolation clamps its coordinates. With ``odd`` the output is 2H-1 x 2W-1, as the
+#  3x3 transposed conv of ``fl_transpose_odd``.
+#
+UPSAMPLERS = ('bilinear', 'transpose', 'pixel_shuffle', 'bilinear_dw', 'carafe')
+
+
+def bilinear_phase_kernels(kernel_size=3):
+    """ (4, k, k) kernels of the 2x bilinear upsampling, one per output phase (dy * 2 + dx),
+    centered on the input pixel """
+    c = kernel_size // 2
+    taps = torch.zeros(2, kernel_size)
+    taps[0, c - 1], taps[0, c] = 0.25, 0.75
+    taps[1, c], taps[1, c + 1] = 0.75, 0.25
+    return torch.stack([torch.outer(taps[i], taps[j]) for i in range(2) for j in range(2)])
+
+
+class _Upsample2x(nn.Module):
+    def __init__(self, odd=False):
+        super(_Upsample2x, self).__init__()
+        self.odd = odd
+
+    def _crop(self, x):
+        return x[:, :, :-1, :-1] if self.odd else x
+
+
+class PixelShuffleUpsample(_Upsample2x):
+    """ Sub-pixel upsampling: a depthwise 2x2 conv gives each output phase (dy, dx) from its
+    own 2x2 input window, and the phases are interleaved in a single copy (``F.pixel_shuffle``
+    with the window offsets) """
+    def __init__(self, channels, odd=False):
+        super(PixelShuffleUpsample, self).__init__(odd)
+        self.conv = nn.Conv2d(channels, 4 * channels, 2, padding=1, groups=channels, padding_mode='replicate')
+        self.reset_bilinear()
+
+    def reset_bilinear(self):
+        kernels = bilinear_phase_kernels(3)
+        kernels = torch.stack([kernels[p, p // 2:p // 2 + 2, p % 2:p % 2 + 2] for p in range(4)])
+        with torch.no_grad():
+            self.conv.weight.copy_(kernels.repeat(self.conv.in_channels, 1, 1).unsqueeze(1))
+            self.conv.bias.zero_()
+
+    def forward(self, x):
+        n, c, h, w = x.shape
+        y = self.conv(x).view(n, c, 2, 2, h + 1, w + 1)  # phase (dy, dx) at input pixel i is y[..., i + dy]
+        out = x.new_empty(n, c, h, 2, w, 2)
+        for dy in range(2):
+            for dx in range(2):
+                out[:, :, :, dy, :, dx] = y[:, :, dy, dx, dy:dy + h, dx:dx + w]
+        return self._crop(out.view(n, c, 2 * h, 2 * w))
+
+
+class BilinearDWUpsample(_Upsample2x):
+    def __init__(self, channels, kernel_size=3, odd=False):
+        super(BilinearDWUpsample, self).__init__(odd)
+        self.conv = nn.Conv2d(channels, channels, kernel_size, padding=kernel_size // 2, groups=channels,
+                              padding_mode='replicate')
+        self.reset_bilinear()
+
+    def reset_bilinear(self):
+        k = self.conv.kernel_size[0]
+        with torch.no_grad():
+            self.conv.weight.zero_()
+            self.conv.weight[:, :, k // 2, k // 2] = 1
+            self.conv.bias.zero_()
+
+    def forward(self, x):
+        x = F.interpolate(x, scale_factor=2, mode='bilinear', align_corners=False)
+        return self._crop(self.conv(x))
+
+
+class CARAFEUpsample(_Upsample2x):
+    """ Content-aware reassembly of features: ``encoder`` predicts, from ``mid_channels``
+    compressed channels, a k x k reassembly kernel for each of the 4 output phases """
+    def __init__(self, channels, kernel_size=3, mid_channels=64, encoder_size=3, odd=False):
+        super(CARAFEUpsample, self).__init__(odd)
+        self.kernel_size = kernel_size
+        self.compress = nn.Conv2d(channels, mid_channels, 1)
+        self.encoder = nn.Conv2d(mid_channels, 4 * kernel_size ** 2, encoder_size, padding=encoder_size // 2)
+        self.reset_bilinear()
+
+    def reset_bilinear(self, eps=1e-4):
+        """ content-independent kernels, the softmax of the encoder bias is bilinear up to ``eps`` """
+        kernels = bilinear_phase_kernels(self.kernel_size).flatten()
+        with torch.no_grad():
+            self.encoder.weight.zero_()
+            self.encoder.bias.copy_(torch.log(kernels + eps))
+
+    def forward(self, x):
+        n, c, h, w = x.shape
+        k = self.kernel_size
+        kernels = self.encoder(self.compress(x)).view(n, 1, 4, k * k, h, w).softmax(3)
+        x_pad = F.pad(x, [k // 2] * 4, mode='replicate').unsqueeze(2)
+        out = x.new_zeros(n, c, 4, h, w)
+        for t in range(k * k):  # sum over the neighbourhood, without unfolding it
+            dy, dx = divmod(t, k)
+            out = out.addcmul(x_pad[:, :, :, dy:dy + h, dx:dx + w], kernels[:, :, :, t])
+        return self._crop(F.pixel_shuffle(out.view(n, 4 * c, h, w), 2))
+
+
+def make_upsampler(name, channels, odd=False):
+    """ the learned 2x upsampler ``name``: ``pixel_shuffle``, ``bilinear_dw`` or ``carafe`` """
+    if name == 'pixel_shuffle':
+        return PixelShuffleUpsample(channels, odd=odd)
+    if name == 'bilinear_dw':
+        return BilinearDWUpsample(channels, odd=odd)
+    if name == 'carafe':
+        return CARAFEUpsample(channels, odd=odd)
+    raise ValueError('Unknown upsampler %s, should be one of %s' % (name, ', '.join(UPSAMPLERS[2:])))
@@ -5,18 +5,89 @@ import torch.nn.functional as F
 from collections import OrderedDict
 
 class _SimpleSegmentationModel(nn.Module):
+    shape_buckets = None  # set by network.compile_model, inputs are padded to these sizes
+
     def __init__(self, backbone, classifier):
         super(_SimpleSegmentationModel, self).__init__()
         self.backbone = backbone
         self.classifier = classifier
-        
-    def forward(self, x):
-        input_shape = x.shape[-2:]
+
+    def _pad(self, x):
+        # training crops have a fixed size: padding them would enter the BN statistics and pooling
+        if self.shape_buckets is None or self.training:
+            return x
+        return self.shape_buckets.pad(x, pad_batch=True)
+
+    def forward(self, x, upsample=True):
+        """ ``upsample=False`` returns the decoder-resolution logits, e.g. for training """
+        n, _, H, W = x.shape
+        x = self._pad(x)
+        padded_shape = x.shape[-2:]
         features = self.backbone(x)
         x = self.classifier(features)
-        x = F.interpolate(x, size=input_shape, mode='bilinear', align_corners=False)
+        if upsample:
+            x = F.interpolate(x, size=padded_shape, mode='bilinear', align_corners=False)
+        if x.shape[0] != n or padded_shape != (H, W):  # crop the padding away
+            x = x[:n, :, :-(-H * x.shape[2] // padded_shape[0]), :-(-W * x.shape[3] // padded_shape[1])]
         return x
 
+    def predict_labels(self, x, chunk_rows=128, return_confidence=False):
+        """ Returns the class index map (N, H, W) without building the full-size logits
+
+        The decoder-resolution logits are upsampled and reduced with argmax
+        ``chunk_rows`` output rows at a time, which gives the same labels as
+        ``forward(x).max(1)[1]`` while only holding a (N, C, chunk_rows, W) slice.
+        With ``return_confidence`` the softmax max-probability is also returned,
+        quantized to uint8 (0~255).
+        """
+        n, _, H, W = x.shape
+        x = self._pad(x)
+        features = self.backbone(x)
+        logits = self.classifier(features)
+        out = chunked_upsample_argmax(logits, x.shape[-2:], chunk_rows=chunk_rows,
+                                      return_confidence=return_confidence)
+        if return_confidence:
+            return out[0][:n, :H, :W], out[1][:n, :H, :W]
+        return out[:n, :H, :W]
+
+
+def _source_index(in_size, out_size, device):
+    """ Bilinear source rows and weights, as F.interpolate(align_corners=False) computes them """
+    scale = in_size / out_size
+    src = ((torch.arange(out_size, device=device, dtype=torch.float32) + 0.5) * scale - 0.5).clamp(min=0)
+    idx0 = src.floor().long().clamp(max=in_size - 1)
+    idx1 = (idx0 + 1).clamp(max=in_size - 1)
+    lambda1 = src - idx0.float()
+    return idx0, idx1, lambda1
+
+
+def chunked_upsample_argmax(logits, size, chunk_rows=128, return_confidence=False):
+    """ argmax over classes of the bilinearly upsampled ``logits``, computed in row chunks """
+    N, C, h, w = logits.shape
+    H, W = size
+    label_dtype = torch.uint8 if C <= 256 else torch.long
+    labels = torch.empty((N, H, W), dtype=label_dtype, device=logits.device)
+    confidence = torch.empty((N, H, W), dtype=torch.uint8, device=logits.device) if return_confidence else None
+
+    idx0, idx1, lambda1 = _source_index(h, H, logits.device)
+    lambda1 = lambda1.to(logits.dtype).view(1, 1, -1, 1)
+    for r0 in range(0, H, chunk_rows):
+        r1 = min(r0 + chunk_rows, H)
+        l1 = lambda1[:, :, r0:r1]
+        rows = logits[:, :, idx0[r0:r1]] * (1 - l1) + logits[:, :, idx1[r0:r1]] * l1
+        # height is already final, so this only interpolates along the width
+        rows = F.interpolate(rows, size=(r1 - r0, W), mode='bilinear', align_corners=False)
+        if return_confidence:
+            prob, pred = rows.softmax(dim=1).max(dim=1)
+            confidence[:, r0:r1] = (prob * 255).round().to(torch.uint8)
+        else:
+            pred = rows.max(dim=1)[1]
+        labels[:, r0:r1] = pred.to(label_dtype)
+
+    if return_confidence:
+        return labels, confidence
+    return labels
+
 
 class IntermediateLayerGetter(nn.ModuleDict):
     """
@@ -49,6 +120,8 @@ class IntermediateLayerGetter(nn.ModuleDict):
         >>>     [('feat1', torch.Size([1, 64, 56, 56])),
         >>>      ('feat2', torch.Size([1, 256, 14, 14]))]
     """
+    hrnet_concat = True  # False: return the list of HRNet streams, for StreamASPP
+
     def __init__(self, model, return_layers, hrnet_flag=False):
         if not set(return_layers).issubset([name for name, _ in model.named_children()]):
             raise ValueError("return_layers are not present in model")
@@ -68,9 +141,20 @@ class IntermediateLayerGetter(nn.ModuleDict):
         super(IntermediateLayerGetter, self).__init__(layers)
         self.return_layers = orig_return_layers
 
-    def forward(self, x):
+    def forward(self, x, stop_after=None, start_after=None):
+        """
+        Arguments:
+            stop_after (str, optional): name of the last returned layer to compute,
+                e.g. 'low_level' to skip the remaining (expensive) layers.
+            start_after (str, optional): resume a previous ``stop_after`` call; ``x`` is
+                then the returned feature of that name.
+        """
         out = OrderedDict()
+        skip = start_after is not None
         for name, module in self.named_children():
+            if skip:
+                skip = self.return_layers.get(name) != start_after
+                continue
             if self.hrnet_flag and name.startswith('transition'): # if using hrnet, you need to take care of transition
                 if name == 'transition1': # in transition1, you need to split the module to two streams first
                     x = [trans(x) for trans in module]
@@ -81,7 +165,7 @@ class IntermediateLayerGetter(nn.ModuleDict):
 
             if name in self.return_layers:
                 out_name = self.return_layers[name]
-                if name == 'stage4' and self.hrnet_flag: # In HRNetV2, we upsample and concat all outputs streams together
+                if name == 'stage4' and self.hrnet_flag and self.hrnet_concat: # In HRNetV2, we upsample and concat all outputs streams together
                     output_h, output_w = x[0].size(2), x[0].size(3)  # Upsample to size of highest resolution stream
                     x1 = F.interpolate(x[1], size=(output_h, output_w), mode='bilinear', align_corners=False)
                     x2 = F.interpolate(x[2], size=(output_h, output_w), mode='bilinear', align_corners=False)
@@ -90,4 +174,6 @@ class IntermediateLayerGetter(nn.ModuleDict):
                     out[out_name] = x
                 else:
                     out[out_name] = x
+                if out_name == stop_after:
+                    break
         return out
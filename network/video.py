@@ -0,0 +1,75 @@
+import torch
+import torch.nn.functional as F
+
+from ._deeplab import DeepLabHeadV3Plus
+
+
+class VideoSegmenter(object):
+    """ Frame-sequence inference reusing the high-level features between keyframes
+
+    The expensive part of DeepLabV3+ (backbone up to ``out`` and the ASPP) only runs
+    on keyframes. On the other frames the backbone stops after ``low_level`` and the
+    cached ASPP output of the last keyframe is fused with the fresh low-level
+    features by the decoder.
+
+    Arguments:
+        model (nn.Module): a DeepLabV3+ model built by ``network.modeling``.
+        key_interval (int, optional): a keyframe is forced every ``key_interval`` frames.
+        change_threshold (float, optional): adaptive keyframes. A new keyframe is taken
+            when the mean absolute change of the low-level features, relative to the
+            ones of the last keyframe, exceeds this value.
+
+    Examples::
+
+        >>> segmenter = VideoSegmenter(model.eval(), key_interval=10, change_threshold=0.2)
+        >>> for frame in frames:
+        >>>     pred = segmenter(frame).max(1)[1]
+    """
+    def __init__(self, model, key_interval=5, change_threshold=None):
+        if not isinstance(model.classifier, DeepLabHeadV3Plus):
+            raise ValueError('Temporal feature reuse needs a DeepLabV3+ model')
+        if key_interval is None and change_threshold is None:
+            raise ValueError('Set key_interval, change_threshold or both')
+        self.model = model
+        self.key_interval = key_interval
+        self.change_threshold = change_threshold
+        self.reset()
+
+    def reset(self):
+        """ forgets the cached keyframe, e.g. at the start of a new sequence """
+        self.key_low_level = None
+        self.key_output = None
+        self.since_key = 0
+        self.n_frames = 0
+        self.n_keyframes = 0
+
+    def _is_keyframe(self, low_level):
+        if self.key_low_level is None or self.key_low_level.shape != low_level.shape:
+            return True
+        if self.key_interval is not None and self.since_key >= self.key_interval:
+            return True
+        if self.change_threshold is not None:
+            change = (low_level - self.key_low_level).abs().mean() / (self.key_low_level.abs().mean() + 1e-8)
+            return change.item() > self.change_threshold
+        return False
+
+    @torch.no_grad()
+    def __call__(self, x):
+        """ returns the full-resolution logits of frame ``x`` (N, 3, H, W) """
+        input_shape = x.shape[-2:]
+        backbone = self.model.backbone
+        classifier = self.model.classifier
+
+        features = backbone(x, stop_after='low_level')
+        low_level = features['low_level']
+        if self._is_keyframe(low_level):
+            features = backbone(low_level, start_after='low_level')
+            self.key_output = classifier.forward_high(features['out'], low_level.shape[2:])
+            self.key_low_level = low_level
+            self.since_key = 0
+            self.n_keyframes += 1
+
+        logits = classifier.forward_low(low_level, self.key_output)
+        self.since_key += 1
+        self.n_frames += 1
+        return F.interpolate(logits, size=input_shape, mode='bilinear', align_corners=False)
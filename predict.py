@@ -3,6 +3,7 @@ from tqdm import tqdm
 import network
 import utils
 import os
+import io
 import random
 import argparse
 import numpy as np
@@ -11,6 +12,7 @@ from torch.utils import data
 from datasets import VOCSegmentation, Cityscapes, cityscapes
 from torchvision import transforms as T
 from metrics import StreamSegMetrics
+from main import get_model_kwargs, build_model
 
 import torch
 import torch.nn as nn
@@ -31,7 +33,7 @@ def get_argparser():
 
     # Deeplab Options
     available_models = sorted(name for name in network.modeling.__dict__ if name.islower() and \
-                              not (name.startswith("__") or name.startswith('_')) and callable(
+                              name.startswith('deeplab') and callable(
                               network.modeling.__dict__[name])
                               )
 
@@ -40,10 +42,70 @@ def get_argparser():
     parser.add_argument("--separable_conv", action='store_true', default=False,
                         help="apply separable conv to decoder and aspp")
     parser.add_argument("--output_stride", type=int, default=16, choices=[8, 16])
+    parser.add_argument("--stream_aspp", action='store_true', default=False,
+                        help="HRNet: run the ASPP on the streams instead of their upsampled concat "
+                             "(same results and weights, less memory)")
+    parser.add_argument("--fusion_channels", type=int, default=None,
+                        help="HRNet: run the atrous ASPP branches on a reduced fusion of the streams "
+                             "with this many channels (new weights, to train)")
+    parser.add_argument("--pad_in_conv", type=int, default=None, choices=[0, 1],
+                        help="mobilenet: pad in the depthwise convs instead of copying every block input "
+                             "(default: 1 for the _x width variants, 0 for the released checkpoints)")
+    parser.add_argument("--fused_aspp", action='store_true', default=False,
+                        help="use the fused ASPP for inference (same weights)")
+    parser.add_argument("--aspp_workers", type=int, default=1,
+                        help="threads running the fused ASPP branches concurrently (default: 1)")
+    parser.add_argument("--space_to_batch", action='store_true', default=False,
+                        help="run the dilated convs in space-to-batch layout where it is faster, timed on the "
+                             "first image of each size (same results and weights)")
+    parser.add_argument("--branch_workers", type=int, default=1,
+                        help="threads running the branches of HRNet stages, ASPP and multi-branch stems "
+                             "concurrently (default: 1)")
+    parser.add_argument("--label_only", action='store_true', default=False,
+                        help="upsample and argmax in row chunks instead of building full-size logits")
+
+    # ResNet Options
+    parser.add_argument("--fl_maxpool", type=int, default=1, choices=[0, 1],
+                        help="resnet: keep the stem max-pooling (default: 1)")
+    parser.add_argument("--fl_stemstride", type=int, default=1, choices=[0, 1],
+                        help="resnet: stride 2 in the stem convolution (default: 1)")
+    parser.add_argument("--fl_richstem", type=int, default=0, choices=[0, 1],
+                        help="resnet: three 3x3 convolutions stem (default: 0)")
+    parser.add_argument("--fl_parallelstem", type=int, default=0, choices=[0, 1],
+                        help="resnet: parallel branches stem (default: 0)")
+    parser.add_argument("--fl_lfe", type=int, default=0, choices=[0, 1],
+                        help="resnet: large field extraction dilations (default: 0)")
+    parser.add_argument("--fl_transpose", type=int, default=0, choices=[0, 1],
+                        help="deeplabv3plus resnet: transposed convolutions in the decoder (default: 0)")
+    parser.add_argument("--fl_transpose_odd", type=int, default=0, choices=[0, 1],
+                        help="deeplabv3plus resnet: last transposed convolution of the high-level path is 3x3, "
+                             "for input sizes of 2^k+1 like 513 (default: 0)")
+    parser.add_argument("--upsampler", type=str, default='bilinear', choices=network.UPSAMPLERS,
+                        help="deeplabv3plus: decoder upsampling, bilinear or a learned 2x upsampler "
+                             "initialized bilinear (transpose is --fl_transpose 1, default: bilinear)")
+
+    # Video Options
+    parser.add_argument("--key_interval", type=int, default=None,
+                        help="treat the sorted input images as a sequence and only run the "
+                             "full backbone every KEY_INTERVAL frames")
+    parser.add_argument("--key_threshold", type=float, default=None,
+                        help="also take a keyframe when the low-level features change "
+                             "more than this (relative mean abs change)")
+
+    # Cache Options
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="reuse predictions of identical images from this on-disk cache")
+    parser.add_argument("--cache_size_mb", type=int, default=1024,
+                        help="size bound of the prediction cache (default: 1024)")
 
     # Train Options
     parser.add_argument("--save_val_results_to", default=None,
                         help="save segmentation results to the specified dir")
+    parser.add_argument("--output_format", type=str, default='rgb', choices=utils.LABEL_FORMATS,
+                        help="rgb: colorized png, palette: 8-bit paletted png, raw: uint8 npy, "
+                             "rle: run-length encoded, npz: compressed shards (default: rgb)")
+    parser.add_argument("--shard_size", type=int, default=256,
+                        help="label maps per npz shard (default: 256)")
 
     parser.add_argument("--crop_val", action='store_true', default=False,
                         help='crop validation (default: False)')
@@ -52,6 +114,18 @@ def get_argparser():
     parser.add_argument("--crop_size", type=int, default=513)
 
     
+    # Compilation options
+    parser.add_argument("--compile", action='store_true', default=False,
+                        help="run the model with torch.compile, inputs padded to a few shape buckets")
+    parser.add_argument("--compile_backend", type=str, default='inductor',
+                        help="torch.compile backend (default: inductor)")
+    parser.add_argument("--compile_mode", type=str, default=None,
+                        help="torch.compile mode, e.g. max-autotune (default: None)")
+    parser.add_argument("--compile_buckets", type=int, default=4,
+                        help="maximum number of input shapes of variable-size images (default: 4)")
+    parser.add_argument("--compile_cache_dir", type=str, default=None,
+                        help="persistent compiler cache, reused by later runs (default: torch default)")
+
     parser.add_argument("--ckpt", default=None, type=str,
                         help="resume from checkpoint")
     parser.add_argument("--gpu_id", type=str, default='0',
@@ -63,9 +137,11 @@ def main():
     if opts.dataset.lower() == 'voc':
         opts.num_classes = 21
         decode_fn = VOCSegmentation.decode_target
+        palette = utils.make_palette(VOCSegmentation.cmap)
     elif opts.dataset.lower() == 'cityscapes':
         opts.num_classes = 19
         decode_fn = Cityscapes.decode_target
+        palette = utils.make_palette(Cityscapes.train_id_to_color)
 
     os.environ['CUDA_VISIBLE_DEVICES'] = opts.gpu_id
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -82,14 +158,20 @@ def main():
         image_files.append(opts.input)
     
     # Set up model (all models are 'constructed at network.modeling)
-    model = network.modeling.__dict__[opts.model](num_classes=opts.num_classes, output_stride=opts.output_stride)
-    if opts.separable_conv and 'plus' in opts.model:
-        network.convert_to_separable_conv(model.classifier)
+    model = build_model(opts)
     utils.set_bn_momentum(model.backbone, momentum=0.01)
+    if opts.fused_aspp:
+        network.convert_to_fused_aspp(model.classifier, num_workers=opts.aspp_workers)
+    if opts.branch_workers > 1:
+        network.convert_to_parallel_branches(model, num_workers=opts.branch_workers)
     
     if opts.ckpt is not None and os.path.isfile(opts.ckpt):
         # https://github.com/VainF/DeepLabV3Plus-Pytorch/issues/8#issuecomment-605601402, @PytaichukBohdan
         checkpoint = torch.load(opts.ckpt, map_location=torch.device('cpu'))
+        if checkpoint.get("pruning"):  # pruned with --prune_ratio
+            network.prune_channels(model, plan=checkpoint["pruning"])
+        if checkpoint.get("decomposition"):  # saved by decompose.py
+            network.decompose_convs(model, plan=checkpoint["decomposition"])
         model.load_state_dict(checkpoint["model_state"])
         model = nn.DataParallel(model)
         model.to(device)
@@ -99,6 +181,11 @@ def main():
         print("[!] Retrain")
         model = nn.DataParallel(model)
         model.to(device)
+    if opts.space_to_batch and opts.compile:
+        print("[!] --space_to_batch is not supported with --compile, running the dilated convs")
+    elif opts.space_to_batch:
+        runs = network.convert_to_space_to_batch(model.module)
+        print("Space-to-batch runs (dilation, blocks): %s" % runs)
 
     #denorm = utils.Denormalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])  # denormalization for ori images
 
@@ -116,22 +203,88 @@ def main():
                 T.Normalize(mean=[0.485, 0.456, 0.406],
                                 std=[0.229, 0.224, 0.225]),
             ])
+    writer = None
     if opts.save_val_results_to is not None:
-        os.makedirs(opts.save_val_results_to, exist_ok=True)
+        writer = utils.LabelWriter(opts.save_val_results_to, opts.output_format, palette=palette,
+                                   decode_fn=decode_fn, shard_size=opts.shard_size)
+    segmenter = None
+    if opts.key_interval is not None or opts.key_threshold is not None:
+        image_files = sorted(image_files)
+        segmenter = network.VideoSegmenter(model.module, key_interval=opts.key_interval,
+                                           change_threshold=opts.key_threshold)
+
+    if opts.compile and segmenter is not None:
+        print("[!] --compile is not supported with keyframes, running eagerly")
+    elif opts.compile:
+        if opts.crop_val:
+            sizes = [(opts.crop_size, opts.crop_size)]
+        else:
+            sizes = []
+            for img_path in image_files:
+                with Image.open(img_path) as img:  # only parses the header
+                    sizes.append(img.size[::-1])
+        if sizes:
+            buckets = network.ShapeBuckets.from_sizes(sizes, max_buckets=opts.compile_buckets, batch_size=1)
+            network.compile_model(model.module, buckets, backend=opts.compile_backend, mode=opts.compile_mode,
+                                  cache_dir=opts.compile_cache_dir)
+            timings = network.warmup_compiled(model.module, device)
+            print("Compiled %s, %d variants in %.1fs, padding %.1f%%" % (
+                buckets, len(timings), sum(t for _, _, t in timings), 100 * buckets.padding_ratio(sizes)))
+
+    cache = None
+    if opts.cache_dir is not None and segmenter is None: # sequence predictions depend on previous frames
+        if opts.ckpt is None or not os.path.isfile(opts.ckpt):
+            raise ValueError("--cache_dir needs a checkpoint (--ckpt) to fingerprint the model")
+        parts = [opts.model, opts.dataset, opts.output_stride, opts.separable_conv, opts.fused_aspp,
+                 utils.file_digest(opts.ckpt), transform]
+        if model.module.shape_buckets is not None:  # padding slightly changes the predictions
+            parts.append(model.module.shape_buckets)
+        if 'resnet' in opts.model:  # the stem and decoder flags change the network for the same weights
+            parts.append(sorted(get_model_kwargs(opts).items()))
+        if opts.pad_in_conv is not None:  # conv padding changes the borders
+            parts.append('pad_in_conv=%d' % opts.pad_in_conv)
+        if 'hrnet' in opts.model and (opts.stream_aspp or opts.fusion_channels is not None):
+            parts.append('stream_aspp=%d,fusion_channels=%s' % (opts.stream_aspp, opts.fusion_channels))
+        if opts.space_to_batch and not opts.compile:  # equal up to float rounding
+            parts.append('space_to_batch')
+        fingerprint = utils.PredictionCache.make_fingerprint(*parts)
+        cache = utils.PredictionCache(opts.cache_dir, fingerprint, max_bytes=opts.cache_size_mb * 2 ** 20)
+
     with torch.no_grad():
         model = model.eval()
         for img_path in tqdm(image_files):
             ext = os.path.basename(img_path).split('.')[-1]
             img_name = os.path.basename(img_path)[:-len(ext)-1]
-            img = Image.open(img_path).convert('RGB')
-            img = transform(img).unsqueeze(0) # To tensor of NCHW
-            img = img.to(device)
-            
-            pred = model(img).max(1)[1].cpu().numpy()[0] # HW
-            colorized_preds = decode_fn(pred).astype('uint8')
-            colorized_preds = Image.fromarray(colorized_preds)
-            if opts.save_val_results_to:
-                colorized_preds.save(os.path.join(opts.save_val_results_to, img_name+'.png'))
+
+            pred = None
+            if cache is not None:
+                with open(img_path, 'rb') as f:
+                    img_bytes = f.read()
+                cache_key = cache.key(img_bytes)
+                pred = cache.get(cache_key, n_bytes=len(img_bytes))
+
+            if pred is None:
+                img = Image.open(io.BytesIO(img_bytes) if cache is not None else img_path).convert('RGB')
+                img = transform(img).unsqueeze(0) # To tensor of NCHW
+                img = img.to(device)
+
+                if segmenter is not None:
+                    pred = segmenter(img).max(1)[1].cpu().numpy()[0] # HW
+                elif opts.label_only:
+                    pred = model.module.predict_labels(img).cpu().numpy()[0] # HW
+                else:
+                    pred = model(img).max(1)[1].cpu().numpy()[0] # HW
+                if cache is not None:
+                    cache.put(cache_key, pred.astype(np.uint8))
+            if writer is not None:
+                writer.write(img_name, pred)
+
+    if writer is not None:
+        writer.close()
+
+    if cache is not None:
+        cache.evict()
+        print(cache.report())
 
 if __name__ == '__main__':
     main()
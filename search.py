@@ -0,0 +1,194 @@
+"""Searches the ResNet/decoder flags of the DeepLab models for the latency/accuracy trade-off
+
+    python search.py --models deeplabv3plus_resnet50 --output_strides 8 16 --search_size 513 \
+        --search_flags fl_maxpool fl_stemstride fl_lfe fl_transpose fl_transpose_odd --output search.json
+
+Every valid combination of --search_flags (see network/search.py) is built and its CPU
+latency, peak memory and params are measured on a --search_size input. The flags not
+searched keep their main.py value. With --proxy_itrs each config is also trained for a
+few iterations on the dataset and validated on --val_samples images, and the Pareto front
+is over latency and mIoU. Without proxy trainings the front is over latency, memory and
+output stride (the lower the more accurate). The front is printed as main.py flags and
+saved to --output, with the constructor kwargs of every config. With --latency_table the
+latency and memory are predicted by the cost model of network/cost.py, which times each
+distinct layer once per machine, instead of running every config.
+"""
+import argparse
+import json
+
+import torch
+import torch.nn as nn
+from torch.utils import data
+
+import network
+import utils
+from benchmark import timeit, peak_memory_bytes
+from main import get_argparser, get_dataset, validate, build_model
+from metrics import StreamSegMetrics
+from network.search import RESNET_FLAGS, DECODER_FLAGS
+
+
+def get_search_argparser():
+    parser = get_argparser()
+    parser.add_argument("--models", type=str, nargs='+', default=['deeplabv3plus_resnet50'],
+                        help="ResNet models to search (default: deeplabv3plus_resnet50)")
+    parser.add_argument("--output_strides", type=int, nargs='+', default=[8, 16],
+                        help="output strides to search (default: 8 16)")
+    parser.add_argument("--search_flags", type=str, nargs='+', default=list(RESNET_FLAGS + DECODER_FLAGS),
+                        choices=RESNET_FLAGS + DECODER_FLAGS, help="flags to search, the others keep their value")
+    parser.add_argument("--search_size", type=int, default=None,
+                        help="input size of the latency and memory measures (default: --crop_size)")
+    parser.add_argument("--n_iters", type=int, default=5,
+                        help="timed forward passes per config (default: 5)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="torch CPU threads (default: torch's default)")
+    parser.add_argument("--latency_table", type=str, default=None,
+                        help="predict the latency and memory with the cost model and this per-machine op table "
+                             "(created or extended as needed) instead of measuring every config")
+    parser.add_argument("--max_ms", type=float, default=None,
+                        help="skip the proxy training of configs slower than this")
+    parser.add_argument("--proxy_itrs", type=int, default=0,
+                        help="training iterations of each config before validation (default: 0, no training)")
+    parser.add_argument("--proxy_pretrained", type=int, default=1, choices=[0, 1],
+                        help="proxy trainings start from the ImageNet backbone (default: 1)")
+    parser.add_argument("--val_samples", type=int, default=None,
+                        help="validate on the first N val images (default: all)")
+    parser.add_argument("--output", type=str, default=None,
+                        help="json file of the measured configs and the Pareto front")
+    return parser
+
+
+def main_flags(config):
+    """ the main.py arguments building ``config`` """
+    flags = ['--model %s' % config['model'], '--output_stride %d' % config['output_stride']]
+    return ' '.join(flags + ['--%s %d' % (k, v) for k, v in sorted(config['kwargs'].items())])
+
+
+def config_opts(opts, config):
+    """ ``opts`` with the model, output stride and flags of ``config``, the other main.py
+    options (e.g. --upsampler, --separable_conv) keep their value """
+    return argparse.Namespace(**dict(vars(opts), model=config['model'], output_stride=config['output_stride'],
+                                     **config['kwargs']))
+
+
+def measure(model, size, n_iters):
+    x = torch.randn(1, 3, size, size)
+    model.eval()
+    with torch.no_grad():
+        ms = timeit(lambda: model(x), 1, n_iters)
+        peak = peak_memory_bytes(lambda: model(x))
+    params = sum(p.numel() for p in model.parameters())
+    return {'ms': ms, 'peak_mib': peak / 2 ** 20, 'params_m': params / 1e6}
+
+
+def predict(model, size, table):
+    """ ``measure`` from the cost model, the missing ops of the table are measured """
+    if table.scale is None:  # calibrate the table on its first model
+        table.calibrate([model], (1, 3, size, size))
+    cost = network.predict_cost(model, (1, 3, size, size), table)
+    params = sum(p.numel() for p in model.parameters())
+    return {'ms': cost['ms'], 'peak_mib': cost['peak_mib'], 'params_m': params / 1e6}
+
+
+def proxy_train(model, train_loader, val_loader, opts, device):
+    """ mIoU after ``opts.proxy_itrs`` iterations of the main.py training recipe """
+    optimizer = torch.optim.SGD(params=[
+        {'params': model.backbone.parameters(), 'lr': 0.1 * opts.lr},
+        {'params': model.classifier.parameters(), 'lr': opts.lr},
+    ], lr=opts.lr, momentum=0.9, weight_decay=opts.weight_decay)
+    scheduler = utils.PolyLR(optimizer, opts.proxy_itrs, power=0.9)
+    criterion = nn.CrossEntropyLoss(ignore_index=255, reduction='mean')
+    utils.set_bn_momentum(model.backbone, momentum=0.01)
+    model.to(device).train()
+    itrs = 0
+    while itrs < opts.proxy_itrs:
+        for images, labels in train_loader:
+            images = images.to(device, dtype=torch.float32)
+            labels = labels.to(device, dtype=torch.long)
+            optimizer.zero_grad()
+            criterion(model(images), labels).backward()
+            optimizer.step()
+            scheduler.step()
+            itrs += 1
+            if itrs >= opts.proxy_itrs:
+                break
+    model.eval()
+    score, _ = validate(opts=opts, model=model, loader=val_loader, device=device,
+                        metrics=StreamSegMetrics(opts.num_classes))
+    return score['Mean IoU']
+
+
+def main():
+    opts = get_search_argparser().parse_args()
+    opts.num_classes = opts.num_classes or (21 if opts.dataset == 'voc' else 19)
+    opts.save_val_results = False
+    if opts.threads is not None:
+        torch.set_num_threads(opts.threads)
+    size = opts.search_size or opts.crop_size
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    fixed = {f: bool(getattr(opts, f)) for f in RESNET_FLAGS + DECODER_FLAGS}
+    configs = network.search.resnet_configs(opts.models, opts.output_strides, opts.search_flags, fixed)
+    print("%d valid configs, latency on %dx%d, %d threads" % (len(configs), size, size, torch.get_num_threads()))
+    table = network.LatencyTable(opts.latency_table) if opts.latency_table is not None else None
+
+    if opts.proxy_itrs > 0:
+        train_dst, val_dst = get_dataset(opts)
+        if opts.val_samples is not None:
+            val_dst = data.Subset(val_dst, range(min(opts.val_samples, len(val_dst))))
+        train_loader = data.DataLoader(train_dst, batch_size=opts.batch_size, shuffle=True, num_workers=2,
+                                       drop_last=True)
+        val_loader = data.DataLoader(val_dst, batch_size=opts.val_batch_size, shuffle=False, num_workers=2)
+
+    rows = []
+    for config in configs:
+        name = network.search.config_name(config)
+        try:
+            model = build_model(config_opts(opts, config), pretrained_backbone=False)
+        except (AssertionError, IndexError, ValueError) as e:  # e.g. LFE only fits the resnet34/50 layer sizes
+            print("%s: cannot be built (%r), skipped" % (name, e))
+            continue
+        if not network.search.check_config(model, size):
+            print("%s: does not run on %dx%d inputs, skipped" % (name, size, size))
+            continue
+        if table is not None:
+            row = dict(config, name=name, **predict(model, size, table))
+        else:
+            row = dict(config, name=name, **measure(model, size, opts.n_iters))
+        if opts.proxy_itrs > 0 and (opts.max_ms is None or row['ms'] <= opts.max_ms):
+            torch.manual_seed(opts.random_seed)
+            model = build_model(config_opts(opts, config), pretrained_backbone=bool(opts.proxy_pretrained))
+            row['miou'] = proxy_train(model, train_loader, val_loader, opts, device)
+        print("%s: %.1f ms, %.1f MiB%s" % (name, row['ms'], row['peak_mib'],
+                                           ', mIoU %.4f' % row['miou'] if 'miou' in row else ''))
+        rows.append(row)
+        del model
+
+    if table is not None:
+        table.save()
+    if opts.proxy_itrs > 0:
+        front = network.search.pareto_front([r for r in rows if 'miou' in r], ['ms'], ['miou'])
+    else:
+        front = network.search.pareto_front(rows, ['ms', 'peak_mib', 'output_stride'], [])
+    names = set(r['name'] for r in front)
+
+    header = ['config', 'ms', 'peak MiB', 'params (M)', 'mIoU', 'front']
+    table = [[r['name'], '%.1f' % r['ms'], '%.1f' % r['peak_mib'], '%.2f' % r['params_m'],
+              '%.4f' % r['miou'] if 'miou' in r else '-', '*' if r['name'] in names else '']
+             for r in sorted(rows, key=lambda r: r['ms'])]
+    widths = [max(len(str(v)) for v in col) for col in zip(header, *table)]
+    for row in [header] + table:
+        print(' | '.join(str(v).ljust(w) for v, w in zip(row, widths)))
+
+    print("Pareto front:")
+    for r in front:
+        print("  %.1f ms%s: %s" % (r['ms'], ', mIoU %.4f' % r['miou'] if 'miou' in r else '', main_flags(r)))
+    if opts.output is not None:
+        with open(opts.output, 'w') as f:
+            json.dump({'search_size': size, 'threads': torch.get_num_threads(), 'front': front, 'configs': rows},
+                      f, indent=2)
+        print("Search results saved as %s" % opts.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""Runs a grid of main.py trainings in parallel
+
+    python sweep.py --sweep_dir sweeps/os_lr --parallel 4 \
+        --grid lr=0.01,0.1 output_stride=8,16 loss_type=cross_entropy,focal_loss fl_lfe=0,1 \
+        -- --model deeplabv3plus_resnet50 --dataset voc --data_root ./datasets/data --total_itrs 30000
+
+Every run gets its own set of CPU cores (and GPU with --gpus), its own checkpoint dir and
+log under --sweep_dir, and reads the images through one decoded-image cache shared by all
+runs. Validation scores are collected from the runs' --metrics_file, dominated runs are
+stopped early and the results are written to <sweep_dir>/results.csv.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sweep_dir", type=str, default='./sweeps/sweep',
+                        help="directory of the runs, logs and results")
+    parser.add_argument("--grid", type=str, nargs='+', default=[],
+                        help="main.py options to sweep, as name=value1,value2,...")
+    parser.add_argument("--parallel", type=int, default=2,
+                        help="number of concurrent runs (default: 2)")
+    parser.add_argument("--cores_per_run", type=int, default=None,
+                        help="CPU cores pinned to each run (default: all cores split between the runs)")
+    parser.add_argument("--gpus", type=str, default=None,
+                        help="comma separated GPU ids assigned round-robin to the run slots")
+    parser.add_argument("--decoded_cache", type=str, default=None,
+                        help="decoded image cache shared by the runs (default: SWEEP_DIR/decoded)")
+    parser.add_argument("--script", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'),
+                        help="training script")
+
+    # Early stopping
+    parser.add_argument("--prune_after", type=int, default=None,
+                        help="stop dominated runs from this iteration on (default: never)")
+    parser.add_argument("--prune_margin", type=float, default=0.05,
+                        help="a run is dominated when its mIoU trails the best run at the same "
+                             "iteration by more than this (default: 0.05)")
+    parser.add_argument("--poll_interval", type=float, default=10.,
+                        help="seconds between checks of the runs (default: 10)")
+    return parser
+
+
+def expand_grid(grid):
+    """['lr=0.01,0.1', 'output_stride=8,16'] -> list of {name: value} dicts"""
+    names, values = [], []
+    for item in grid:
+        name, vals = item.split('=', 1)
+        names.append(name.lstrip('-'))
+        values.append(vals.split(','))
+    return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+
+def core_slots(parallel, cores_per_run=None):
+    """CPU core sets, one per slot, disjoint when there are enough cores (None where
+    affinity is unsupported)"""
+    if not hasattr(os, 'sched_getaffinity'):
+        return [None] * parallel
+    cores = sorted(os.sched_getaffinity(0))
+    cores_per_run = cores_per_run or max(len(cores) // parallel, 1)
+    return [set(cores[(i * cores_per_run + k) % len(cores)] for k in range(cores_per_run))
+            for i in range(parallel)]
+
+
+class Run(object):
+    """ One training process of the sweep """
+    def __init__(self, name, params, run_dir):
+        self.name = name
+        self.params = params
+        self.run_dir = run_dir
+        self.metrics_file = os.path.join(run_dir, 'metrics.jsonl')
+        self.proc = None
+        self.slot = None
+        self.status = 'pending'
+        self.scores = {}  # itrs -> mIoU, of the full val set or of the --fast_val_samples subset
+        self.full_itrs = set()  # itrs of the full validations
+        self.start_time = None
+        self.end_time = None
+
+    def command(self, opts, common_args, slot):
+        args = [sys.executable, opts.script] + common_args
+        for name, value in self.params.items():
+            args += ['--' + name, value]
+        args += ['--ckpt_dir', self.run_dir, '--metrics_file', self.metrics_file,
+                 '--decoded_cache', opts.decoded_cache]
+        if opts.gpus is not None:
+            gpus = opts.gpus.split(',')
+            args += ['--gpu_id', gpus[slot % len(gpus)]]
+        return args
+
+    def start(self, opts, common_args, slot, cores):
+        os.makedirs(self.run_dir, exist_ok=True)
+        if os.path.exists(self.metrics_file):
+            os.remove(self.metrics_file)
+        env = dict(os.environ)
+        if cores is not None:
+            env['OMP_NUM_THREADS'] = env['MKL_NUM_THREADS'] = str(len(cores))
+        preexec_fn = (lambda: os.sched_setaffinity(0, cores)) if cores is not None else None
+        self.log = open(os.path.join(self.run_dir, 'log.txt'), 'w')
+        self.proc = subprocess.Popen(self.command(opts, common_args, slot), stdout=self.log,
+                                     stderr=subprocess.STDOUT, env=env, preexec_fn=preexec_fn)
+        self.slot = slot
+        self.status = 'running'
+        self.start_time = time.time()
+
+    def update(self):
+        """ reads new validation scores and returns True once the process has exited """
+        if os.path.exists(self.metrics_file):
+            with open(self.metrics_file) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # line being written
+                        continue
+                    self.scores[record['itrs']] = record['Mean IoU']
+                    if record.get('val', 'full') == 'full':
+                        self.full_itrs.add(record['itrs'])
+        code = self.proc.poll()
+        if code is None:
+            return False
+        if self.status == 'running':
+            self.status = 'done' if code == 0 else 'failed (%d)' % code
+        self._finish()
+        return True
+
+    def stop(self, status):
+        self.status = status
+        self.proc.terminate()
+
+    def _finish(self):
+        self.end_time = time.time()
+        self.log.close()
+
+    def best(self):
+        """ best mIoU of the full validations """
+        return max(self.scores[i] for i in self.full_itrs) if self.full_itrs else None
+
+
+def dominated(run, runs, prune_after, margin):
+    """ True if, at the last validation both reported, another run was better than ``run``
+    by more than ``margin``. The fast validation estimates count too: a run that plateaus
+    below the best score only reports those. """
+    if prune_after is None:
+        return False
+    for other in runs:
+        if other is run:
+            continue
+        common = [itrs for itrs in run.scores if itrs in other.scores and itrs >= prune_after]
+        if common and run.scores[max(common)] < other.scores[max(common)] - margin:
+            return True
+    return False
+
+
+def write_results(path, runs, names):
+    header = ['run'] + names + ['status', 'itrs', 'best mIoU', 'last mIoU', 'minutes']
+    rows = []
+    for r in runs:
+        last = ''
+        if r.scores:
+            last = '%.4f%s' % (r.scores[max(r.scores)], '' if max(r.scores) in r.full_itrs else ' (subset)')
+        minutes = ((r.end_time or time.time()) - r.start_time) / 60 if r.start_time else 0
+        rows.append([r.name] + [r.params[n] for n in names] +
+                    [r.status, max(r.scores) if r.scores else '',
+                     '%.4f' % r.best() if r.best() is not None else '', last, '%.1f' % minutes])
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    return header, rows
+
+
+def main():
+    argv = sys.argv[1:]
+    common_args = []
+    if '--' in argv:
+        common_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    opts = get_argparser().parse_args(argv)
+    opts.decoded_cache = opts.decoded_cache or os.path.join(opts.sweep_dir, 'decoded')
+    os.makedirs(opts.sweep_dir, exist_ok=True)
+
+    grid = expand_grid(opts.grid)
+    names = list(grid[0]) if grid else []
+    runs = [Run('run%03d' % i, params, os.path.join(opts.sweep_dir, 'run%03d' % i)) for i, params in enumerate(grid)]
+    slots = core_slots(opts.parallel, opts.cores_per_run)
+    free_slots = list(range(opts.parallel))
+    pending = list(runs)
+    running = []
+    print("Sweep of %d runs, %d in parallel, cores per run: %s" % (len(runs), opts.parallel, slots))
+
+    try:
+        while pending or running:
+            while pending and free_slots:
+                run, slot = pending.pop(0), free_slots.pop(0)
+                run.start(opts, common_args, slot, slots[slot])
+                running.append(run)
+                print("[%s] started: %s" % (run.name, ' '.join('%s=%s' % kv for kv in run.params.items())))
+            time.sleep(opts.poll_interval)
+            for run in list(running):
+                if run.update():
+                    running.remove(run)
+                    free_slots.append(run.slot)
+                    print("[%s] %s, best mIoU %s" % (run.name, run.status, run.best()))
+                elif run.status == 'running' and dominated(run, runs, opts.prune_after, opts.prune_margin):
+                    print("[%s] dominated at itrs %d, stopping" % (run.name, max(run.scores)))
+                    run.stop('pruned')
+            write_results(os.path.join(opts.sweep_dir, 'results.csv'), runs, names)
+    finally:
+        for run in running:
+            run.proc.terminate()
+
+    header, rows = write_results(os.path.join(opts.sweep_dir, 'results.csv'), runs, names)
+    widths = [max(len(str(v)) for v in col) for col in zip(header, *rows)]
+    for row in [header] + rows:
+        print(' | '.join(str(v).ljust(w) for v, w in zip(row, widths)))
+
+
+if __name__ == '__main__':
+    main()
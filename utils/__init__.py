@@ -1,4 +1,8 @@
 from .utils import *
 from .visualizer import Visualizer
+from .metrics_logger import MetricsLogger, JSONLSink, TensorBoardSink, VisdomSink
 from .scheduler import PolyLR
-from .loss import FocalLoss
\ No newline at end of file
+from .loss import FocalLoss, ChunkedCrossEntropyLoss, ChunkedFocalLoss, OHEMCrossEntropyLoss
+from .cache import PredictionCache, file_digest
+from .label_io import LabelWriter, LABEL_FORMATS, make_palette, read_label, read_shard
+from .render import AsyncImageSaver, label_lut, render_batch
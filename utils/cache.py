@@ -0,0 +1,130 @@
+import os
+import io
+import hashlib
+import tempfile
+import numpy as np
+
+try:  # POSIX only, eviction is unlocked elsewhere
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """sha1 of a file's content, read in 1MB chunks"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class PredictionCache(object):
+    """ On-disk cache of label maps keyed by image content and model fingerprint
+
+    Entries are stored as ``<root>/<key[:2]>/<key>.npy`` where the key hashes the raw
+    bytes of the input image together with ``fingerprint`` (model, checkpoint,
+    transform...). Writes go to a temporary file followed by an atomic rename, so
+    several processes can share one cache. Hits refresh the file mtime and the
+    least recently used entries are evicted once the cache exceeds ``max_bytes``.
+
+    Args:
+        root (str): cache directory.
+        fingerprint (str): everything besides the image that determines the prediction.
+        max_bytes (int): size bound of the cache.
+    """
+    def __init__(self, root, fingerprint, max_bytes=1024 ** 3, evict_every=64):
+        self.root = os.path.expanduser(root)
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        os.makedirs(self.root, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0  # input bytes that did not need to be decoded and forwarded
+        self._puts = 0
+
+    @staticmethod
+    def make_fingerprint(*parts):
+        return hashlib.sha1('\n'.join(str(p) for p in parts).encode()).hexdigest()
+
+    def key(self, img_bytes):
+        h = hashlib.sha1(img_bytes)
+        h.update(self.fingerprint.encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + '.npy')
+
+    def get(self, key, n_bytes=0):
+        """ returns the cached label map or None """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                pred = np.load(io.BytesIO(f.read()))
+            os.utime(path)
+        except (OSError, ValueError):  # missing, evicted concurrently or truncated
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.bytes_saved += n_bytes
+        return pred
+
+    def put(self, key, pred):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, pred)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._puts += 1
+        if self._puts % self.evict_every == 0:
+            self.evict()
+
+    def _entries(self):
+        entries = []
+        for sub in os.listdir(self.root):
+            sub_dir = os.path.join(self.root, sub)
+            if not os.path.isdir(sub_dir):
+                continue
+            for name in os.listdir(sub_dir):
+                if not name.endswith('.npy'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(sub_dir, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, os.path.join(sub_dir, name)))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """ removes least recently used entries until the cache fits in ``max_bytes`` """
+        with open(os.path.join(self.root, '.lock'), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def report(self):
+        return "Cache: %d hits, %d misses (hit rate %.1f%%), %.1f MB of input skipped, %.1f MB on disk" % (
+            self.hits, self.misses, 100 * self.hit_rate(), self.bytes_saved / 2 ** 20, self.size() / 2 ** 20)
@@ -338,15 +338,21 @@ class ExtRandomCrop(object):
             respectively.
         pad_if_needed (boolean): It will pad the image if smaller than the
             desired size to avoid raising an exception.
+        class_weights (sequence, optional): crop priority of each label value (256 entries),
+            e.g. ``LabelStats.crop_weights()``.
+        rare_prob (float): probability of centering the crop on a pixel of a class of the
+            label drawn proportionally to ``class_weights`` instead of cropping uniformly.
     """
 
-    def __init__(self, size, padding=0, pad_if_needed=False):
+    def __init__(self, size, padding=0, pad_if_needed=False, class_weights=None, rare_prob=0.):
         if isinstance(size, numbers.Number):
             self.size = (int(size), int(size))
         else:
             self.size = size
         self.padding = padding
         self.pad_if_needed = pad_if_needed
+        self.class_weights = class_weights
+        self.rare_prob = rare_prob
 
     @staticmethod
     def get_params(img, output_size):
@@ -366,6 +372,24 @@ class ExtRandomCrop(object):
         j = random.randint(0, w - tw)
         return i, j, th, tw
 
+    @staticmethod
+    def get_class_params(lbl, output_size, class_weights):
+        """Get parameters for ``crop`` for a crop centered on a pixel of a class drawn with
+        ``class_weights`` among the classes of ``lbl``. None if no weighted class is present.
+        """
+        lbl = np.asarray(lbl)
+        h, w = lbl.shape[:2]
+        th, tw = output_size
+        weights = np.bincount(lbl.ravel(), minlength=256)[:256].astype(bool) * np.asarray(class_weights)
+        if weights.sum() <= 0:
+            return None
+        c = np.random.choice(256, p=weights / weights.sum())
+        ys, xs = np.nonzero(lbl == c)
+        k = random.randrange(len(ys))
+        i = min(max(ys[k] - th // 2, 0), h - th)
+        j = min(max(xs[k] - tw // 2, 0), w - tw)
+        return i, j, th, tw
+
     def __call__(self, img, lbl):
         """
         Args:
@@ -390,12 +414,18 @@ class ExtRandomCrop(object):
             img = F.pad(img, padding=int((1 + self.size[0] - img.size[1]) / 2))
             lbl = F.pad(lbl, padding=int((1 + self.size[0] - lbl.size[1]) / 2))
 
-        i, j, h, w = self.get_params(img, self.size)
+        params = None
+        if self.class_weights is not None and random.random() < self.rare_prob:
+            params = self.get_class_params(lbl, self.size, self.class_weights)
+        if params is None:
+            params = self.get_params(img, self.size)
+        i, j, h, w = params
 
         return F.crop(img, i, j, h, w), F.crop(lbl, i, j, h, w)
 
     def __repr__(self):
-        return self.__class__.__name__ + '(size={0}, padding={1})'.format(self.size, self.padding)
+        return self.__class__.__name__ + '(size={0}, padding={1}, rare_prob={2})'.format(
+            self.size, self.padding, self.rare_prob)
 
 
 class ExtResize(object):
@@ -0,0 +1,130 @@
+import os
+import numpy as np
+from PIL import Image
+
+#
+#  Compact storage formats for predicted label maps
+#
+LABEL_FORMATS = ['rgb', 'palette', 'raw', 'rle', 'npz']
+
+_EXTENSIONS = {
+    'rgb': '.png',
+    'palette': '.png',
+    'raw': '.npy',
+    'rle': '.rle',
+}
+
+
+def make_palette(colors, fill=(0, 0, 0)):
+    """Pads a (K, 3) color table to the 256 entries of a PIL palette.
+
+    Args:
+        colors (array): color of class index i at row i, e.g. ``VOCSegmentation.cmap``
+            or ``Cityscapes.train_id_to_color``.
+        fill (tuple): color of the remaining indices (including 255, 'ignore').
+    """
+    palette = np.empty((256, 3), dtype=np.uint8)
+    palette[:] = fill
+    colors = np.asarray(colors, dtype=np.uint8)[:256]
+    palette[:len(colors)] = colors
+    return palette
+
+
+def rle_encode(label):
+    """Run-length encoding of a uint8 (H, W) label map as bytes"""
+    flat = np.ascontiguousarray(label, dtype=np.uint8).ravel()
+    starts = np.concatenate([[0], np.flatnonzero(flat[1:] != flat[:-1]) + 1])
+    lengths = np.diff(np.concatenate([starts, [flat.size]])).astype(np.uint32)
+    header = np.array([label.shape[0], label.shape[1], len(starts)], dtype=np.uint32)
+    return header.tobytes() + flat[starts].tobytes() + lengths.tobytes()
+
+
+def rle_decode(buf):
+    h, w, n = np.frombuffer(buf, dtype=np.uint32, count=3)
+    values = np.frombuffer(buf, dtype=np.uint8, count=n, offset=12)
+    lengths = np.frombuffer(buf, dtype=np.uint32, count=n, offset=12 + int(n))
+    return np.repeat(values, lengths).reshape(h, w)
+
+
+class LabelWriter(object):
+    """Writes predicted label maps in one of ``LABEL_FORMATS``.
+
+    - ``rgb``: colorized RGB PNG (``decode_fn(label)``), the historical format.
+    - ``palette``: 8-bit paletted PNG, the palette holds the dataset colors.
+    - ``raw``: uint8 ``.npy`` class map.
+    - ``rle``: run-length encoded class map (see ``rle_encode``).
+    - ``npz``: ``shard_size`` maps per compressed ``shard_XXXXX.npz``, keyed by name.
+
+    Args:
+        out_dir (str): output directory.
+        fmt (str): output format.
+        palette (array, optional): (256, 3) uint8 palette for ``palette`` (see ``make_palette``).
+        decode_fn (callable, optional): label -> RGB image for ``rgb``.
+        shard_size (int): number of maps per ``npz`` shard.
+    """
+    def __init__(self, out_dir, fmt='rgb', palette=None, decode_fn=None, shard_size=256):
+        assert fmt in LABEL_FORMATS, 'Unknown label format %s' % fmt
+        self.out_dir = out_dir
+        self.fmt = fmt
+        self.palette = palette
+        self.decode_fn = decode_fn
+        self.shard_size = shard_size
+        self._shard = {}
+        os.makedirs(out_dir, exist_ok=True)
+        # append to the shards of previous runs instead of overwriting them
+        self._n_shards = len([f for f in os.listdir(out_dir) if f.startswith('shard_') and f.endswith('.npz')])
+
+    def write(self, name, label):
+        """Writes the (H, W) class map ``label`` under ``name`` (without extension)"""
+        label = np.asarray(label)
+        if self.fmt == 'npz':
+            self._shard[name] = label.astype(np.uint8)
+            if len(self._shard) >= self.shard_size:
+                self.flush()
+            return
+        path = os.path.join(self.out_dir, name + _EXTENSIONS[self.fmt])
+        if self.fmt == 'rgb':
+            Image.fromarray(self.decode_fn(label).astype('uint8')).save(path)
+        elif self.fmt == 'palette':
+            img = Image.fromarray(label.astype(np.uint8))
+            img.putpalette(self.palette.ravel().tolist())  # 'L' -> 'P'
+            img.save(path)
+        elif self.fmt == 'raw':
+            np.save(path, label.astype(np.uint8))
+        elif self.fmt == 'rle':
+            with open(path, 'wb') as f:
+                f.write(rle_encode(label))
+
+    def flush(self):
+        if self._shard:
+            np.savez_compressed(os.path.join(self.out_dir, 'shard_%05d.npz' % self._n_shards), **self._shard)
+            self._n_shards += 1
+            self._shard = {}
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_label(path):
+    """Reads a class map written by ``LabelWriter`` (palette, raw or rle)"""
+    if path.endswith('.npy'):
+        return np.load(path)
+    if path.endswith('.rle'):
+        with open(path, 'rb') as f:
+            return rle_decode(f.read())
+    img = Image.open(path)
+    if img.mode != 'P':
+        raise ValueError('%s is not a paletted image, RGB outputs cannot be read back as labels' % path)
+    return np.array(img)
+
+
+def read_shard(path):
+    """Returns {name: class map} of an ``npz`` shard"""
+    with np.load(path) as shard:
+        return {k: shard[k] for k in shard.files}
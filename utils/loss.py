@@ -3,19 +3,151 @@ import torch.nn.functional as F
 import torch 
 
 class FocalLoss(nn.Module):
-    def __init__(self, alpha=1, gamma=0, size_average=True, ignore_index=255):
+    def __init__(self, alpha=1, gamma=0, size_average=True, ignore_index=255, weight=None):
         super(FocalLoss, self).__init__()
         self.alpha = alpha
         self.gamma = gamma
         self.ignore_index = ignore_index
         self.size_average = size_average
+        self.register_buffer('weight', weight)
 
     def forward(self, inputs, targets):
         ce_loss = F.cross_entropy(
             inputs, targets, reduction='none', ignore_index=self.ignore_index)
         pt = torch.exp(-ce_loss)
         focal_loss = self.alpha * (1 - pt)**self.gamma * ce_loss
+        if self.weight is not None:
+            # class weights scale the loss after pt, which must stay the unweighted probability
+            valid = targets != self.ignore_index
+            focal_loss = focal_loss * torch.where(valid, self.weight[targets.clamp(max=len(self.weight) - 1)], 0.)
         if self.size_average:
             return focal_loss.mean()
         else:
             return focal_loss.sum()
+
+
+class _ChunkedFocalNLL(torch.autograd.Function):
+    """Sum over pixels of the (class weighted) focal loss, computed ``chunk_rows`` rows at a time.
+
+    Only the logits and targets are kept for backward, which recomputes the softmax of
+    each chunk, so no (N, C, H, W) or (N, H, W) float intermediates outlive a chunk.
+    gamma=0 is the cross entropy.
+    """
+    @staticmethod
+    def forward(ctx, logits, targets, weight, gamma, alpha, ignore_index, chunk_rows):
+        ctx.save_for_backward(logits, targets, weight)
+        ctx.gamma, ctx.alpha, ctx.ignore_index, ctx.chunk_rows = gamma, alpha, ignore_index, chunk_rows
+        total = logits.new_zeros((), dtype=torch.float32)
+        for h0 in range(0, logits.shape[2], chunk_rows):
+            z = logits[:, :, h0:h0 + chunk_rows].float()
+            t, valid = _chunk_targets(targets[:, h0:h0 + chunk_rows], ignore_index)
+            logp_t = z.gather(1, t) - torch.logsumexp(z, dim=1, keepdim=True)
+            loss = -logp_t
+            if gamma != 0:
+                loss = loss * (1 - logp_t.exp()) ** gamma
+            total += (loss * _pixel_weights(t, valid, weight)).sum()
+        return (alpha * total).to(logits.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        logits, targets, weight = ctx.saved_tensors
+        gamma, alpha = ctx.gamma, ctx.alpha
+        grad = torch.empty_like(logits)
+        for h0 in range(0, logits.shape[2], ctx.chunk_rows):
+            z = logits[:, :, h0:h0 + ctx.chunk_rows].float()
+            t, valid = _chunk_targets(targets[:, h0:h0 + ctx.chunk_rows], ctx.ignore_index)
+            p = torch.softmax(z, dim=1)
+            # d loss / d z_j = coef * (p_j - [j == t])
+            coef = alpha * grad_output.float() * _pixel_weights(t, valid, weight)
+            if gamma != 0:
+                # p_t * log p_t from the log-probability, finite when p_t underflows to 0
+                logp_t = z.gather(1, t) - torch.logsumexp(z, dim=1, keepdim=True)
+                p_t = logp_t.exp()
+                one_minus = (1 - p_t).clamp(min=1e-12)
+                coef = coef * (one_minus ** gamma - gamma * one_minus ** (gamma - 1) * p_t * logp_t)
+            g = p.mul_(coef)
+            g.scatter_add_(1, t, -coef)
+            grad[:, :, h0:h0 + ctx.chunk_rows] = g
+        return grad, None, None, None, None, None, None
+
+
+def _chunk_targets(targets, ignore_index):
+    valid = (targets != ignore_index).unsqueeze(1)
+    return targets.unsqueeze(1).masked_fill(~valid, 0), valid
+
+
+def _pixel_weights(t, valid, weight):
+    if weight is None:
+        return valid.float()
+    return weight[t].float() * valid
+
+
+def _valid_weight_sum(targets, weight, ignore_index):
+    """Denominator of a 'mean' reduction: number (or total class weight) of valid pixels"""
+    valid = targets != ignore_index
+    if weight is None:
+        return valid.sum()
+    return weight[targets[valid]].sum()
+
+
+class ChunkedCrossEntropyLoss(nn.Module):
+    """``nn.CrossEntropyLoss(weight, ignore_index, reduction='mean')`` computed over
+    ``chunk_rows`` rows at a time, without full-size log-softmax intermediates"""
+    def __init__(self, weight=None, ignore_index=255, chunk_rows=64):
+        super(ChunkedCrossEntropyLoss, self).__init__()
+        self.ignore_index = ignore_index
+        self.chunk_rows = chunk_rows
+        self.register_buffer('weight', weight)
+
+    def forward(self, inputs, targets):
+        loss = _ChunkedFocalNLL.apply(inputs, targets, self.weight, 0, 1., self.ignore_index, self.chunk_rows)
+        return loss / _valid_weight_sum(targets, self.weight, self.ignore_index).clamp(min=1)
+
+
+class ChunkedFocalLoss(FocalLoss):
+    """``FocalLoss`` computed over ``chunk_rows`` rows at a time, without full-size
+    ``ce_loss``/``pt`` intermediates"""
+    def __init__(self, alpha=1, gamma=0, size_average=True, ignore_index=255, weight=None, chunk_rows=64):
+        super(ChunkedFocalLoss, self).__init__(alpha, gamma, size_average, ignore_index, weight)
+        self.chunk_rows = chunk_rows
+
+    def forward(self, inputs, targets):
+        loss = _ChunkedFocalNLL.apply(inputs, targets, self.weight, self.gamma, self.alpha,
+                                      self.ignore_index, self.chunk_rows)
+        return loss / targets.numel() if self.size_average else loss
+
+
+class OHEMCrossEntropyLoss(nn.Module):
+    """Online hard example mining cross entropy
+
+    Averages the loss over the pixels whose target probability is below ``thresh``, and
+    at least over the ``min_kept`` hardest pixels. The cut-off is found with ``kthvalue``
+    (selection, not a full sort) on probabilities computed chunk by chunk without grad.
+    """
+    def __init__(self, thresh=0.7, min_kept=100000, weight=None, ignore_index=255, chunk_rows=64):
+        super(OHEMCrossEntropyLoss, self).__init__()
+        self.thresh = thresh
+        self.min_kept = min_kept
+        self.ignore_index = ignore_index
+        self.chunk_rows = chunk_rows
+        self.register_buffer('weight', weight)
+
+    @torch.no_grad()
+    def _target_prob(self, inputs, targets):
+        prob = torch.ones(targets.shape, dtype=torch.float32, device=targets.device)  # ignored pixels: easy
+        for h0 in range(0, inputs.shape[2], self.chunk_rows):
+            z = inputs[:, :, h0:h0 + self.chunk_rows].float()
+            t, valid = _chunk_targets(targets[:, h0:h0 + self.chunk_rows], self.ignore_index)
+            p_t = (z.gather(1, t) - torch.logsumexp(z, dim=1, keepdim=True)).exp()
+            prob[:, h0:h0 + self.chunk_rows] = p_t.masked_fill(~valid, 1.).squeeze(1)
+        return prob
+
+    def forward(self, inputs, targets):
+        prob = self._target_prob(inputs, targets).view(-1)
+        n_valid = int((targets != self.ignore_index).sum())
+        thresh = self.thresh
+        if 0 < self.min_kept < n_valid:
+            thresh = max(thresh, prob.kthvalue(self.min_kept).values.item())
+        hard_targets = targets.masked_fill(prob.view_as(targets) > thresh, self.ignore_index)
+        loss = _ChunkedFocalNLL.apply(inputs, hard_targets, self.weight, 0, 1., self.ignore_index, self.chunk_rows)
+        return loss / _valid_weight_sum(hard_targets, self.weight, self.ignore_index).clamp(min=1)
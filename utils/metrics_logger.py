@@ -0,0 +1,196 @@
+import json
+import queue
+import threading
+import time
+import warnings
+
+#
+#  Non-blocking metrics logging
+#
+_FLUSH = 'flush'
+_CLOSE = 'close'
+
+
+class JSONLSink(object):
+    """ Appends scalars and tables to a json lines file, one event per line """
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, events):
+        with open(self.path, 'a') as f:
+            for kind, name, step, value, t in events:
+                if kind == 'image':
+                    continue
+                if kind == 'table':
+                    value = {str(k): str(v) for k, v in value.items()}
+                f.write(json.dumps({'kind': kind, 'name': name, 'step': step, 'value': value, 'time': t}) + '\n')
+
+    def close(self):
+        pass
+
+
+class TensorBoardSink(object):
+    """ TensorBoard event files in ``log_dir`` (needs the ``tensorboard`` package) """
+    def __init__(self, log_dir):
+        from torch.utils.tensorboard import SummaryWriter
+        self.writer = SummaryWriter(log_dir)
+
+    def write(self, events):
+        for kind, name, step, value, t in events:
+            if kind == 'scalar':
+                self.writer.add_scalar(name, value, step, walltime=t)
+            elif kind == 'image':
+                self.writer.add_image(name, value, step, walltime=t)
+            elif kind == 'table':
+                text = '| Term | Value |\n|---|---|\n' + ''.join('| %s | %s |\n' % kv for kv in value.items())
+                self.writer.add_text(name, text, step, walltime=t)
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+class VisdomSink(object):
+    """ Visdom dashboard, one ``line`` request per scalar window and batch
+
+    The connection is opened on the first write, from the sink thread, so a missing
+    server never delays the start of training.
+    """
+    def __init__(self, port='13570', env='main', server='http://localhost'):
+        self.port = port
+        self.env = env
+        self.server = server
+        self.vis = None
+
+    def write(self, events):
+        if self.vis is None:
+            from .visualizer import Visualizer
+            self.vis = Visualizer(port=self.port, env=self.env, server=self.server,
+                                  raise_exceptions=True, use_incoming_socket=False)
+        lines = {}
+        for kind, name, step, value, t in events:
+            if kind == 'scalar':
+                xs, ys = lines.setdefault(name, ([], []))
+                xs.append(step)
+                ys.append(value)
+            elif kind == 'image':
+                self.vis.vis_image(name, value)
+            elif kind == 'table':
+                self.vis.vis_table(name, value)
+        for name, (xs, ys) in lines.items():
+            self.vis.vis_scalar(name, xs, ys)
+
+    def close(self):
+        pass
+
+
+class _SinkWorker(object):
+    """ Bounded queue and thread feeding one sink. Events are dropped when the queue is
+    full and write errors are counted and reported, never raised. """
+    def __init__(self, sink, flush_interval, max_queue, max_batch):
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.errors = 0
+        self.idle = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch, deadline, marker = [], None, None
+            while len(batch) < self.max_batch:
+                timeout = None if deadline is None else max(deadline - time.time(), 0)
+                try:
+                    event = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if event is _FLUSH or event is _CLOSE:
+                    marker = event
+                    break
+                batch.append(event)
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+            self._write(batch)
+            if marker is not None:
+                self.idle.set()
+            if marker is _CLOSE:
+                return
+
+    def signal(self, marker, timeout):
+        self.idle.clear()
+        try:
+            self.queue.put(marker, timeout=timeout)
+        except queue.Full:  # sink too slow to drain its queue
+            self.idle.set()
+
+    def _write(self, batch):
+        if not batch:
+            return
+        try:
+            self.sink.write(batch)
+        except Exception as e:
+            self.errors += 1
+            if self.errors == 1 or self.errors % 100 == 0:
+                warnings.warn('%s failed (%d times): %r' % (type(self.sink).__name__, self.errors, e))
+
+
+class MetricsLogger(object):
+    """ Non-blocking logging of training metrics to several sinks
+
+    Calls only enqueue the event and return. Each sink has its own thread that writes
+    batches of events every ``flush_interval`` seconds, so a slow or unreachable sink
+    (e.g. a Visdom server) never stalls training nor delays the other sinks.
+
+    Arguments:
+        sinks (list): objects with ``write(events)`` and ``close()``, e.g. ``JSONLSink``,
+            ``TensorBoardSink`` or ``VisdomSink``. An event is ``(kind, name, step, value, time)``.
+        flush_interval (float): maximum seconds an event waits before being written.
+        max_queue (int): events buffered per sink before new ones are dropped.
+    """
+    def __init__(self, sinks, flush_interval=2.0, max_queue=10000, max_batch=1000):
+        self.workers = [_SinkWorker(sink, flush_interval, max_queue, max_batch) for sink in sinks]
+
+    def _put(self, kind, name, step, value):
+        event = (kind, name, step, value, time.time())
+        for w in self.workers:
+            w.put(event)
+
+    def scalar(self, name, step, value):
+        self._put('scalar', name, step, float(value))
+
+    def image(self, name, img, step=None):
+        """ ``img``: (3, H, W) uint8 array """
+        self._put('image', name, step, img)
+
+    def table(self, name, tbl, step=None):
+        self._put('table', name, step, dict(tbl))
+
+    def flush(self, timeout=None):
+        """ waits until every event queued so far is written (or ``timeout`` expires) """
+        for w in self.workers:
+            w.signal(_FLUSH, timeout)
+        for w in self.workers:
+            w.idle.wait(timeout)
+
+    def close(self, timeout=10.):
+        for w in self.workers:
+            w.signal(_CLOSE, timeout)
+        for w in self.workers:
+            w.thread.join(timeout)
+            try:
+                w.sink.close()
+            except Exception:
+                pass
+
+    def report(self):
+        return ', '.join('%s: %d dropped, %d failed writes' % (type(w.sink).__name__, w.dropped, w.errors)
+                         for w in self.workers)
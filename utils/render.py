@@ -0,0 +1,83 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+from .label_io import make_palette
+
+
+def label_lut(dataset):
+    """(256, 3) uint8 color look-up table of a segmentation dataset (VOC or Cityscapes)"""
+    dataset = getattr(dataset, 'dataset', dataset)  # torch.utils.data.Subset
+    if hasattr(dataset, 'cmap'):
+        return make_palette(dataset.cmap)
+    return make_palette(dataset.train_id_to_color)
+
+
+def to_uint8_images(images, mean, std):
+    """Denormalizes a (N, 3, H, W) tensor or array into (N, H, W, 3) uint8"""
+    images = torch.as_tensor(images).detach().float()
+    mean = torch.tensor(mean, dtype=images.dtype, device=images.device).view(1, -1, 1, 1)
+    std = torch.tensor(std, dtype=images.dtype, device=images.device).view(1, -1, 1, 1)
+    images = ((images * std + mean) * 255).clamp_(0, 255).to(torch.uint8)
+    return images.permute(0, 2, 3, 1).cpu().numpy()
+
+
+def colorize(labels, lut):
+    """(N, H, W) class indices -> (N, H, W, 3) uint8 colors"""
+    return lut[np.asarray(labels).astype(np.uint8)]
+
+
+def blend(images, colors, alpha=0.7):
+    """Integer alpha blending of ``colors`` over ``images``, both uint8"""
+    a = np.uint16(round(alpha * 256))
+    out = images.astype(np.uint16) * (256 - a) + colors.astype(np.uint16) * a
+    return (out >> 8).astype(np.uint8)
+
+
+def render_batch(images, targets, preds, lut, mean, std, alpha=0.7):
+    """Renders image/target/pred/overlay panels for a whole batch
+
+    Returns:
+        dict: 'image', 'target', 'pred' and 'overlay', each a (N, H, W, 3) uint8 array.
+    """
+    images = to_uint8_images(images, mean, std)
+    targets = np.asarray(targets).reshape(np.shape(preds))  # Cityscapes targets are (N, 1, H, W)
+    preds = colorize(preds, lut)
+    return {
+        'image': images,
+        'target': colorize(targets, lut),
+        'pred': preds,
+        'overlay': blend(images, preds, alpha),
+    }
+
+
+class AsyncImageSaver(object):
+    """Saves images on a bounded thread pool
+
+    At most ``max_pending`` images wait to be encoded, so ``save`` blocks instead of
+    letting rendered images pile up in memory when the disk is slower than the model.
+    """
+    def __init__(self, num_workers=4, max_pending=32):
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def _save(self, array, path):
+        try:
+            Image.fromarray(array).save(path)
+        finally:
+            self.slots.release()
+
+    def save(self, array, path):
+        self.slots.acquire()
+        self.futures.append(self.executor.submit(self._save, array, path))
+
+    def close(self):
+        """Waits for pending images and re-raises the first failure"""
+        futures, self.futures = self.futures, []
+        for f in futures:
+            f.result()
+        self.executor.shutdown()
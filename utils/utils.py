@@ -1,5 +1,7 @@
 from torchvision.transforms.functional import normalize
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 import os 
 
@@ -36,3 +38,25 @@ def fix_bn(model):
 def mkdir(path):
     if not os.path.exists(path):
         os.mkdir(path)
+
+def downsample_labels(labels, size, num_classes, ignore_index=255, mode='mode', min_valid=0.5):
+    """Downsamples (N, H, W) labels to ``size``, e.g. to train on decoder-resolution logits
+
+    ``nearest`` picks one pixel per output cell. ``mode`` takes the most frequent valid
+    class of the cell (one class at a time, no one-hot tensor), and ``ignore_index`` when
+    less than ``min_valid`` of the cell is labeled.
+    """
+    if tuple(labels.shape[-2:]) == tuple(size):
+        return labels
+    if mode == 'nearest':
+        return F.interpolate(labels[:, None].float(), size=size, mode='nearest')[:, 0].to(labels.dtype)
+    best = torch.zeros((labels.shape[0], 1) + tuple(size), dtype=torch.float32, device=labels.device)
+    out = torch.full_like(best, ignore_index, dtype=labels.dtype)
+    for c in range(num_classes):
+        frac = F.adaptive_avg_pool2d((labels == c)[:, None].float(), size)
+        better = frac > best
+        best = torch.where(better, frac, best)
+        out.masked_fill_(better, c)
+    valid = F.adaptive_avg_pool2d((labels != ignore_index)[:, None].float(), size)
+    out.masked_fill_(valid < min_valid, ignore_index)
+    return out[:, 0]
@@ -4,9 +4,9 @@ import json
 class Visualizer(object):
     """ Visualizer
     """
-    def __init__(self, port='13579', env='main', id=None):
+    def __init__(self, port='13579', env='main', id=None, server='http://localhost', **kwargs):
         #self.cur_win = {}
-        self.vis = Visdom(port=port, env=env)
+        self.vis = Visdom(server=server, port=port, env=env, **kwargs)
         self.id = id
         self.env = env
         # Restore